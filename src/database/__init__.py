@@ -1,4 +1,15 @@
 from .db import *
+from .pool import *
 from .models import *
+from .pagination import *
 from .queries import *
+from .aggregates import *
+from .playlists import *
+from .user_cache import *
+from .search import *
+from .suggest import *
+from .snapshot import *
+from .instrumentation import *
+from .ingest import *
 from .populators import *
+from .explain import *
@@ -0,0 +1,92 @@
+from typing import Iterable, Optional
+
+from .db import database
+from .models import Artist, Album, Track, Playlist, playlist_track
+
+db = database()
+
+# The most rows to update in a single statement
+CHUNK_SIZE = 500
+
+
+def _get_album_aggregates() -> dict:
+    def tracks(column):
+        return db.select([column]).where(Track.album_key == Album.id).as_scalar()
+
+    return {
+        Album.track_count: tracks(db.func.count(Track.id)),
+        Album.disc_count: tracks(db.func.count(db.distinct(Track.disc_num))),
+        Album.total_size: tracks(db.func.coalesce(db.func.sum(Track.size), 0)),
+        Album.total_duration: tracks(db.func.coalesce(db.func.sum(Track.duration), 0))
+    }
+
+
+def _get_artist_aggregates() -> dict:
+    return {
+        Artist.album_count: db.select([db.func.count(Album.id)]).where(Album.artist_key == Artist.id).as_scalar(),
+        Artist.track_count: db.select([db.func.count(Track.id)]).where(Track.artist_key == Artist.id).as_scalar()
+    }
+
+
+def _get_playlist_aggregates() -> dict:
+    def tracks(column):
+        return db.select([column]).select_from(playlist_track.join(Track, playlist_track.c.track_id == Track.id)) \
+            .where(playlist_track.c.playlist_id == Playlist.id).as_scalar()
+
+    return {
+        Playlist.track_count: tracks(db.func.count(Track.id)),
+        Playlist.total_size: tracks(db.func.coalesce(db.func.sum(Track.size), 0)),
+        Playlist.total_duration: tracks(db.func.coalesce(db.func.sum(Track.duration), 0))
+    }
+
+
+def _update(model, values: dict, keys: Optional[Iterable[int]], connection):
+    """
+    Recomputes aggregate columns with one statement per chunk of rows.
+
+    :param keys: The IDs of the rows to update, or None for every row.
+    :param connection: The connection to use, or None for the session.
+    """
+    executor = connection if connection is not None else db.session
+    table = model.__table__
+    values = {table.c[column.key]: value for column, value in values.items()}
+
+    if keys is None:
+        executor.execute(table.update().values(values))
+        return
+
+    keys = [key for key in set(keys) if key is not None]
+    for i in range(0, len(keys), CHUNK_SIZE):
+        executor.execute(table.update().where(table.c.id.in_(keys[i:i + CHUNK_SIZE])).values(values))
+
+
+def update_album_aggregates(keys: Iterable[int] = None, connection=None):
+    """
+    Recomputes the track count, disc count, total size
+    and total duration of albums from their tracks.
+
+    :param keys: The IDs of the albums, or None for every album.
+    :param connection: The connection to use, or None for the session.
+    """
+    _update(Album, _get_album_aggregates(), keys, connection)
+
+
+def update_artist_aggregates(keys: Iterable[int] = None, connection=None):
+    """
+    Recomputes the album and track counts of artists.
+
+    :param keys: The IDs of the artists, or None for every artist.
+    :param connection: The connection to use, or None for the session.
+    """
+    _update(Artist, _get_artist_aggregates(), keys, connection)
+
+
+def update_playlist_aggregates(keys: Iterable[int] = None, connection=None):
+    """
+    Recomputes the track count, total size and
+    total duration of playlists from their tracks.
+
+    :param keys: The IDs of the playlists, or None for every playlist.
+    :param connection: The connection to use, or None for the session.
+    """
+    _update(Playlist, _get_playlist_aggregates(), keys, connection)
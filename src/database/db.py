@@ -5,11 +5,30 @@ from flask_sqlalchemy import SQLAlchemy
 db: SQLAlchemy = SQLAlchemy()
 
 
-def init(app):
+def init(app, sqlite_pragmas: dict = None):
+    """
+    Connects the database to the app, creating any missing
+    tables and applying any pending migrations.
+
+    :param sqlite_pragmas: The pragmas to set on each connection if the database is SQLite.
+    """
     with app.app_context():
         db.init_app(app)
+
+        from .pool import make_fork_safe, set_sqlite_pragmas
+        make_fork_safe(db.engine)
+        if sqlite_pragmas and db.engine.dialect.name == 'sqlite':
+            set_sqlite_pragmas(db.engine, sqlite_pragmas)
+
         db.create_all()
 
+        from .migrations import migrate
+        migrate()
+
+        # Leave no connections open for forked workers to inherit
+        db.session.remove()
+        db.engine.dispose()
+
 
 def session():
     return db.session
@@ -0,0 +1,129 @@
+import datetime
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event
+
+from .db import database
+from .models import User
+from .pagination import encode_cursor
+from .playlists import _get_new_tracks
+from .queries import get_user_by_username, get_user_by_api_key, get_artists_page, get_artist_by_id, \
+    get_artist_albums_page, get_album_by_id, get_album_with_tracks, get_album_by_name, get_album_disc_by_id, \
+    get_track_by_id, get_track_with_album, get_playlists_page, get_playlist_tracks_page, get_track_keys_by_plex_id, \
+    get_track_hash_map
+
+db = database()
+
+# The query functions called by each route, with placeholder values.
+# Paginated listings are checked on their first page and on a later
+# one, which filters by its cursor. Searches by substring cannot use
+# an index and are not listed.
+ROUTE_QUERIES: List[Tuple[str, Callable]] = [
+    ("users: by username", lambda: get_user_by_username('user')),
+    ("users: by API key", lambda: get_user_by_api_key('key')),
+    ("music: artists by sort name", lambda: get_artists_page(None)),
+    ("music: artists after cursor", lambda: get_artists_page(encode_cursor(['artist', 1]))),
+    ("music: artist by ID", lambda: get_artist_by_id(1)),
+    ("music: artist albums", lambda: get_artist_albums_page(1, None)),
+    ("music: artist albums after cursor", lambda: get_artist_albums_page(1, encode_cursor([datetime.date(2000, 1, 1),
+                                                                                          1]))),
+    ("music: album by ID", lambda: get_album_by_id(1)),
+    ("music: album with tracks", lambda: get_album_with_tracks(1)),
+    ("music: album by name", lambda: get_album_by_name('artist', 'album')),
+    ("music: album disc", lambda: get_album_disc_by_id(1, 1)),
+    ("music: track by ID", lambda: get_track_by_id(1)),
+    ("music: track with album", lambda: get_track_with_album(1)),
+    ("music: playlists by user", lambda: get_playlists_page(User(id=1), None)),
+    ("music: playlist tracks", lambda: get_playlist_tracks_page(1, None)),
+    ("music: playlist tracks after cursor", lambda: get_playlist_tracks_page(1, encode_cursor([0, 1]))),
+    ("music: playlist membership", lambda: _get_new_tracks(1, [1, 2])),
+    ("ingest: track by Plex ID", lambda: get_track_keys_by_plex_id([1])),
+    ("ingest: track by hash", lambda: get_track_hash_map([1])),
+]
+
+
+@contextmanager
+def _capture_statements() -> Iterator[List[Tuple[str, tuple]]]:
+    """
+    Records the SQL and parameters of every statement
+    executed inside the context, as sent to the database.
+    """
+    statements = []
+
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', capture)
+
+
+def _explain(statement: str, parameters) -> Optional[Tuple[List[str], bool]]:
+    """
+    Gets the plan the database would use for a statement.
+
+    :param statement: The SQL of the statement, as sent to the database.
+    :param parameters: The parameters it was sent with.
+    :return: The lines of the plan and whether every
+    table it reads is accessed through an index, or None
+    if plans cannot be read from this database.
+    """
+    dialect = db.engine.dialect.name
+    cursor = db.session.connection().connection.cursor()
+
+    try:
+        if dialect == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plan = [row[-1] for row in cursor.fetchall()]
+            # Full scans are shown as "SCAN table" without an index
+            return plan, not any(line.startswith('SCAN') and 'INDEX' not in line for line in plan)
+
+        if dialect == 'mysql':
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            plan = ['%s: %s using %s' % (row['table'], row['type'], row['key']) for row in rows]
+            return plan, not any(row['type'] == 'ALL' for row in rows)
+    finally:
+        cursor.close()
+
+    return None
+
+
+def check_query_plans() -> bool:
+    """
+    Calls the query functions of every route, and prints the plan of
+    each statement they execute, flagging those which scan a whole
+    table rather than using an index.
+
+    :return: True if every query uses an index,
+    or plans cannot be read from this database.
+    """
+    passed = True
+    for name, call in ROUTE_QUERIES:
+        with _capture_statements() as statements:
+            call()
+
+        for i, (statement, parameters) in enumerate(statements):
+            result = _explain(statement, parameters)
+            if result is None:
+                # Skipped rather than failed, as the queries may well use an index
+                print("Query plans are not supported for %s" % db.engine.dialect.name)
+                db.session.rollback()
+                return passed
+
+            plan, uses_index = result
+            passed &= uses_index
+
+            number = ' (%d)' % (i + 1) if len(statements) > 1 else ''
+            print("%s %s%s" % ('OK  ' if uses_index else 'SCAN', name, number))
+            for line in plan:
+                print("\t" + line)
+
+        db.session.rollback()
+
+    return passed
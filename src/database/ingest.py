@@ -0,0 +1,609 @@
+import datetime
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import helper
+from .aggregates import update_album_aggregates, update_artist_aggregates, update_playlist_aggregates
+from .db import database
+from .instrumentation import IngestStats
+from .models import Artist, Album, Track, IngestCheckpoint, ProbeCache, playlist_track
+from .queries import get_artist_hash_map, get_album_hash_map, get_track_hash_map, get_ingest_checkpoint, \
+    set_sync_watermark
+from .snapshot import write_catalog_snapshot, schedule_catalog_snapshot
+
+db = database()
+
+
+class Ingest:
+    """
+    Collects artists, albums and tracks from a backend
+    and writes only the ones not already in the database.
+
+    The existing hashes are loaded once when the ingest is
+    created, so checking whether a row is new never touches
+    the database. New rows are queued and written using bulk
+    inserts every `batch_size` tracks, meaning each batch
+    costs a constant number of round trips.
+
+    Every batch is committed on its own along with a checkpoint
+    of the last artist the backend finished, so an interrupted
+    ingest loses at most one batch and can be resumed.
+
+    Every track the backend reports is marked, so that once a full
+    pass is complete any unmarked tracks can be swept away.
+
+    The time spent in each stage and the rows written are recorded
+    in `stats`, which populators add their own stages to.
+
+    If `snapshot_path` is given, the catalog snapshot there is
+    rewritten when the ingest finishes, if anything changed, or
+    `snapshot_delay` seconds later, so that frequent small ingests
+    rewrite it once between them.
+
+    Ingests can skip loading every hash with `preload=False`, and
+    instead call `load_hashes` with the hashes they are about to check,
+    one batch at a time. Only that batch's track hashes are held, so
+    memory grows with the number of albums and artists rather than
+    tracks. The hashes of every reported track are still marked,
+    as `sweep` needs them.
+    """
+
+    def __init__(self, backend: str, batch_size: int = 500, progress_interval: float = 10,
+                 snapshot_path: str = None, preload: bool = True, snapshot_delay: float = 0):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.snapshot_path = snapshot_path
+        self.snapshot_delay = snapshot_delay
+        self.stats = IngestStats(backend, progress_interval)
+
+        self._completed: Optional[Tuple[str, int]] = None
+        self._preloaded = preload
+
+        self.artists: Dict[int, int] = {}
+        self.albums: Dict[int, int] = {}
+        self.tracks: Dict[int, int] = {}
+        if preload:
+            with self.stats.stage('diff'):
+                self.artists = get_artist_hash_map()
+                self.albums = get_album_hash_map()
+                self.tracks = get_track_hash_map()
+
+        self._new_artists: Dict[int, dict] = {}
+        self._new_albums: Dict[int, dict] = {}
+        self._new_tracks: Dict[int, dict] = {}
+        self._updated_artists: List[dict] = []
+        self._updated_albums: List[dict] = []
+        self._updated_tracks: List[dict] = []
+
+        self._new_probes: List[dict] = []
+        self._updated_probes: List[dict] = []
+
+        self._marked: Set[int] = set()
+        self._inserted: Dict[Tuple[int, int], int] = {}
+
+    def load_hashes(self, artist_hashes: Iterable[int], album_hashes: Iterable[int], track_hashes: Iterable[int]):
+        """
+        Loads the IDs of the given hashes which are in the database,
+        for ingests created without preloading, replacing the track
+        hashes of the previous batch. Does nothing otherwise,
+        as every hash is already loaded.
+        """
+        if self._preloaded:
+            return
+
+        with self.stats.stage('diff'):
+            # Tracks already written are found again if reported twice,
+            # and those still queued are checked by `has_track`
+            self.tracks = {}
+
+            for hashes, known, get_hash_map in [(artist_hashes, self.artists, get_artist_hash_map),
+                                                (album_hashes, self.albums, get_album_hash_map),
+                                                (track_hashes, self.tracks, get_track_hash_map)]:
+                hashes = list(set(hashes) - known.keys())
+                for i in range(0, len(hashes), self.batch_size):
+                    known.update(get_hash_map(hashes[i:i + self.batch_size]))
+
+    def has_artist(self, artist_hash: int) -> bool:
+        return artist_hash in self.artists or artist_hash in self._new_artists
+
+    def has_album(self, album_hash: int) -> bool:
+        return album_hash in self.albums or album_hash in self._new_albums
+
+    def has_track(self, track_hash: int) -> bool:
+        return track_hash in self.tracks or track_hash in self._new_tracks
+
+    def mark_track(self, track_hash: int) -> bool:
+        """
+        Marks a track as still present in the backend,
+        so that it is not removed by `sweep`.
+
+        :return: True if the track is already known.
+        """
+        self._marked.add(track_hash)
+        self.stats.progress(len(self._marked))
+        return self.has_track(track_hash)
+
+    def add_artist(self, artist_hash: int, **fields):
+        if self.has_artist(artist_hash):
+            return
+
+        fields['hash'] = artist_hash
+        self._new_artists[artist_hash] = fields
+
+    def add_album(self, album_hash: int, artist_hash: int, **fields):
+        """
+        Queues an album for insertion.
+        The artist key is resolved from the artist hash when written.
+        """
+        if self.has_album(album_hash):
+            return
+
+        fields['hash'] = album_hash
+        fields['artist_hash'] = artist_hash
+        self._new_albums[album_hash] = fields
+
+    def update_artist(self, key: int, artist_hash: int, **fields):
+        """
+        Queues new values for an existing artist, such as one renamed
+        in the backend. The new hash refers to the artist straight away.
+
+        :param key: The ID of the artist to update.
+        """
+        fields['id'] = key
+        fields['hash'] = artist_hash
+        self._updated_artists.append(fields)
+        self.artists[artist_hash] = key
+
+    def update_album(self, key: int, album_hash: int, artist_hash: int, **fields):
+        """
+        Queues new values for an existing album, such as one renamed
+        in the backend. The new hash refers to the album straight away.
+        The artist key is resolved from the artist hash when written.
+
+        :param key: The ID of the album to update.
+        """
+        fields['id'] = key
+        fields['hash'] = album_hash
+        fields['artist_hash'] = artist_hash
+        self._updated_albums.append(fields)
+        self.albums[album_hash] = key
+
+    def add_track(self, track_hash: int, album_hash: int, artist_hash: int, **fields):
+        """
+        Queues a track for insertion.
+        The artist and album keys are resolved from their hashes when written.
+        """
+        if self.mark_track(track_hash):
+            return
+
+        fields['hash'] = track_hash
+        fields['artist_hash'] = artist_hash
+        fields['album_hash'] = album_hash
+        self._new_tracks[track_hash] = fields
+        move_key = _get_move_key(fields)
+        if move_key is not None:
+            self._inserted[move_key] = track_hash
+
+        if len(self._new_tracks) >= self.batch_size:
+            self.flush()
+
+    def update_track(self, key: int, track_hash: int, album_hash: int, artist_hash: int, **fields):
+        """
+        Queues new values for an existing track.
+        The artist and album keys are resolved from their hashes when written.
+
+        :param key: The ID of the track to update.
+        """
+        self.mark_track(track_hash)
+
+        fields['id'] = key
+        fields['hash'] = track_hash
+        fields['artist_hash'] = artist_hash
+        fields['album_hash'] = album_hash
+        self._updated_tracks.append(fields)
+
+        if len(self._updated_tracks) >= self.batch_size:
+            self.flush()
+
+    def cache_probe(self, relative_path: str, probed: dict):
+        """
+        Queues a fresh probe result to be stored in the probe cache.
+
+        :param relative_path: The path of the file relative to the library.
+        :param probed: The result from `probe.probe_file`.
+        """
+        row = {key: probed[key] for key in ['bitrate', 'duration', 'size', 'mtime_ns', 'format', 'tag_digest']}
+        row['path'] = relative_path
+        row['path_hash'] = helper.generate_path_hash(relative_path)
+
+        if probed['id']:
+            row['id'] = probed['id']
+            self._updated_probes.append(row)
+        else:
+            self._new_probes.append(row)
+
+    def get_resume_cursor(self) -> int:
+        """
+        :return: The backend cursor to continue from,
+        or 0 if there is no checkpoint.
+        """
+        checkpoint = get_ingest_checkpoint(self.backend)
+        if not checkpoint:
+            return 0
+
+        print("Resuming %s ingest after %s" % (self.backend, checkpoint.artist))
+        return checkpoint.cursor
+
+    def end_artist(self, name: str, cursor: int):
+        """
+        Marks every row for an artist as queued.
+        The checkpoint written with the next batch will point here.
+
+        :param name: The name of the artist, or the directory
+        for backends which walk the library by directory.
+        :param cursor: The backend position to resume from.
+        """
+        self._completed = name, cursor
+
+    def flush(self):
+        """
+        Writes all queued rows to the database and commits them
+        along with the checkpoint.
+        Artists are written first, then albums, then tracks,
+        so that each can reference the keys of the last.
+        """
+        with self.stats.stage('insert'):
+            self._write()
+
+        with self.stats.stage('commit'):
+            db.session.commit()
+            db.session.expunge_all()
+
+    def _write(self):
+        """
+        Writes all queued rows and the checkpoint without committing.
+        """
+        self.stats.count('artists_inserted', len(self._new_artists))
+        self.stats.count('albums_inserted', len(self._new_albums))
+        self.stats.count('tracks_inserted', len(self._new_tracks))
+        self.stats.count('artists_updated', len(self._updated_artists))
+        self.stats.count('albums_updated', len(self._updated_albums))
+        self.stats.count('tracks_updated', len(self._updated_tracks))
+        self.stats.count('probes_cached', len(self._new_probes) + len(self._updated_probes))
+
+        self._insert(Artist, self._new_artists, self.artists, get_artist_hash_map)
+        artist_keys = {artist['id'] for artist in self._updated_artists}
+        self._update(Artist, self._updated_artists, self.artists)
+
+        for album in [*self._new_albums.values(), *self._updated_albums]:
+            album['artist_key'] = self.artists[album.pop('artist_hash')]
+            artist_keys.add(album['artist_key'])
+        album_keys = {album['id'] for album in self._updated_albums}
+        self._insert(Album, self._new_albums, self.albums, get_album_hash_map)
+
+        # A renamed album may also have moved to another artist
+        artist_keys.update(self._update(Album, self._updated_albums, self.albums, Album.artist_key))
+
+        for track in [*self._new_tracks.values(), *self._updated_tracks]:
+            track['artist_key'] = self.artists[track.pop('artist_hash')]
+            track['album_key'] = self.albums[track.pop('album_hash')]
+            artist_keys.add(track['artist_key'])
+            album_keys.add(track['album_key'])
+        self._insert(Track, self._new_tracks, self.tracks, get_track_hash_map)
+
+        playlist_keys = set()
+        if self._updated_tracks:
+            # An updated track may have left its album, and its size
+            # and duration count towards any playlists it is on
+            updated_keys = [track['id'] for track in self._updated_tracks]
+            for old_hash, album_key, artist_key in db.session.query(Track.hash, Track.album_key, Track.artist_key) \
+                    .filter(Track.id.in_(updated_keys)):
+                self.tracks.pop(old_hash, None)
+                album_keys.add(album_key)
+                artist_keys.add(artist_key)
+            playlist_keys = _get_playlist_keys(updated_keys)
+
+            self.tracks.update({track['hash']: track['id'] for track in self._updated_tracks})
+            db.session.bulk_update_mappings(Track, self._updated_tracks)
+            self._updated_tracks.clear()
+
+        self._update_aggregates(album_keys, artist_keys, playlist_keys)
+
+        self._write_probes()
+
+        if self._completed:
+            artist, cursor = self._completed
+            db.session.merge(IngestCheckpoint(backend=self.backend, artist=artist, cursor=cursor,
+                                              updated_at=datetime.datetime.now()))
+
+    def _write_probes(self):
+        """
+        Inserts or updates the queued probe results. A path can be queued
+        twice, or already be cached without having been loaded as cached,
+        so paths without a cache ID are looked up before inserting.
+        """
+        rows = {}
+        for row in [*self._new_probes, *self._updated_probes]:
+            rows[row['path_hash']] = dict(rows.get(row['path_hash'], {}), **row)
+        self._new_probes.clear()
+        self._updated_probes.clear()
+
+        new = {path_hash: row for path_hash, row in rows.items() if not row.get('id')}
+        if new:
+            for path_hash, key in db.session.query(ProbeCache.path_hash, ProbeCache.id) \
+                    .filter(ProbeCache.path_hash.in_(list(new))):
+                new[path_hash]['id'] = key
+
+        db.session.bulk_insert_mappings(ProbeCache, [row for row in rows.values() if not row.get('id')])
+        db.session.bulk_update_mappings(ProbeCache, [row for row in rows.values() if row.get('id')])
+
+    def commit(self):
+        """
+        Writes any remaining rows and removes the checkpoint,
+        as there is nothing left to resume.
+        """
+        self.flush()
+
+        with self.stats.stage('commit'):
+            db.session.query(IngestCheckpoint).filter_by(backend=self.backend).delete()
+            db.session.commit()
+
+    def finish(self) -> dict:
+        """
+        Records the summary of this ingest, and the time it finished
+        if it changed anything, so that caches of the catalog know
+        to refresh. See `IngestStats.finish`.
+        """
+        changes = ['artists_inserted', 'albums_inserted', 'tracks_inserted',
+                   'artists_updated', 'albums_updated', 'tracks_updated', 'tracks_deleted']
+        changed = any(self.stats.counts.get(name) for name in changes)
+        if changed:
+            set_sync_watermark('ingest', self.backend, int(time.time()))
+
+        if self.snapshot_path and (changed or not os.path.exists(self.snapshot_path)):
+            if self.snapshot_delay:
+                schedule_catalog_snapshot(self.snapshot_path, self.snapshot_delay)
+            else:
+                with self.stats.stage('snapshot'):
+                    write_catalog_snapshot(self.snapshot_path)
+
+        return self.stats.finish(len(self._marked))
+
+    def sweep(self, criterion, allow_empty: bool = False) -> int:
+        """
+        Deletes every track matching the criterion which was not marked
+        during this ingest, along with their playlist entries and any
+        albums and artists left empty.
+
+        A deleted track with the same size and duration as a track
+        inserted during this ingest is treated as having been moved,
+        and its playlist entries are moved to the new track.
+
+        Should only be called once the backend has reported
+        every track, otherwise tracks will be wrongly removed. If no
+        tracks were reported at all, nothing is removed, as an empty
+        listing is more likely a failure of the backend than an empty library.
+
+        :param criterion: A filter limiting the sweep to tracks from this backend.
+        :param allow_empty: If true, sweep even if no tracks were reported,
+        for when the criterion only covers places known to be empty.
+        :return: The number of tracks removed.
+        """
+        self.flush()
+
+        if not self._marked and not allow_empty:
+            print("[%s] No tracks were reported, so none will be removed" % self.backend)
+            return 0
+
+        with self.stats.stage('diff'):
+            candidates = {key for key, in db.session.query(Track.id).filter(criterion)}
+            kept = set(self._get_track_keys(self._marked).values())
+            missing = [*(candidates - kept)]
+
+            moved = []
+            for i in range(0, len(missing), self.batch_size):
+                chunk = missing[i:i + self.batch_size]
+
+                for key, size, duration in db.session.query(Track.id, Track.size, Track.duration) \
+                        .filter(Track.id.in_(chunk)):
+                    move_key = _get_move_key({'size': size, 'duration': duration})
+                    if move_key is None:
+                        continue
+
+                    # Each new track can only take the place of one old one
+                    moved_hash = self._inserted.pop(move_key, None)
+                    if moved_hash is not None:
+                        moved.append((key, moved_hash))
+
+            inserted = self._get_track_keys(moved_hash for key, moved_hash in moved)
+            moves = [(key, inserted[moved_hash]) for key, moved_hash in moved if moved_hash in inserted]
+
+        if moves:
+            with self.stats.stage('delete'):
+                self._move_playlist_entries(moves)
+
+        self.stats.count('tracks_moved', len(moves))
+        self.delete_tracks(missing)
+
+        return len(missing)
+
+    def _get_track_keys(self, track_hashes: Iterable[int]) -> Dict[int, int]:
+        """
+        :return: A dictionary of hash to ID for the given track hashes,
+        looked up in batches if they were not preloaded.
+        """
+        if self._preloaded:
+            return {track_hash: self.tracks[track_hash] for track_hash in track_hashes
+                    if track_hash in self.tracks}
+
+        track_hashes = [*track_hashes]
+
+        keys = {}
+        for i in range(0, len(track_hashes), self.batch_size):
+            keys.update(get_track_hash_map(track_hashes[i:i + self.batch_size]))
+
+        return keys
+
+    def _move_playlist_entries(self, moves: List[Tuple[int, int]]):
+        """
+        Moves the playlist entries of old tracks to the new tracks which
+        replaced them. An entry is left on the old track, to be deleted
+        with it, if the new track is already on that playlist.
+
+        :param moves: The ID of each old track and of the new track.
+        """
+        for i in range(0, len(moves), self.batch_size):
+            chunk = dict(moves[i:i + self.batch_size])
+
+            existing = set(db.session.query(playlist_track.c.track_id, playlist_track.c.playlist_id)
+                           .filter(playlist_track.c.track_id.in_(list(chunk.values()))))
+            entries = [{'old_id': old_id, 'new_id': chunk[old_id], 'b_playlist_id': playlist_id}
+                       for old_id, playlist_id in db.session.query(playlist_track.c.track_id,
+                                                                   playlist_track.c.playlist_id)
+                       .filter(playlist_track.c.track_id.in_(list(chunk)))
+                       if (chunk[old_id], playlist_id) not in existing]
+
+            if entries:
+                db.session.execute(playlist_track.update()
+                                   .where(playlist_track.c.track_id == db.bindparam('old_id'))
+                                   .where(playlist_track.c.playlist_id == db.bindparam('b_playlist_id'))
+                                   .values(track_id=db.bindparam('new_id')), entries)
+
+    def delete_tracks(self, keys: List[int]):
+        """
+        Deletes tracks along with their playlist entries,
+        and any albums and artists left empty.
+
+        Each batch is committed on its own, so that a large
+        deletion never holds the database's write lock for long.
+
+        :param keys: The IDs of the tracks to delete.
+        """
+        for i in range(0, len(keys), self.batch_size):
+            with self.stats.stage('delete'):
+                self._delete(keys[i:i + self.batch_size])
+
+            with self.stats.stage('commit'):
+                db.session.commit()
+
+        self.stats.count('tracks_deleted', len(keys))
+
+        deleted = set(keys)
+        self.tracks = {track_hash: key for track_hash, key in self.tracks.items() if key not in deleted}
+        if self._preloaded:
+            self.albums = get_album_hash_map()
+            self.artists = get_artist_hash_map()
+        else:
+            # Reloaded by the next `load_hashes` if still needed
+            self.albums.clear()
+            self.artists.clear()
+
+    def _delete(self, keys: List[int]):
+        """
+        Deletes a batch of tracks and anything left empty without committing.
+        Only the albums and artists of the deleted tracks are checked.
+        """
+        # Expanding parameters are much quicker to build than a literal list,
+        # which matters here, as the write lock is held from the first delete
+        track_keys = {'keys': keys}
+        in_keys = db.bindparam('keys', expanding=True)
+
+        album_keys = set()
+        artist_keys = set()
+        for album_key, artist_key in db.session.query(Track.album_key, Track.artist_key) \
+                .filter(Track.id.in_(in_keys)).params(track_keys):
+            album_keys.add(album_key)
+            artist_keys.add(artist_key)
+        playlist_keys = {key for key, in db.session.query(playlist_track.c.playlist_id)
+                         .filter(playlist_track.c.track_id.in_(in_keys)).distinct().params(track_keys)}
+
+        db.session.execute(playlist_track.delete().where(playlist_track.c.track_id.in_(in_keys)), track_keys)
+        db.session.execute(Track.__table__.delete().where(Track.__table__.c.id.in_(in_keys)), track_keys)
+
+        empty_albums = db.session.query(Album.id, Album.artist_key).filter(Album.id.in_(album_keys)) \
+            .filter(~db.exists().where(Track.album_key == Album.id)).all()
+        if empty_albums:
+            artist_keys.update(artist_key for _, artist_key in empty_albums)
+            db.session.query(Album).filter(Album.id.in_([key for key, _ in empty_albums])) \
+                .delete(synchronize_session=False)
+
+        db.session.query(Artist).filter(Artist.id.in_(artist_keys)) \
+            .filter(~db.exists().where(Album.artist_key == Artist.id)) \
+            .filter(~db.exists().where(Track.artist_key == Artist.id)) \
+            .delete(synchronize_session=False)
+
+        self._update_aggregates(album_keys, artist_keys, playlist_keys)
+
+    @staticmethod
+    def _update_aggregates(album_keys: Set[int], artist_keys: Set[int], playlist_keys: Set[int]):
+        """
+        Recomputes the aggregates of every album, artist and playlist
+        whose tracks changed, with one statement per table, as the rows
+        for an album may arrive over several batches.
+        """
+        if album_keys:
+            update_album_aggregates(album_keys)
+
+        if artist_keys:
+            update_artist_aggregates(artist_keys)
+
+        if playlist_keys:
+            update_playlist_aggregates(playlist_keys)
+
+    @staticmethod
+    def _insert(model, pending: Dict[int, dict], known: Dict[int, int], get_hash_map):
+        """
+        Bulk inserts the pending rows for a model,
+        then fetches their new IDs in a single query.
+        """
+        if not pending:
+            return
+
+        rows: List[dict] = [*pending.values()]
+        db.session.bulk_insert_mappings(model, rows)
+        known.update(get_hash_map(pending.keys()))
+        pending.clear()
+
+    @staticmethod
+    def _update(model, pending: List[dict], known: Dict[int, int], column=None) -> Set[int]:
+        """
+        Bulk updates the pending rows for a model,
+        replacing their old hashes with their new ones.
+
+        :param column: A column whose values from before the update are returned.
+        :return: The old values of the column, if given.
+        """
+        if not pending:
+            return set()
+
+        old = set()
+        columns = [model.hash] if column is None else [model.hash, column]
+        for values in db.session.query(*columns).filter(model.id.in_([row['id'] for row in pending])):
+            known.pop(values[0], None)
+            old.update(values[1:])
+
+        known.update({row['hash']: row['id'] for row in pending})
+        db.session.bulk_update_mappings(model, pending)
+        pending.clear()
+        return old
+
+
+def _get_playlist_keys(track_keys: List[int]) -> Set[int]:
+    """
+    :return: The IDs of the playlists containing any of the tracks.
+    """
+    query = db.session.query(playlist_track.c.playlist_id).filter(playlist_track.c.track_id.in_(track_keys)).distinct()
+    return {key for key, in query}
+
+
+def _get_move_key(track: dict) -> Optional[Tuple[int, int]]:
+    """
+    :return: The values used to recognise a track which has been
+    moved or renamed, or None if its size is unknown, as tracks
+    without a size cannot be told apart.
+    """
+    if track.get('size') is None:
+        return None
+
+    return track.get('size'), int(round(track.get('duration') or 0))
@@ -0,0 +1,312 @@
+import datetime
+import re
+import threading
+from collections import deque
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from typing import Deque, Dict, Iterable, Iterator, List
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+
+# The most ingest summaries to keep, as a watching
+# process finishes an ingest for every change
+MAX_SUMMARIES = 100
+
+# Summaries of the latest ingests finished by this process
+_summaries: Deque[dict] = deque(maxlen=MAX_SUMMARIES)
+
+
+class IngestStats:
+    """
+    Times the stages of an ingest and counts the rows it writes.
+
+    Stages nest, and time spent in an inner stage is not counted
+    towards the outer one, so the stage times add up to the total.
+    This lets interleaved work, such as fetching the next file
+    while waiting on a probe, be attributed to the right stage.
+    """
+
+    def __init__(self, backend: str, progress_interval: float = 10):
+        self.backend = backend
+        self.progress_interval = progress_interval
+
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+
+        self._started_at = datetime.datetime.now()
+        self._start = timer()
+        self._last_progress = self._start
+
+        self._stack: List[str] = []
+        self._stage_start = self._start
+
+    def _add_time(self, name: str, now: float):
+        self.stages[name] = self.stages.get(name, 0) + now - self._stage_start
+        self._stage_start = now
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times the enclosed block as part of a stage,
+        pausing the stage which was running before it.
+        """
+        if self._stack:
+            self._add_time(self._stack[-1], timer())
+        else:
+            self._stage_start = timer()
+
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._add_time(self._stack.pop(), timer())
+
+    def timed(self, items: Iterable, name: str) -> Iterator:
+        """
+        Times how long each item of an iterable takes to produce,
+        without timing the code which consumes it.
+        """
+        iterator = iter(items)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name: str, amount: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def progress(self, seen: int):
+        """
+        Prints a progress line if one has not been
+        printed in the last `progress_interval` seconds.
+
+        :param seen: The number of tracks seen so far.
+        """
+        now = timer()
+        if now - self._last_progress < self.progress_interval:
+            return
+
+        self._last_progress = now
+        elapsed = now - self._start
+        print("[%s] %d tracks seen, %d inserted, %.1f tracks/s, %ds elapsed"
+              % (self.backend, seen, self.counts.get('tracks_inserted', 0), seen / elapsed, elapsed))
+
+    def finish(self, seen: int) -> dict:
+        """
+        Ends the ingest, prints a final line and
+        records its summary for `get_ingest_summaries`.
+
+        :param seen: The number of tracks seen.
+        :return: The summary of the ingest.
+        """
+        elapsed = timer() - self._start
+        counts = dict(self.counts, tracks_seen=seen)
+
+        inserted = sum(counts.get(name, 0) for name in ['artists_inserted', 'albums_inserted', 'tracks_inserted'])
+        insert_time = self.stages.get('insert', 0)
+
+        summary = {
+            'backend': self.backend,
+            'started_at': self._started_at.isoformat(),
+            'elapsed': round(elapsed, 3),
+            'stages': {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            'counts': counts,
+            'rates': {
+                'tracks_seen_per_second': round(seen / elapsed, 1) if elapsed else 0,
+                'rows_inserted_per_second': round(inserted / insert_time, 1) if insert_time else 0
+            }
+        }
+
+        _summaries.append(summary)
+
+        print("[%s] Finished in %.1fs: %d tracks seen, %d inserted, %d updated, %d removed"
+              % (self.backend, elapsed, seen, counts.get('tracks_inserted', 0), counts.get('tracks_updated', 0),
+                 counts.get('tracks_deleted', 0)))
+
+        return summary
+
+
+def get_ingest_summaries() -> List[dict]:
+    """
+    :return: The summary of every ingest finished by this process, in order,
+    up to the latest `MAX_SUMMARIES`.
+    """
+    return list(_summaries)
+
+
+# String and number literals, and lists of bound parameters,
+# which vary between statements of the same shape
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMETER_LISTS = re.compile(r'\(\s*(?:\?|%s|:\w+)(?:\s*,\s*(?:\?|%s|:\w+))+\s*\)')
+
+# The endpoint that requests matching no route are counted under
+UNMATCHED_ENDPOINT = '<unmatched>'
+
+# Query statistics of each endpoint handled by this process
+_routes: Dict[str, 'RouteQueryStats'] = {}
+_routes_lock = threading.Lock()
+_instrumented = False
+
+
+def get_query_shape(statement: str) -> str:
+    """
+    :return: The statement without its literals, so statements
+    which only differ by their parameters have the same shape.
+    """
+    shape = _PARAMETER_LISTS.sub('(?)', _LITERALS.sub('?', statement))
+    return ' '.join(shape.split())
+
+
+class QueryStats:
+    """
+    Counts the statements run while handling one request,
+    the rows they loaded or changed and the time they took.
+    Rows loaded are counted as the objects the ORM builds.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.time = 0.0
+        self.shapes: Dict[str, int] = {}
+
+    def record(self, statement: str, seconds: float, rows: int = 0):
+        self.queries += 1
+        self.rows += rows
+        self.time += seconds
+
+        shape = get_query_shape(statement)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def get_suspects(self, threshold: int) -> Dict[str, int]:
+        """
+        :param threshold: The number of times a shape must run to be a suspect.
+        :return: The number of times each shape which ran at least `threshold`
+        times was run. These are usually a query run once per row of another,
+        such as a relationship loaded lazily in a loop.
+        """
+        return {shape: count for shape, count in self.shapes.items() if count >= threshold}
+
+
+class RouteQueryStats:
+    """
+    The totals of the query statistics of every request to an endpoint,
+    and the most times each N+1 suspect has run in one request.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.rows = 0
+        self.time = 0.0
+        self.suspects: Dict[str, int] = {}
+
+    def add(self, stats: QueryStats, suspects: Dict[str, int]):
+        self.requests += 1
+        self.queries += stats.queries
+        self.max_queries = max(self.max_queries, stats.queries)
+        self.rows += stats.rows
+        self.time += stats.time
+
+        for shape, count in suspects.items():
+            self.suspects[shape] = max(self.suspects.get(shape, 0), count)
+
+    def to_dict(self) -> dict:
+        return {
+            'requests': self.requests,
+            'average_queries': round(self.queries / self.requests, 1),
+            'max_queries': self.max_queries,
+            'average_rows': round(self.rows / self.requests, 1),
+            'average_time_ms': round(self.time / self.requests * 1000, 3),
+            'suspects': [{'statement': shape, 'count': count}
+                         for shape, count in sorted(self.suspects.items(), key=lambda item: -item[1])]
+        }
+
+
+def _get_request_stats():
+    return g.get('query_stats') if has_request_context() else None
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's own context, so that one which fails leaves nothing behind
+    if context is not None:
+        context._query_start = timer()
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_query_start', None)
+    elapsed = timer() - start if start is not None else 0
+
+    stats = _get_request_stats()
+    if stats is not None:
+        # Only writes report the rows they changed
+        stats.record(statement, elapsed, max(cursor.rowcount, 0) if cursor.description is None else 0)
+
+
+def _load(target, context):
+    stats = _get_request_stats()
+    if stats is not None:
+        stats.rows += 1
+
+
+def init_query_stats(app, settings: dict):
+    """
+    Counts the queries, rows and database time of each request, and
+    flags statements run many times in one request as N+1 suspects.
+
+    The totals of each endpoint are kept for `get_query_report`. In debug
+    mode, or if `headers` is set, each response also carries its own
+    counts in `X-Query-*` headers.
+
+    :param settings: The `query_stats` settings.
+    """
+    global _instrumented
+
+    if not settings['enable'] or _instrumented:
+        return
+    _instrumented = True
+
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Mapper, 'load', _load)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def finish_query_stats(response):
+        stats = g.pop('query_stats', None)
+        if stats is None:
+            return response
+
+        suspects = stats.get_suspects(settings['n_plus_one_threshold'])
+
+        # Requests matching no route share one entry, as their paths are unbounded
+        endpoint = request.endpoint or UNMATCHED_ENDPOINT
+        with _routes_lock:
+            _routes.setdefault(endpoint, RouteQueryStats()).add(stats, suspects)
+
+        if app.debug or settings['headers']:
+            response.headers['X-Query-Count'] = str(stats.queries)
+            response.headers['X-Query-Rows'] = str(stats.rows)
+            response.headers['X-Query-Time'] = '%.3f' % (stats.time * 1000)
+            response.headers['X-Query-Suspects'] = str(len(suspects))
+
+        return response
+
+
+def get_query_report() -> Dict[str, dict]:
+    """
+    :return: The query statistics of each endpoint
+    handled by this process, by endpoint.
+    """
+    with _routes_lock:
+        return {endpoint: stats.to_dict() for endpoint, stats in sorted(_routes.items())}
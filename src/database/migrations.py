@@ -0,0 +1,203 @@
+import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import OperationalError
+
+import helper
+from .db import database
+from .aggregates import update_album_aggregates, update_artist_aggregates, update_playlist_aggregates
+from .models import SchemaMigration, Artist, Album, Playlist, ProbeCache, MpdDirectory, playlist_track
+from .search import SEARCH_KINDS, SEARCH_MODELS
+
+db = database()
+
+
+def _create_missing_indexes(connection):
+    """
+    Creates every index defined on the models
+    which does not yet exist in the database.
+    """
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            # Indexes on columns added by a later migration are created by it
+            if index.name not in existing and all(column.name in columns for column in index.columns):
+                print("Creating index %s" % index.name)
+                index.create(connection)
+
+
+def _create_search_index(connection):
+    """
+    Creates the full-text index used by `search_music`.
+
+    On SQLite this is an FTS5 table kept up to date by triggers,
+    so every write path maintains it. On MySQL it is a FULLTEXT
+    index on each name. Other databases fall back to substring search.
+    """
+    dialect = connection.dialect.name
+
+    if dialect == 'mysql':
+        for model in SEARCH_MODELS:
+            table = model.__tablename__
+            if not any(index['name'] == 'ft_%s_name' % table for index in inspect(connection).get_indexes(table)):
+                connection.execute("ALTER TABLE %s ADD FULLTEXT INDEX ft_%s_name (name)" % (table, table))
+        return
+
+    if dialect != 'sqlite':
+        print("Full-text search is not supported for %s, using substring search." % dialect)
+        return
+
+    try:
+        connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                           "name, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+    except OperationalError:
+        print("SQLite was built without FTS5, using substring search.")
+        return
+
+    for kind, model in enumerate(SEARCH_MODELS):
+        table = model.__tablename__
+        row_id = "%%s.id * %d + %d" % (SEARCH_KINDS, kind)
+
+        connection.execute("CREATE TRIGGER IF NOT EXISTS search_index_%s_insert AFTER INSERT ON %s BEGIN "
+                           "INSERT INTO search_index(rowid, name) VALUES (%s, new.name); END"
+                           % (table, table, row_id % 'new'))
+        connection.execute("CREATE TRIGGER IF NOT EXISTS search_index_%s_update AFTER UPDATE OF name ON %s BEGIN "
+                           "DELETE FROM search_index WHERE rowid = %s; "
+                           "INSERT INTO search_index(rowid, name) VALUES (%s, new.name); END"
+                           % (table, table, row_id % 'old', row_id % 'new'))
+        connection.execute("CREATE TRIGGER IF NOT EXISTS search_index_%s_delete AFTER DELETE ON %s BEGIN "
+                           "DELETE FROM search_index WHERE rowid = %s; END"
+                           % (table, table, row_id % 'old'))
+
+        connection.execute("INSERT INTO search_index(rowid, name) SELECT %s, name FROM %s"
+                           % (row_id % table, table))
+
+
+def _add_pagination_indexes(connection):
+    """
+    Creates the indexes which listings are paginated by, and drops
+    the albums' artist index, which the new one also covers.
+    """
+    _create_missing_indexes(connection)
+
+    if any(index['name'] == 'ix_albums_artist_key' for index in inspect(connection).get_indexes('albums')):
+        connection.execute("DROP INDEX ix_albums_artist_key" +
+                           (" ON albums" if connection.dialect.name == 'mysql' else ""))
+
+
+def _add_missing_columns(connection, table, names: List[str]):
+    """
+    Adds any of the table's columns which do not yet exist in the database.
+    """
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+
+    for name in names:
+        if name not in existing:
+            print("Adding column %s.%s" % (table.name, name))
+            connection.execute("ALTER TABLE %s ADD COLUMN %s %s"
+                               % (table.name, name, table.c[name].type.compile(dialect=connection.dialect)))
+
+
+def _add_aggregate_columns(connection):
+    """
+    Adds the aggregate columns of artists, albums
+    and playlists, and computes them for every row.
+    """
+    _add_missing_columns(connection, Artist.__table__, ['track_count'])
+    _add_missing_columns(connection, Album.__table__, ['disc_count', 'total_size', 'total_duration'])
+    _add_missing_columns(connection, Playlist.__table__, ['track_count', 'total_size', 'total_duration'])
+
+    update_album_aggregates(connection=connection)
+    update_artist_aggregates(connection=connection)
+    update_playlist_aggregates(connection=connection)
+
+
+def _add_playlist_positions(connection):
+    """
+    Adds the position of each track in its playlist, numbering existing
+    playlists in the order they were listed in, by track ID. The index
+    on position replaces the playlists' index on track ID.
+    """
+    _add_missing_columns(connection, playlist_track, ['position'])
+
+    rows = connection.execute(db.select([playlist_track.c.playlist_id, playlist_track.c.track_id])
+                              .where(playlist_track.c.position.is_(None))
+                              .order_by(playlist_track.c.playlist_id, playlist_track.c.track_id))
+
+    positions = []
+    previous, position = None, 0
+    for playlist_id, track_id in rows:
+        position = position + 1 if playlist_id == previous else 0
+        previous = playlist_id
+        positions.append({'b_playlist': playlist_id, 'b_track': track_id, 'b_position': position})
+
+    if positions:
+        connection.execute(playlist_track.update()
+                           .where(playlist_track.c.playlist_id == db.bindparam('b_playlist'))
+                           .where(playlist_track.c.track_id == db.bindparam('b_track'))
+                           .values(position=db.bindparam('b_position')), positions)
+
+    _create_missing_indexes(connection)
+
+    if any(index['name'] == 'ix_playlist_track_playlist_id'
+           for index in inspect(connection).get_indexes('playlist_track')):
+        connection.execute("DROP INDEX ix_playlist_track_playlist_id" +
+                           (" ON playlist_track" if connection.dialect.name == 'mysql' else ""))
+
+
+def _widen_path_hashes(connection):
+    """
+    Recomputes the path hashes of cached probes and MPD directories,
+    which are now 63 bits rather than 32. Every hash is cleared first,
+    so that no new hash collides with an old one part way through.
+    """
+    for model in [ProbeCache, MpdDirectory]:
+        table = model.__table__
+        rows = [{'b_id': key, 'b_path_hash': helper.generate_path_hash(path)}
+                for key, path in connection.execute(db.select([table.c.id, table.c.path]))]
+
+        connection.execute(table.update().values(path_hash=None))
+        if rows:
+            connection.execute(table.update().where(table.c.id == db.bindparam('b_id'))
+                               .values(path_hash=db.bindparam('b_path_hash')), rows)
+
+
+# Every migration in order of version. `create_all` builds new tables
+# in their latest form, so each migration must check what already exists.
+# Once released, a migration should never be changed; add a new one instead.
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "Add lookup indexes", _create_missing_indexes),
+    (2, "Add full-text search index", _create_search_index),
+    (3, "Add pagination indexes", _add_pagination_indexes),
+    (4, "Add aggregate columns", _add_aggregate_columns),
+    (5, "Add playlist positions", _add_playlist_positions),
+    (6, "Widen path hashes", _widen_path_hashes),
+]
+
+
+def migrate():
+    """
+    Applies any migrations which have not yet been applied to the database.
+    Each migration is recorded in the same transaction as its changes,
+    although MySQL commits schema changes as soon as they are made.
+    """
+    applied = {version for version, in db.session.query(SchemaMigration.version)}
+    db.session.commit()
+
+    for version, name, apply in MIGRATIONS:
+        if version in applied:
+            continue
+
+        print("Applying migration %d: %s" % (version, name))
+        with db.engine.begin() as connection:
+            apply(connection)
+            connection.execute(SchemaMigration.__table__.insert(),
+                               version=version, name=name, applied_at=datetime.datetime.now())
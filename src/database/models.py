@@ -1,6 +1,3 @@
-import operator
-from functools import reduce
-
 from flask_login import UserMixin
 
 from .db import Permission, database
@@ -12,7 +9,7 @@ class User(db.Model, UserMixin):
     __tablename__ = 'users'
 
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(32), nullable=False)
+    username = db.Column(db.String(32), nullable=False, index=True)
     password = db.Column(db.String(100), nullable=False)
 
     music_can_delete = db.Column(db.Boolean, default=False)
@@ -39,7 +36,7 @@ class User(db.Model, UserMixin):
     is_admin = db.Column(db.Boolean, default=False)
     is_deleted = db.Column(db.Boolean, default=False)
 
-    api_key = db.Column(db.String(64), nullable=True)
+    api_key = db.Column(db.String(64), nullable=True, index=True)
 
     lastfm_username = db.Column(db.String(16), nullable=True)
 
@@ -62,13 +59,20 @@ class User(db.Model, UserMixin):
 
 class Artist(db.Model):
     __tablename__ = 'artists'
+    __table_args__ = (
+        # MySQL can only index the start of a text column
+        db.Index('ix_artists_name', 'name', mysql_length=255),
+        db.Index('ix_artists_name_sort', 'name_sort', mysql_length=255),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
     name = db.Column(db.Text, nullable=False)
     name_sort = db.Column(db.Text)
 
+    # Aggregates kept up to date by `update_artist_aggregates`
     album_count = db.Column(db.SmallInteger)
+    track_count = db.Column(db.Integer, default=0)
 
     plex_id = db.Column(db.BigInteger, unique=True)
     plex_thumb = db.Column(db.BigInteger)
@@ -84,6 +88,12 @@ class Artist(db.Model):
 
 class Album(db.Model):
     __tablename__ = 'albums'
+    __table_args__ = (
+        db.Index('ix_albums_artist_name_name', 'artist_name', 'name', mysql_length=255),
+        db.Index('ix_albums_name_sort', 'name_sort', mysql_length=255),
+        # Also covers lookups by artist alone
+        db.Index('ix_albums_artist_release_date', 'artist_key', 'release_date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -96,7 +106,11 @@ class Album(db.Model):
     release_date = db.Column(db.Date)
     genres = db.Column(db.Text)
 
+    # Aggregates kept up to date by `update_album_aggregates`
     track_count = db.Column(db.SmallInteger)
+    disc_count = db.Column(db.SmallInteger, default=0)
+    total_size = db.Column(db.BigInteger, default=0)
+    total_duration = db.Column(db.BigInteger, default=0)
 
     plex_id = db.Column(db.BigInteger, unique=True)
     plex_thumb = db.Column(db.BigInteger)
@@ -110,25 +124,30 @@ class Album(db.Model):
     def __repr__(self):
         return "<%d - %s>" % (self.id, self.name)
 
-    def total_size(self):
-        pass
-        return reduce(operator.add, [track.size for track in self.tracks])
-
 
 playlist_track = db.Table('playlist_track', db.metadata,
                           db.Column('track_id', db.ForeignKey('tracks.id'), primary_key=True),
-                          db.Column('playlist_id', db.ForeignKey('playlists.id'), primary_key=True))
+                          db.Column('playlist_id', db.ForeignKey('playlists.id'), primary_key=True),
+                          # The order of the track in the playlist, unique within it
+                          db.Column('position', db.Integer),
+                          # The primary key only covers lookups by track
+                          db.Index('ix_playlist_track_playlist_position', 'playlist_id', 'position'))
 
 
 class Track(db.Model):
     __tablename__ = 'tracks'
+    __table_args__ = (
+        # Also covers lookups by album alone
+        db.Index('ix_tracks_album_disc_track', 'album_key', 'disc_num', 'track_num'),
+        db.Index('ix_tracks_name_sort', 'name_sort', mysql_length=255),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
     name = db.Column(db.Text, nullable=False)
     name_sort = db.Column(db.Text)
 
-    artist_key = db.Column(db.Integer, db.ForeignKey('artists.id'))
+    artist_key = db.Column(db.Integer, db.ForeignKey('artists.id'), index=True)
     artist_name = db.Column(db.Text)
 
     album_key = db.Column(db.Integer, db.ForeignKey('albums.id'))
@@ -163,7 +182,106 @@ class Playlist(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text, nullable=False)
 
-    creator_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    creator_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+
+    # Aggregates kept up to date by `update_playlist_aggregates`
+    track_count = db.Column(db.Integer, default=0)
+    total_size = db.Column(db.BigInteger, default=0)
+    total_duration = db.Column(db.BigInteger, default=0)
 
     creator = db.relationship('User', back_populates='playlists')
-    tracks = db .relationship('Track', secondary=playlist_track, back_populates='playlists')
+    tracks = db.relationship('Track', secondary=playlist_track, back_populates='playlists',
+                             order_by=playlist_track.c.position)
+
+
+class IngestCheckpoint(db.Model):
+    """
+    The position of the last chunk committed by a backend's ingest,
+    used to resume an interrupted update.
+    """
+    __tablename__ = 'ingest_checkpoints'
+
+    backend = db.Column(db.String(16), primary_key=True)
+
+    artist = db.Column(db.Text)
+    cursor = db.Column(db.Integer, nullable=False, default=0)
+
+    updated_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<%s - %d>" % (self.backend, self.cursor)
+
+
+class SyncWatermark(db.Model):
+    """
+    The time a backend's library section was last synced,
+    used to only fetch items which have changed since.
+    """
+    __tablename__ = 'sync_watermarks'
+
+    backend = db.Column(db.String(16), primary_key=True)
+    section = db.Column(db.String(64), primary_key=True)
+
+    synced_at = db.Column(db.BigInteger, nullable=False)
+
+    def __repr__(self):
+        return "<%s:%s - %d>" % (self.backend, self.section, self.synced_at)
+
+
+class ProbeCache(db.Model):
+    """
+    The audio properties read from a file, stored along with
+    its size and modification time so unchanged files do
+    not need to be opened again.
+    """
+    __tablename__ = 'probe_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    path = db.Column(db.Text, nullable=False)
+    path_hash = db.Column(db.BigInteger, unique=True)
+
+    size = db.Column(db.BigInteger)
+    mtime_ns = db.Column(db.BigInteger)
+
+    bitrate = db.Column(db.Integer)
+    duration = db.Column(db.BigInteger)
+    format = db.Column(db.String(32))
+    tag_digest = db.Column(db.String(32))
+
+    def __repr__(self):
+        return "<%d - %s>" % (self.id, self.path)
+
+
+class MpdDirectory(db.Model):
+    """
+    The newest modification time MPD reported for a directory
+    and the songs directly inside it, used to only re-read
+    directories which have changed.
+    """
+    __tablename__ = 'mpd_directories'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    path = db.Column(db.Text, nullable=False)
+    path_hash = db.Column(db.BigInteger, unique=True)
+
+    last_modified = db.Column(db.String(32))
+
+    def __repr__(self):
+        return "<%d - %s>" % (self.id, self.path)
+
+
+class SchemaMigration(db.Model):
+    """
+    A migration which has been applied to the database.
+    """
+    __tablename__ = 'schema_migrations'
+
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(128), nullable=False)
+
+    applied_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<%d - %s>" % (self.version, self.name)
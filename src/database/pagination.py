@@ -0,0 +1,121 @@
+import base64
+import datetime
+import json
+from typing import Any, List, Optional, Tuple
+
+from .db import database
+
+db = database()
+
+
+class InvalidCursorError(ValueError):
+    """
+    Raised when a cursor cannot be decoded,
+    or does not match the listing it was given to.
+    """
+    pass
+
+
+class Page:
+    """
+    A page of a listing, and the cursor to pass
+    as `after` to get the next page, if there is one.
+    """
+
+    def __init__(self, items: list, next_cursor: Optional[str], limit: int):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.limit = limit
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """
+    :param values: The sort values of the last item of a page.
+    :return: An opaque, URL-safe cursor.
+    """
+    values = [value.isoformat() if isinstance(value, datetime.date) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, length: int) -> List[Any]:
+    """
+    :param cursor: A cursor made by `encode_cursor`.
+    :param length: The number of values the cursor should hold.
+    :return: The sort values held by the cursor.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise InvalidCursorError("Invalid cursor")
+
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursorError("Invalid cursor")
+
+    return values
+
+
+def _after(order: List[Tuple[Any, bool]], values: List[Any]):
+    """
+    Builds the condition for rows which sort after the given values.
+
+    Relies on SQLite and MySQL sorting nulls before every
+    other value, so they come first in ascending order and last
+    in descending order. Each column but the last may be null.
+    """
+    terms = []
+    for i, (column, descending) in enumerate(order):
+        value = values[i]
+        if value is None:
+            term = None if descending else column.isnot(None)
+        elif descending:
+            term = db.or_(column < value, column.is_(None))
+        else:
+            term = column > value
+
+        if term is not None:
+            equal = [previous.is_(None) if values[j] is None else previous == values[j]
+                     for j, (previous, _) in enumerate(order[:i])]
+            terms.append(db.and_(*equal, term))
+
+    return db.or_(*terms)
+
+
+def paginate(query, order: List[Tuple[Any, bool]], after: Optional[str], limit: int) -> Page:
+    """
+    Gets a page of a query using keyset pagination, which seeks straight
+    to the start of the page rather than counting past earlier ones,
+    so every page takes as long to load as the first.
+
+    :param query: The query to paginate, which must select a model.
+    :param order: Each column to sort by, and whether it is descending.
+    The last column must be unique, so that the order is total.
+    :param after: The cursor of the page, or None for the first page.
+    :param limit: The most items to return.
+    :return: The page of items.
+    """
+    if after:
+        values = decode_cursor(after, len(order))
+        for i, (column, _) in enumerate(order):
+            if values[i] is not None and column.type.python_type is datetime.date:
+                try:
+                    values[i] = datetime.date.fromisoformat(values[i])
+                except (TypeError, ValueError):
+                    raise InvalidCursorError("Invalid cursor")
+
+        query = query.filter(_after(order, values))
+
+    query = query.order_by(*[column.desc() if descending else column for column, descending in order])
+
+    # One more than the limit is fetched to see if there is a next page
+    items = query.limit(limit + 1).all()
+    if len(items) <= limit:
+        return Page(items, None, limit)
+
+    items = items[:limit]
+    return Page(items, encode_cursor([getattr(items[-1], column.key) for column, _ in order]), limit)
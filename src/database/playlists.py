@@ -0,0 +1,212 @@
+from typing import Iterable, List
+
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError
+
+from .db import database
+from .models import Track, Playlist, playlist_track
+
+db = database()
+
+# The most track IDs to bind to a single statement
+CHUNK_SIZE = 500
+
+# The most times to try adding tracks when another request gets in the way
+ADD_ATTEMPTS = 3
+
+# MySQL's lock wait timeout and deadlock errors
+MYSQL_LOCK_ERRORS = {1205, 1213}
+
+# PostgreSQL's serialization failure and deadlock errors
+POSTGRES_LOCK_ERRORS = {'40001', '40P01'}
+
+
+def _unique(keys: Iterable[int]) -> List[int]:
+    """
+    Removes duplicate IDs, keeping the first of each.
+    """
+    return list(dict.fromkeys(int(key) for key in keys))
+
+
+def _chunks(keys: List[int]):
+    for i in range(0, len(keys), CHUNK_SIZE):
+        yield keys[i:i + CHUNK_SIZE]
+
+
+def _is_member(key: int):
+    """
+    :return: A clause which is true for tracks on the playlist.
+    """
+    return db.exists().where(db.and_(playlist_track.c.playlist_id == key, playlist_track.c.track_id == Track.id))
+
+
+def _is_conflict(error: DBAPIError) -> bool:
+    """
+    :return: Whether an error was caused by a concurrent transaction,
+    so that trying again may succeed.
+    """
+    if isinstance(error, IntegrityError):
+        return True
+
+    orig = error.orig
+    return bool(orig.args) and orig.args[0] in MYSQL_LOCK_ERRORS \
+        or getattr(orig, 'pgcode', None) in POSTGRES_LOCK_ERRORS \
+        or 'database is locked' in str(orig)
+
+
+def _adjust_aggregates(key: int, track_keys: List[int], sign: int):
+    """
+    Adds the count, size and duration of the given tracks to
+    a playlist's aggregates, or subtracts them if `sign` is -1,
+    rather than recomputing them from every track on the playlist.
+    """
+    count = size = duration = 0
+    for chunk in _chunks(track_keys):
+        totals = db.session.query(db.func.count(Track.id), db.func.coalesce(db.func.sum(Track.size), 0),
+                                  db.func.coalesce(db.func.sum(Track.duration), 0)) \
+            .filter(Track.id.in_(chunk)).one()
+        count, size, duration = count + totals[0], size + totals[1], duration + totals[2]
+
+    db.session.query(Playlist).filter_by(id=key).update({
+        Playlist.track_count: db.func.coalesce(Playlist.track_count, 0) + sign * count,
+        Playlist.total_size: db.func.coalesce(Playlist.total_size, 0) + sign * size,
+        Playlist.total_duration: db.func.coalesce(Playlist.total_duration, 0) + sign * duration
+    }, synchronize_session=False)
+
+
+def add_tracks_to_playlist(key: int, track_keys: Iterable[int]) -> List[int]:
+    """
+    Adds tracks to the end of a playlist, in the given order.
+    Tracks which do not exist or are already on the playlist are skipped.
+
+    Which tracks to add is found with one query per chunk of IDs,
+    which checks each against the playlist's primary key, so the cost
+    does not depend on how many tracks the playlist already has.
+
+    Each track's position is read from the playlist by the statement
+    inserting it, so concurrent adds never share a position. If another
+    request adds one of the same tracks in between, or the database
+    gives up waiting for another request's locks, the whole add
+    is rolled back and tried again.
+
+    :param key: The ID of the playlist.
+    :param track_keys: The IDs of the tracks.
+    :return: The IDs of the tracks which were added.
+    """
+    track_keys = _unique(track_keys)
+
+    for attempt in range(ADD_ATTEMPTS):
+        try:
+            added = _add_tracks(key, track_keys)
+            db.session.commit()
+            return added
+        except (IntegrityError, OperationalError) as error:
+            db.session.rollback()
+            if attempt == ADD_ATTEMPTS - 1 or not _is_conflict(error):
+                raise
+
+
+def _add_tracks(key: int, track_keys: List[int]) -> List[int]:
+    """
+    Adds tracks to the end of a playlist without committing.
+    See `add_tracks_to_playlist`.
+    """
+    new = set()
+    for chunk in _chunks(track_keys):
+        new.update(_get_new_tracks(key, chunk))
+    added = [track_key for track_key in track_keys if track_key in new]
+
+    if added:
+        end = db.select([db.bindparam('b_playlist'), db.bindparam('b_track'),
+                         db.func.coalesce(db.func.max(playlist_track.c.position), -1) + 1]) \
+            .where(playlist_track.c.playlist_id == db.bindparam('b_playlist'))
+        db.session.execute(playlist_track.insert().from_select(['playlist_id', 'track_id', 'position'], end),
+                           [{'b_playlist': key, 'b_track': track_key} for track_key in added])
+        _adjust_aggregates(key, added, 1)
+
+    return added
+
+
+def _get_new_tracks(key: int, track_keys: List[int]) -> List[int]:
+    """
+    :return: The IDs of the given tracks which exist and are not on the playlist.
+    """
+    return [track_key for track_key, in db.session.query(Track.id)
+            .filter(Track.id.in_(track_keys)).filter(~_is_member(key))]
+
+
+def add_album_to_playlist(key: int, album_key: int) -> List[int]:
+    """
+    Adds an album's tracks to the end of a playlist, in album order.
+
+    :param key: The ID of the playlist.
+    :param album_key: The ID of the album.
+    :return: The IDs of the tracks which were added.
+    """
+    track_keys = [track_key for track_key, in db.session.query(Track.id).filter(Track.album_key == album_key)
+                  .order_by(Track.disc_num, Track.track_num)]
+    return add_tracks_to_playlist(key, track_keys)
+
+
+def remove_tracks_from_playlist(key: int, track_keys: Iterable[int]) -> List[int]:
+    """
+    Removes tracks from a playlist. The remaining tracks keep their order.
+
+    :param key: The ID of the playlist.
+    :param track_keys: The IDs of the tracks.
+    :return: The IDs of the tracks which were removed.
+    """
+    track_keys = _unique(track_keys)
+
+    removed = []
+    for chunk in _chunks(track_keys):
+        removed += [track_key for track_key, in db.session.query(Track.id)
+                    .filter(Track.id.in_(chunk)).filter(_is_member(key))]
+
+    if removed:
+        # Subtracted before the tracks are no longer on the playlist
+        _adjust_aggregates(key, removed, -1)
+
+        for chunk in _chunks(removed):
+            db.session.execute(playlist_track.delete()
+                               .where(playlist_track.c.playlist_id == key)
+                               .where(playlist_track.c.track_id.in_(chunk)))
+
+    db.session.commit()
+    return removed
+
+
+def move_tracks_in_playlist(key: int, track_keys: Iterable[int], position: int = 0) -> List[int]:
+    """
+    Moves tracks on a playlist so that they are together in the given order,
+    starting at `position` among the rest of the playlist. Passing every track
+    on the playlist reorders all of it. Only tracks whose position changes
+    are written.
+
+    :param key: The ID of the playlist.
+    :param track_keys: The IDs of the tracks to move.
+    Those not on the playlist are skipped.
+    :param position: The index to move them to, counted
+    without the moved tracks. Out of range indexes are clamped.
+    :return: The IDs of every track on the playlist, in their new order.
+    """
+    current = {track_key: track_position for track_key, track_position in
+               db.session.query(playlist_track.c.track_id, playlist_track.c.position)
+               .filter(playlist_track.c.playlist_id == key)
+               .order_by(playlist_track.c.position, playlist_track.c.track_id)}
+
+    moved = [track_key for track_key in _unique(track_keys) if track_key in current]
+    moving = set(moved)
+    rest = [track_key for track_key in current if track_key not in moving]
+    position = max(0, min(position, len(rest)))
+    order = rest[:position] + moved + rest[position:]
+
+    changes = [{'b_playlist': key, 'b_track': track_key, 'b_position': i}
+               for i, track_key in enumerate(order) if current[track_key] != i]
+    if changes:
+        db.session.execute(playlist_track.update()
+                           .where(playlist_track.c.playlist_id == db.bindparam('b_playlist'))
+                           .where(playlist_track.c.track_id == db.bindparam('b_track'))
+                           .values(position=db.bindparam('b_position')), changes)
+
+    db.session.commit()
+    return order
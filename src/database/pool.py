@@ -0,0 +1,175 @@
+import os
+import re
+import weakref
+from timeit import default_timer as timer
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+from .db import database
+
+db = database()
+
+
+class PoolStats:
+    """
+    Counts how often this process checked out a database
+    connection, and how long it waited for one.
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, seconds: float):
+        self.checkouts += 1
+        self.total_wait += seconds
+        self.max_wait = max(self.max_wait, seconds)
+
+
+_stats = PoolStats()
+
+# Engines already made safe to use after a fork, or given SQLite pragmas
+_fork_safe = weakref.WeakSet()
+_has_pragmas = weakref.WeakSet()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    A queue pool which records the time taken to check out each
+    connection, including any wait for a free connection or to open one.
+    """
+
+    def connect(self):
+        return self._timed_checkout(super().connect)
+
+    def unique_connection(self):
+        return self._timed_checkout(super().unique_connection)
+
+    @staticmethod
+    def _timed_checkout(checkout):
+        start = timer()
+        try:
+            return checkout()
+        except exc.TimeoutError:
+            _stats.timeouts += 1
+            raise
+        finally:
+            _stats.record(timer() - start)
+
+
+def get_engine_options(uri: str, settings: dict) -> dict:
+    """
+    Gets the options to create the database engine with.
+
+    Each process keeps a pool of `size` connections, plus up to
+    `max_overflow` more under load. A checkout waits up to `timeout`
+    seconds for a connection before failing, rather than opening
+    an unbounded number of them.
+
+    :param uri: The database URI.
+    :param settings: The `database_pool` settings.
+    :return: The keyword arguments for `create_engine`.
+    """
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': settings['size'],
+        'max_overflow': settings['max_overflow'],
+        'pool_timeout': settings['timeout']
+    }
+
+    if uri.startswith('sqlite'):
+        # Pooled connections keep their page cache between requests. Each
+        # is only used by one thread at a time, but not always the same one.
+        options['connect_args'] = {'check_same_thread': False}
+    else:
+        options.update(pool_recycle=settings['recycle'], pool_pre_ping=settings['pre_ping'])
+
+    return options
+
+
+def set_sqlite_pragmas(engine, pragmas: dict):
+    """
+    Sets pragmas on every new SQLite connection.
+
+    The defaults use a write-ahead log, so that readers never block
+    the writer or each other, and wait for a lock rather than failing
+    with "database is locked" while another process is writing.
+
+    :param pragmas: The `sqlite` settings, as pragma names and values.
+    """
+    for name, value in pragmas.items():
+        if not re.fullmatch(r'\w+', name) or not re.fullmatch(r'-?\w+', str(value)):
+            raise ValueError("Invalid SQLite pragma %s = %s" % (name, value))
+
+    if engine in _has_pragmas:
+        return
+    _has_pragmas.add(engine)
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+
+def make_fork_safe(engine):
+    """
+    Stops processes forked from this one, such as uwsgi workers,
+    from using connections opened by their parent, which would
+    interleave their traffic on the same socket.
+
+    Each child starts with a new, empty pool. Any connection which
+    is still checked out from another process is discarded on
+    checkout without being closed, as closing it would also end
+    it for the process which opened it.
+    """
+    if engine in _fork_safe:
+        return
+    _fork_safe.add(engine)
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if connection_record.info['pid'] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError("Connection belongs to process %d, not %d"
+                                         % (connection_record.info['pid'], os.getpid()))
+
+    def after_fork():
+        global _stats
+
+        # Recreating rather than disposing the pool leaves
+        # the parent's connections open for the parent
+        engine.pool = engine.pool.recreate()
+        _stats = PoolStats()
+
+    os.register_at_fork(after_in_child=after_fork)
+
+
+def get_pool_stats() -> dict:
+    """
+    :return: The state of this process's connection
+    pool and how long checkouts have waited.
+    """
+    pool = db.engine.pool
+    stats = {
+        'pid': os.getpid(),
+        'pool': type(pool).__name__,
+        'checkouts': _stats.checkouts,
+        'timeouts': _stats.timeouts,
+        'average_wait_ms': round(_stats.total_wait / _stats.checkouts * 1000, 3) if _stats.checkouts else 0,
+        'max_wait_ms': round(_stats.max_wait * 1000, 3)
+    }
+
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                     overflow=max(pool.overflow(), 0))
+
+    return stats
@@ -1,26 +1,51 @@
-import os
-from os import path
-from timeit import default_timer as timer
-from typing import List
+import datetime
+import time
+from os import path, scandir, cpu_count
+from collections import Counter
+from typing import List, Dict, Iterator, Tuple, Iterable, Optional
 
-import mutagen
 from plexapi.audio import Artist as PlexArtist, Album as PlexAlbum, Track as PlexTrack
 from plexapi.media import MediaPart, Media
 
 import helper
 import mpd_helper
+import probe
 from PersistentMPDClient import PersistentMPDClient
 from .db import database
-from .models import Album, Artist, Track
-from .queries import get_artist_by_plex_key, get_album_by_plex_key, get_track_by_plex_key, get_artist_by_hash, \
-    get_album_by_hash, get_track_by_hash
+from .ingest import Ingest
+from .models import Track, MpdDirectory
+from .queries import get_sync_watermark, set_sync_watermark, get_track_keys_by_plex_id, get_probe_cache, \
+    get_track_keys_by_plex_parent, get_mpd_directories, get_track_hashes_by_path, get_album_keys_by_plex_id, \
+    get_artist_keys_by_plex_id
 
 db = database()
 
+PLEX_ARTIST = 8
+PLEX_ALBUM = 9
+PLEX_TRACK = 10
+
+# The most MPD directories swept per statement, as each adds
+# to the size of the expression, which SQLite limits
+MPD_SWEEP_DIRECTORIES = 50
+
 
 def get_formatted_date(date):
+    """
+    Converts a year or a partial date string to a date,
+    as SQLite does not accept strings for date columns.
+    Tags holding a timestamp, such as 2019-05-03T00:00:00,
+    are cut down to their date.
+    """
     if isinstance(date, int):
-        return '%s-01-01' % date
+        return datetime.date(date, 1, 1)
+
+    if isinstance(date, str):
+        parts = (date.strip()[:10].split('-') + ['1', '1'])[:3]
+        try:
+            return datetime.date(*[int(part) for part in parts])
+        except ValueError:
+            return None
+
     return date
 
 
@@ -28,76 +53,351 @@ def base_key(key: str) -> int:
     return int(path.basename(key))
 
 
-def populate_db_from_plex():
+def _create_ingest(backend: str, preload: bool = True, watching: bool = False) -> Ingest:
+    """
+    :param backend: The name of the backend.
+    :param preload: Whether to load every hash up front. See `Ingest`.
+    :param watching: Whether the ingest applies a live update, in which
+    case the catalog snapshot is written after a delay.
+    :return: An ingest for the backend, using the ingest settings.
+    """
     import pmv
 
-    start_time = timer()
-
-    artists: List[PlexArtist] = pmv.music.all()
-    for artist in artists:
-        print(artist.title)
-
-        artist_hash = helper.generate_artist_hash(artist.title)
-        albums: List[PlexAlbum] = artist.albums()
-
-        artist_query = get_artist_by_hash(artist_hash)
-        if not artist_query:
-            db.session.add(Artist(name=artist.title,
-                                  name_sort=artist.titleSort,
-                                  album_count=len(albums),
-                                  plex_id=base_key(artist.key),
-                                  plex_thumb=base_key(artist.thumb) if artist.thumb else None,
-                                  hash=artist_hash))
-            artist_query = get_artist_by_hash(artist_hash)
-        for album in albums:
-            print('┣ ' + album.title)
-
-            tracks: List[PlexTrack] = album.tracks()
-            album_hash = helper.generate_album_hash(album.title, artist.title)
-
-            album_query = get_album_by_hash(album_hash)
-            if not album_query:
-                db.session.add(Album(name=album.title,
-                                     name_sort=album.titleSort,
-                                     artist_key=artist_query.id,
-                                     artist_name=artist.title,
-                                     release_date=get_formatted_date(album.year),
-                                     genres=','.join([genre.tag for genre in album.genres]),
-                                     track_count=len(tracks),
-                                     plex_id=base_key(album.key),
-                                     plex_thumb=base_key(album.thumb),
-                                     hash=album_hash))
-                album_query = get_album_by_hash(album_hash)
-
-            for track in tracks:
-                print("┃ \t┣ " + track.title)
-
-                track_part: MediaPart = [*track.iterParts()][0]
-                relative_path = track_part.file.replace(pmv.settings['music_library'], '')
-                track_hash = helper.generate_track_hash(track.title, album.title, artist.title, relative_path)
-
-                track_query = get_track_by_hash(track_hash)
-                if not track_query:
-                    media: Media = track.media[0]
-                    db.session.add(Track(name=track.title,
-                                         name_sort=track.titleSort,
-                                         artist_key=artist_query.id,
-                                         artist_name=artist.title,
-                                         album_key=album_query.id,
-                                         album_name=album.title,
-                                         duration=track.duration,
-                                         track_num=track.index,
-                                         disc_num=track.parentIndex,
-                                         download_url=relative_path,
-                                         bitrate=media.bitrate,
-                                         size=track_part.size,
-                                         format=media.audioCodec,
-                                         plex_id=base_key(track.key),
-                                         hash=track_hash))
-
-    print("\nFinished constructing db.session in %r seconds" % round(timer() - start_time))
-    print("Committing db.session.\n")
-    db.session.commit()
+    settings = pmv.settings['ingest']
+    snapshot = pmv.settings['catalog_snapshot']
+    return Ingest(backend, settings['batch_size'], settings['progress_interval'],
+                  snapshot['path'] if snapshot['enable'] else None, preload,
+                  snapshot['watch_delay'] if watching else 0)
+
+
+def _get_plex_artist_fields(artist: PlexArtist, album_count: int) -> dict:
+    return dict(name=artist.title,
+                name_sort=artist.titleSort,
+                album_count=album_count,
+                plex_id=base_key(artist.key),
+                plex_thumb=base_key(artist.thumb) if artist.thumb else None)
+
+
+def _get_plex_album_fields(album: PlexAlbum, artist_name: str, track_count: int) -> dict:
+    return dict(name=album.title,
+                name_sort=album.titleSort,
+                artist_name=artist_name,
+                release_date=get_formatted_date(album.year),
+                genres=','.join([genre.tag for genre in album.genres]),
+                track_count=track_count,
+                plex_id=base_key(album.key),
+                plex_thumb=base_key(album.thumb) if album.thumb else None)
+
+
+def _get_plex_track_fields(track: PlexTrack, track_part: MediaPart, artist_name: str, album_name: str,
+                           relative_path: str) -> dict:
+    media: Media = track.media[0]
+    return dict(name=track.title,
+                name_sort=track.titleSort,
+                artist_name=artist_name,
+                album_name=album_name,
+                duration=track.duration,
+                track_num=track.index,
+                disc_num=track.parentIndex,
+                download_url=relative_path,
+                bitrate=media.bitrate,
+                size=track_part.size,
+                format=media.audioCodec,
+                plex_id=base_key(track.key))
+
+
+def _fetch_plex_section(libtype: int, params: str = '', start: int = 0) -> Iterator[Tuple[int, list]]:
+    """
+    Fetches every item of a type from the music section,
+    one container of `container_size` items at a time.
+
+    Items are sorted by when they were added, so that new
+    items do not shift the position of existing ones.
+
+    :param libtype: The Plex type number of the items.
+    :param params: Any extra query string parameters, such as filters.
+    :param start: The offset of the first item to fetch.
+    :return: An iterator of each container's end offset and its items.
+    """
+    import pmv
+
+    size = pmv.settings['backends']['plex']['container_size']
+    ekey = '/library/sections/%s/all?type=%d&sort=addedAt%s' % (pmv.music.key, libtype, params)
+
+    while True:
+        items = _disable_reload(pmv.plex.fetchItems(ekey, container_start=start, container_size=size,
+                                                    maxresults=size))
+        start += len(items)
+        yield start, items
+
+        if len(items) < size:
+            break
+
+
+def _fetch_plex_items(keys: Iterable[int]) -> list:
+    """
+    Fetches the items with the given keys,
+    requesting up to `container_size` items at a time.
+    """
+    import pmv
+
+    size = pmv.settings['backends']['plex']['container_size']
+    keys = [*keys]
+
+    items = []
+    for i in range(0, len(keys), size):
+        items += _disable_reload(pmv.plex.fetchItems('/library/metadata/%s'
+                                                     % ','.join(str(key) for key in keys[i:i + size])))
+
+    return items
+
+
+def _disable_reload(items: list) -> list:
+    """
+    Listed items are only partial objects, and plexapi reloads
+    them whenever an empty attribute is read. An empty attribute
+    in a listing just means the value is not set, so turn this
+    off to stop every item costing another request.
+    """
+    for item in items:
+        item._autoReload = False
+
+    return items
+
+
+def _reload_plex_item(item):
+    item.reload()
+    return item
+
+
+def _get_keys_by_plex_id(get_keys, plex_keys: Iterable[int], batch_size: int) -> Dict[int, int]:
+    """
+    Calls one of the `get_*_keys_by_plex_id` queries
+    with at most `batch_size` keys at a time.
+    """
+    plex_keys = [*set(plex_keys)]
+
+    keys = {}
+    for i in range(0, len(plex_keys), batch_size):
+        keys.update(get_keys(plex_keys[i:i + batch_size]))
+
+    return keys
+
+
+def _add_plex_tracks(ingest: Ingest, tracks: List[PlexTrack], artists: Dict[int, PlexArtist],
+                     albums: Dict[int, PlexAlbum], album_counts: Dict[int, int], refresh: bool = False):
+    """
+    Joins a container of tracks to their albums and artists
+    and passes them to the ingest.
+
+    Albums and artists not already known are fetched in bulk.
+    Tracks which were listed without their media are reloaded
+    using a bounded pool of concurrent requests.
+
+    :param ingest: The ingest to add rows to.
+    :param tracks: The tracks to add.
+    :param artists: A dictionary of known artists by rating key.
+    :param albums: A dictionary of known albums by rating key.
+    :param album_counts: A dictionary of album counts by artist rating key.
+    :param refresh: Whether to update every track already in the database.
+    Otherwise only tracks whose hash changed, such as retitled ones, are updated.
+    """
+    import pmv
+
+    with ingest.stats.stage('fetch'):
+        missing_albums = {track.parentRatingKey for track in tracks} - albums.keys()
+        albums.update({album.ratingKey: album for album in _fetch_plex_items(missing_albums)})
+
+        missing_artists = {track.grandparentRatingKey for track in tracks} - artists.keys()
+        artists.update({artist.ratingKey: artist for artist in _fetch_plex_items(missing_artists)})
+
+        incomplete = [track for track in tracks if not track.media]
+        workers = pmv.settings['backends']['plex']['fetch_workers']
+        for _ in helper.map_concurrently(_reload_plex_item, incomplete, workers):
+            pass
+
+    with ingest.stats.stage('diff'):
+        rows = []
+        for track in tracks:
+            album = albums[track.parentRatingKey]
+            artist = artists[track.grandparentRatingKey]
+
+            track_part: MediaPart = [*track.iterParts()][0]
+            relative_path = track_part.file.replace(pmv.settings['music_library'], '')
+
+            rows.append((track, track_part, album, artist, relative_path,
+                         helper.generate_artist_hash(artist.title),
+                         helper.generate_album_hash(album.title, artist.title),
+                         helper.generate_track_hash(track.title, album.title, artist.title, relative_path)))
+
+    ingest.load_hashes([row[5] for row in rows], [row[6] for row in rows], [row[7] for row in rows])
+
+    with ingest.stats.stage('diff'):
+        # Items keep their Plex ID when their hash changes, such as when
+        # they are renamed, so match by that first to update them in place
+        existing = _get_keys_by_plex_id(get_track_keys_by_plex_id, (base_key(row[0].key) for row in rows),
+                                        ingest.batch_size)
+        existing_albums = _get_keys_by_plex_id(get_album_keys_by_plex_id, (base_key(row[2].key) for row in rows),
+                                               ingest.batch_size)
+        existing_artists = _get_keys_by_plex_id(get_artist_keys_by_plex_id, (base_key(row[3].key) for row in rows),
+                                                ingest.batch_size)
+
+        for track, track_part, album, artist, relative_path, artist_hash, album_hash, track_hash in rows:
+            if not ingest.has_artist(artist_hash):
+                album_count = album_counts.get(artist.ratingKey) or len(artist.albums())
+                artist_fields = _get_plex_artist_fields(artist, album_count)
+                if artist_fields['plex_id'] in existing_artists:
+                    ingest.update_artist(existing_artists[artist_fields['plex_id']], artist_hash, **artist_fields)
+                else:
+                    ingest.add_artist(artist_hash, **artist_fields)
+
+            if not ingest.has_album(album_hash):
+                album_fields = _get_plex_album_fields(album, artist.title, album.leafCount)
+                if album_fields['plex_id'] in existing_albums:
+                    ingest.update_album(existing_albums[album_fields['plex_id']], album_hash, artist_hash,
+                                        **album_fields)
+                else:
+                    ingest.add_album(album_hash, artist_hash, **album_fields)
+
+            fields = _get_plex_track_fields(track, track_part, artist.title, album.title, relative_path)
+
+            plex_id = base_key(track.key)
+            known = ingest.mark_track(track_hash)
+            if plex_id in existing and (refresh or not known):
+                ingest.update_track(existing[plex_id], track_hash, album_hash, artist_hash, **fields)
+            elif not known:
+                ingest.add_track(track_hash, album_hash, artist_hash, **fields)
+
+
+def populate_db_from_plex(resume: bool = False):
+    """
+    Adds any new artists, albums and tracks from the Plex server.
+
+    The whole music section is fetched in large containers,
+    one per item type, and joined together in memory.
+
+    :param resume: If true, continues from the checkpoint
+    left by an interrupted update.
+    """
+    import pmv
+
+    sync_time = int(time.time())
+
+    # Hashes are loaded a container at a time by `_add_plex_tracks`
+    ingest = _create_ingest('plex', preload=False)
+    start = ingest.get_resume_cursor() if resume else 0
+
+    with ingest.stats.stage('fetch'):
+        artists: Dict[int, PlexArtist] = {artist.ratingKey: artist
+                                          for _, page in _fetch_plex_section(PLEX_ARTIST) for artist in page}
+        albums: Dict[int, PlexAlbum] = {album.ratingKey: album
+                                        for _, page in _fetch_plex_section(PLEX_ALBUM) for album in page}
+        album_counts = Counter(album.parentRatingKey for album in albums.values())
+
+    print("Fetched %d artists and %d albums" % (len(artists), len(albums)))
+
+    for cursor, tracks in ingest.stats.timed(_fetch_plex_section(PLEX_TRACK, start=start), 'fetch'):
+        _add_plex_tracks(ingest, tracks, artists, albums, album_counts)
+
+        if tracks:
+            ingest.end_artist(tracks[-1].grandparentTitle, cursor)
+
+    ingest.commit()
+
+    # A resumed update did not mark the tracks before its checkpoint
+    if not resume:
+        ingest.sweep(Track.plex_id.isnot(None))
+
+    ingest.finish()
+
+    # A resumed update did not see changes made before it started,
+    # so only a complete pass can move the watermark forward.
+    if not resume:
+        set_sync_watermark('plex', str(pmv.music.key), sync_time)
+
+
+def populate_db_from_plex_delta():
+    """
+    Upserts only the tracks added or updated on the Plex server
+    since the music section was last synced.
+
+    Falls back to a full update if the section
+    has never been synced before.
+    """
+    import pmv
+
+    section_key = str(pmv.music.key)
+    watermark = get_sync_watermark('plex', section_key)
+    if not watermark:
+        print("No sync watermark for section %s. Running full update." % section_key)
+        populate_db_from_plex()
+        return
+
+    sync_time = int(time.time())
+
+    ingest = _create_ingest('plex_delta', preload=False)
+
+    changed: Dict[int, PlexTrack] = {}
+    with ingest.stats.stage('fetch'):
+        for field in ['addedAt', 'updatedAt']:
+            for _, tracks in _fetch_plex_section(PLEX_TRACK, '&%s>>=%d' % (field, watermark.synced_at)):
+                changed.update({base_key(track.key): track for track in tracks})
+
+    print("%d tracks changed since last sync" % len(changed))
+
+    _add_plex_tracks(ingest, [*changed.values()], {}, {}, {}, refresh=True)
+
+    ingest.commit()
+    set_sync_watermark('plex', section_key, sync_time)
+
+    ingest.finish()
+
+
+def _fetch_plex_leaves(item) -> list:
+    return _disable_reload(item.fetchItems('%s/allLeaves' % item.key))
+
+
+def sync_plex_items(updated_keys: Iterable[int], deleted_keys: Iterable[int]):
+    """
+    Upserts and deletes individual items from the Plex server,
+    such as those reported by its alert listener.
+
+    :param updated_keys: The rating keys of artists, albums or tracks
+    which were added or changed. Artists and albums have all their tracks synced.
+    :param deleted_keys: The rating keys of artists, albums or tracks
+    which were deleted.
+    """
+    import pmv
+
+    updated_keys = set(updated_keys)
+    deleted_keys = set(deleted_keys) - updated_keys
+
+    # Only the hashes of the synced items are loaded, as a batch is usually small
+    ingest = _create_ingest('plex_alerts', preload=False, watching=True)
+
+    with ingest.stats.stage('fetch'):
+        items = _fetch_plex_items(updated_keys)
+
+        # Items which can no longer be fetched have been deleted since the alert
+        deleted_keys |= updated_keys - {item.ratingKey for item in items}
+
+        tracks: List[PlexTrack] = [item for item in items if item.TYPE == 'track']
+        parents = [item for item in items if item.TYPE != 'track']
+        workers = pmv.settings['backends']['plex']['fetch_workers']
+        for leaves in helper.map_concurrently(_fetch_plex_leaves, parents, workers):
+            tracks += leaves
+
+    if tracks:
+        _add_plex_tracks(ingest, tracks, {}, {}, {}, refresh=True)
+
+    ingest.commit()
+
+    if deleted_keys:
+        with ingest.stats.stage('diff'):
+            deleted_tracks = get_track_keys_by_plex_parent(deleted_keys)
+        ingest.delete_tracks(deleted_tracks)
+
+    ingest.finish()
 
 
 def _get_mpd_key(data, key):
@@ -113,119 +413,568 @@ def _get_mpd_key(data, key):
     return prop
 
 
-def populate_db_from_mpd():
+def _walk_mpd_directory(client: PersistentMPDClient, directory: str, last_modified: str = '',
+                        listed: Dict[str, str] = None, descend=None) -> Iterator[Tuple[str, str, List[dict]]]:
+    """
+    Walks a directory of the MPD database and all of its
+    subdirectories, listing one directory at a time.
+
+    :param last_modified: The modification time MPD reported for the directory.
+    :param listed: A dictionary to fill with the path and modification
+    time of every subdirectory listed, including those not walked.
+    :param descend: A function of a subdirectory's path and modification time
+    which returns whether to walk it, or None to walk every subdirectory.
+    :return: An iterator of each directory's path, signature from `_get_mpd_signature`
+    and the songs directly inside it.
+    """
+    stack = [(directory, last_modified)]
+    while stack:
+        directory, last_modified = stack.pop()
+
+        songs = []
+        subdirectories = []
+        for entry in client.lsinfo(directory):
+            if 'directory' in entry:
+                subdirectories.append((entry['directory'], entry.get('last-modified', '')))
+            elif 'file' in entry:
+                songs.append(entry)
+
+        if listed is not None:
+            listed.update(subdirectories)
+        if descend:
+            subdirectories = [subdirectory for subdirectory in subdirectories if descend(*subdirectory)]
+
+        # Reversed so that directories are popped in the order MPD lists them
+        stack += reversed(subdirectories)
+        yield directory, _get_mpd_signature(last_modified, songs), songs
+
+
+def _get_mpd_signature(last_modified: str, songs: List[dict]) -> str:
+    """
+    Gets a value which changes whenever a song directly inside a
+    directory is added, removed or modified. Adding or removing a file
+    changes the directory's own modification time, and editing one
+    changes the song's, so the newest of these is enough.
+
+    :param last_modified: The modification time MPD reported for the directory.
+    :param songs: The songs directly inside the directory.
+    :return: The newest modification time, as an ISO 8601 string.
+    """
+    return max([last_modified, *(song.get('last-modified', '') for song in songs)])
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _get_mpd_directory_criterion(directory: str, recursive: bool):
+    """
+    :param directory: The path of the directory, relative to the library.
+    :param recursive: If true, also match tracks in subdirectories.
+    :return: A filter matching the MPD tracks inside a directory.
+    """
+    prefix = _escape_like(directory) + '/' if directory else ''
+
+    criterion = Track.download_url.like(prefix + '%', escape='\\')
+    if not recursive:
+        criterion &= ~Track.download_url.like(prefix + '%/%', escape='\\')
+
+    return criterion
+
+
+def _save_mpd_directories(directories: Dict[str, str], known: Dict[int, Tuple[int, str, str]],
+                          removed: Iterable[str], batch_size: int):
+    """
+    Stores the signature of each directory walked.
+
+    :param directories: A dictionary of each walked directory's path to its signature.
+    :param known: The stored directories, as returned by `get_mpd_directories`.
+    :param removed: The paths of stored directories to forget.
+    :param batch_size: The number of directories to forget per statement.
+    """
+    new_rows = []
+    updated_rows = []
+    for directory, last_modified in directories.items():
+        path_hash = helper.generate_path_hash(directory)
+        if path_hash not in known:
+            new_rows.append({'path': directory, 'path_hash': path_hash, 'last_modified': last_modified})
+        elif known[path_hash][2] != last_modified:
+            updated_rows.append({'id': known[path_hash][0], 'last_modified': last_modified})
+
+    db.session.bulk_insert_mappings(MpdDirectory, new_rows)
+    db.session.bulk_update_mappings(MpdDirectory, updated_rows)
+
+    missing = [known[helper.generate_path_hash(directory)][0] for directory in removed]
+    for i in range(0, len(missing), batch_size):
+        db.session.query(MpdDirectory).filter(MpdDirectory.id.in_(missing[i:i + batch_size])) \
+            .delete(synchronize_session=False)
+
+    db.session.commit()
+
+
+def _walk_changed_mpd_directories(client: PersistentMPDClient, stored: Dict[str, str], since: Optional[int],
+                                  listed: Dict[str, str]) -> Iterator[Tuple[str, str, List[dict]]]:
+    """
+    Walks the directories of the MPD database which may have changed since
+    it was last synced, and yields those whose signature has changed.
+
+    Adding or removing a file or subdirectory changes a directory's own
+    modification time, which its parent lists, so a stored directory
+    without stored subdirectories is only listed if that time is newer
+    than its signature. Directories with stored subdirectories are always
+    listed, as a change further down does not reach them. Files modified
+    in place do not change their directory's time, so their directories
+    are found by asking MPD for songs modified since the last sync.
+
+    :param stored: A dictionary of each stored directory's path to its signature.
+    :param since: The time MPD's database was last synced, as a UNIX timestamp,
+    or None to list every directory.
+    :param listed: A dictionary which is filled with the path and
+    modification time of every directory MPD listed, so that stored
+    directories missing from it can be removed.
+    :return: An iterator of each changed directory's path, signature
+    from `_get_mpd_signature` and the songs directly inside it.
+    """
+    modified = set()
+    if since is not None:
+        modified = {song['file'].rpartition('/')[0] for song in client.find('modified-since', str(since))
+                    if 'file' in song}
+    parents = {directory.rpartition('/')[0] for directory in stored if directory}
+
+    def is_changed(directory: str, last_modified: str) -> bool:
+        return since is None or directory in parents or directory in modified or directory not in stored or \
+            last_modified > stored[directory]
+
+    listed[''] = ''
+    for directory, signature, songs in _walk_mpd_directory(client, '', listed=listed, descend=is_changed):
+        if stored.get(directory) != signature:
+            yield directory, signature, songs
+
+
+def _group_mpd_songs(songs: List[dict]) -> Dict[Tuple[str, str], dict]:
+    """
+    Groups a list of songs by artist and album.
+
+    :return: A dictionary of (artist, album) to the album's
+    date, genres and songs.
+    """
+    unknown_album = "[Unknown Album]"
+
+    albums = {}
+    for song in songs:
+        # Skip songs which cannot be placed in an artist
+        if 'artist' not in song:
+            continue
+
+        artist = _get_mpd_key(song, 'artist')
+
+        # Handle songs with missing album tag
+        if 'album' in song:
+            album = _get_mpd_key(song, 'album')
+        else:
+            album = unknown_album
+
+        if (artist, album) not in albums:
+            # Date error checking
+            if 'date' in song:
+                date = _get_mpd_key(song, 'date').replace('.', '-')
+                if '-' not in date:
+                    date = '%s-01-01' % date
+            else:
+                date = None  # Don't write anything for missing dates
+
+            albums[artist, album] = {
+                'date': date,
+                'genres': set(),
+                'songs': []
+            }
+
+        albums[artist, album]['genres'].add(mpd_helper.get_genres_as_text(song))
+
+        if 'track' not in song:
+            song['track'] = 1
+        if 'disc' not in song:
+            song['disc'] = 1
+
+        albums[artist, album]['songs'].append({key: _get_mpd_key(song, key) for key in song})
+
+    return albums
+
+
+def _queue_mpd_songs(ingest: Ingest, songs: List[dict]) -> Iterator[Tuple[str, tuple]]:
+    """
+    Queues the artists and albums for a list of songs,
+    and yields the path of each new track with the fields
+    to insert once it has been probed.
+    """
+    for (artist, album), album_data in _group_mpd_songs(songs).items():
+        artist_hash = helper.generate_artist_hash(artist)
+        ingest.add_artist(artist_hash,
+                          name=artist,
+                          name_sort=helper.get_sort_name(artist))
+
+        album_hash = helper.generate_album_hash(album, artist)
+        genre_list = filter(lambda x: len(x) > 0, album_data['genres'])
+        ingest.add_album(album_hash, artist_hash,
+                         name=album,
+                         name_sort=helper.get_sort_name(album),
+                         artist_name=artist,
+                         release_date=get_formatted_date(album_data['date']),
+                         genres=','.join(sorted(genre_list)))
+
+        for track in album_data['songs']:
+            track_title = track['title']
+            track_hash = helper.generate_track_hash(track_title, album, artist, track['file'])
+
+            if not ingest.mark_track(track_hash):
+                yield track['file'], (track_hash, album_hash, artist_hash, dict(
+                    name=track_title,
+                    name_sort=helper.get_sort_name(track_title),
+                    artist_name=artist,
+                    album_name=album,
+                    duration=float(track['duration']) * 1000,  # Store time in ms
+                    track_num=track['track'],
+                    disc_num=track['disc'],
+                    download_url=track['file']))
+
+
+def _add_probed_mpd_tracks(ingest: Ingest, probes: Iterator[Tuple[tuple, dict]]):
+    """
+    Adds each track from the probe stream to the ingest,
+    caching any fresh probe results along the way.
+    """
+    with ingest.stats.stage('diff'):
+        for payload, probed in ingest.stats.timed(probes, 'probe'):
+            if probed is None:
+                ingest.end_artist(*payload)
+                continue
+
+            track_hash, album_hash, artist_hash, fields = payload
+            if 'error' in probed:
+                print("Could not read %s: %s" % (fields['download_url'], probed['error']))
+                ingest.stats.count('probe_errors')
+                continue
+
+            if not probed['cached']:
+                ingest.cache_probe(fields['download_url'], probed)
+
+            ingest.add_track(track_hash, album_hash, artist_hash, **fields,
+                             bitrate=probed['bitrate'], size=probed['size'], format=probed['format'])
+
+
+def populate_db_from_mpd(resume: bool = False):
+    """
+    Adds any new artists, albums and tracks from the MPD database.
+
+    The database is walked one directory at a time, so memory use
+    is bounded by the largest directory rather than the library.
+    Album and artist counts are kept correct by the ingest when an
+    album is spread over several directories.
+
+    The signature of every directory is stored so that
+    `sync_mpd_database` can later re-read only those which change.
+
+    :param resume: If true, continues from the checkpoint
+    left by an interrupted update.
+    """
     import pmv
 
     settings = pmv.settings['backends']['mpd']
 
-    start_time = timer()
-
     music_library = pmv.settings['music_library']
-    unknown_album = "[Unknown Album]"
 
     client = PersistentMPDClient(host=settings['hostname'], port=settings['port'])
 
-    library_dict = {}
-
-    library = client.listallinfo()
-    # Begin by assembling a dictionary
-    print("Assembling dictionary. Please wait...")
-    for song in library:
-        # Make sure this is a song and not a directory
-        if 'artist' in song:
-            artist = song['artist']
-            if artist not in library_dict:
-                library_dict[artist] = {}
-
-            # Handle songs with missing album tag
-            if 'album' in song:
-                album = song['album']
-            else:
-                album = unknown_album
-
-            if album not in library_dict[artist]:
-                # Date error checking
-                if 'date' in song:
-                    date = song['date'].replace('.', '-')
-                    if '-' not in date:
-                        date = '%s-01-01' % date
-                else:
-                    date = None  # Don't write anything for missing dates
+    ingest = _create_ingest('mpd')
+    start = ingest.get_resume_cursor() if resume else 0
 
-                library_dict[artist][album] = {
-                    'date': date,
-                    'songs': []
-                }
-            if 'genres' not in library_dict[artist][album]:
-                library_dict[artist][album]['genres'] = []
-            library_dict[artist][album]['genres'].append(mpd_helper.get_genres_as_text(song))
+    known = get_mpd_directories()
+    walked = {}
 
-            # Deduplicate
-            library_dict[artist][album]['genres'] = list(set(library_dict[artist][album]['genres']))
+    with ingest.stats.stage('fetch'):
+        db_update = int(client.stats().get('db_update', 0))
+        root = client.lsinfo()
+    root_songs = [entry for entry in root if 'file' in entry]
+    directories = [(entry['directory'], entry.get('last-modified', '')) for entry in root if 'directory' in entry]
 
-            if 'track' not in song:
-                song['track'] = 1
-            if 'disc' not in song:
-                song['disc'] = 1
+    def queue_tracks():
+        walked[''] = _get_mpd_signature('', root_songs)
+        yield from ingest.stats.timed(_queue_mpd_songs(ingest, root_songs), 'diff')
 
-            library_dict[artist][album]['songs'].append({key: _get_mpd_key(song, key) for key in song})
+        for cursor, (top_directory, last_modified) in enumerate(directories):
+            if cursor < start:
+                continue
 
-    for artist in library_dict:
-        print(artist)
-        albums = library_dict[artist]
-        artist_hash = helper.generate_artist_hash(artist)
+            walk = _walk_mpd_directory(client, top_directory, last_modified)
+            for directory, signature, songs in ingest.stats.timed(walk, 'fetch'):
+                walked[directory] = signature
+                yield from ingest.stats.timed(_queue_mpd_songs(ingest, songs), 'diff')
 
-        artist_query = get_artist_by_hash(artist_hash)
-        if not artist_query:
-            db.session.add(Artist(name=artist,
-                                  name_sort=helper.get_sort_name(artist),
-                                  album_count=len(albums),
-                                  hash=artist_hash))
-            artist_query = get_artist_by_hash(artist_hash)
-
-        for album in albums:
-            print('┣ ' + album)
-            album_data = albums[album]
-            album_hash = helper.generate_album_hash(album, artist)
-            tracks = album_data['songs']
-
-            album_query = get_album_by_hash(album_hash)
-            if not album_query:
-                genre_list = filter(lambda x: len(x) > 0, album_data['genres'])
-                db.session.add(Album(name=album,
-                                     name_sort=helper.get_sort_name(album),
-                                     artist_key=artist_query.id,
-                                     artist_name=artist,
-                                     release_date=get_formatted_date(album_data['date']),
-                                     genres=','.join([genre for genre in genre_list]),
-                                     track_count=len(tracks),
-                                     hash=album_hash))
-                album_query = get_album_by_hash(album_hash)
-
-            for track in tracks:
-                track_title = track['title']
-                print("┃ \t┣ " + track_title)
-
-                full_path = music_library + track['file']
-                track_hash = helper.generate_track_hash(track_title, album, artist, track['file'])
-
-                track_query = get_track_by_hash(track_hash)
-                if not track_query:
-                    db.session.add(Track(name=track_title,
-                                         name_sort=helper.get_sort_name(track_title),
-                                         artist_key=artist_query.id,
-                                         artist_name=artist,
-                                         album_key=album_query.id,
-                                         album_name=album,
-                                         duration=float(track['duration']) * 1000,  # Store time in ms
-                                         track_num=track['track'],
-                                         disc_num=track['disc'],
-                                         download_url=track['file'],
-                                         bitrate=mutagen.File(full_path).info.bitrate / 1000,  # Store bitrate in kbps
-                                         size=os.path.getsize(full_path),
-                                         format=full_path.rpartition('.')[-1].lower(),
-                                         hash=track_hash))
-
-    print("\nFinished constructing db.session in %r seconds" % round(timer() - start_time))
-    print("Committing db.session.\n")
-    db.session.commit()
+            # Passed through the probe pool in order, so the checkpoint
+            # only moves once every track before it has been added.
+            yield None, (top_directory, cursor + 1)
+
+    _add_probed_mpd_tracks(ingest, probe.probe_files(queue_tracks(), music_library,
+                                                     pmv.settings['ingest']['probe_workers'],
+                                                     pmv.settings['ingest']['probe_processes'], get_probe_cache()))
+    ingest.commit()
+
+    # A resumed update did not mark the tracks before its checkpoint
+    if not resume:
+        ingest.sweep(Track.plex_id.is_(None))
+
+    with ingest.stats.stage('commit'):
+        removed = [] if resume else [directory for key, directory, last_modified in known.values()
+                                     if directory not in walked]
+        _save_mpd_directories(walked, known, removed, ingest.batch_size)
+
+        # A resumed update did not read the directories before its checkpoint
+        if not resume:
+            set_sync_watermark('mpd', 'db_update', db_update)
+
+    ingest.finish()
+
+
+def sync_mpd_database(client: PersistentMPDClient = None) -> int:
+    """
+    Re-reads only the directories of the MPD database which have changed
+    since it was last synced.
+
+    Nothing is read if MPD's database has not been updated since.
+    Otherwise, only the directories which may have changed are listed,
+    as described in `_walk_changed_mpd_directories`. If MPD's database
+    has never been synced, every directory is listed instead.
+    Only directories whose stored signature differs are re-read.
+
+    Tracks no longer in a changed or removed directory are deleted, with
+    moved tracks keeping their playlist entries. The directories are
+    swept and stored a few at a time, so that a failure part way through
+    leaves the rest to be synced again.
+
+    If no directories have been stored yet, a full update is run instead.
+
+    :param client: The MPD client to use, or None to connect using the settings.
+    :return: The number of directories which changed or were removed.
+    """
+    import pmv
+
+    settings = pmv.settings['backends']['mpd']
+
+    if not client:
+        client = PersistentMPDClient(host=settings['hostname'], port=settings['port'])
+
+    known = get_mpd_directories()
+    if not known:
+        print("No MPD directories stored, running a full update.")
+        populate_db_from_mpd()
+        return len(get_mpd_directories())
+
+    db_update = int(client.stats().get('db_update', 0))
+    watermark = get_sync_watermark('mpd', 'db_update')
+    if watermark and watermark.synced_at == db_update:
+        return 0
+
+    ingest = _create_ingest('mpd_sync', watching=True)
+
+    stored = {directory: last_modified for key, directory, last_modified in known.values()}
+    directories = {}
+    walked = {}
+    changed = []
+
+    listing = _walk_changed_mpd_directories(client, stored, watermark.synced_at if watermark else None,
+                                            directories)
+
+    def queue_tracks():
+        for directory, signature, songs in ingest.stats.timed(listing, 'fetch'):
+            walked[directory] = signature
+            changed.append(directory)
+
+            yield from ingest.stats.timed(_queue_mpd_songs(ingest, songs), 'diff')
+
+    _add_probed_mpd_tracks(ingest, probe.probe_files(queue_tracks(), pmv.settings['music_library'],
+                                                     pmv.settings['ingest']['probe_workers'],
+                                                     pmv.settings['ingest']['probe_processes'], get_probe_cache()))
+    ingest.commit()
+
+    gone = {directory for key, directory, last_modified in known.values() if directory not in directories}
+    if gone and set(directories) <= {''}:
+        # An empty listing is more likely a failure of MPD than an empty library
+        print("MPD listed no directories, so none will be removed")
+        gone = set()
+
+    # Subdirectories of a removed directory are covered by its criterion
+    removed = [directory for directory in gone if directory.rpartition('/')[0] not in gone]
+    forgotten = {directory: [path for path in gone if (path + '/').startswith(directory + '/')]
+                 for directory in removed}
+
+    sweeps = [*((directory, False) for directory in changed), *((directory, True) for directory in removed)]
+    for i in range(0, len(sweeps), MPD_SWEEP_DIRECTORIES):
+        chunk = sweeps[i:i + MPD_SWEEP_DIRECTORIES]
+        criteria = [_get_mpd_directory_criterion(directory, recursive) for directory, recursive in chunk]
+        ingest.sweep(db.and_(Track.plex_id.is_(None), db.or_(*criteria)), allow_empty=True)
+
+        with ingest.stats.stage('commit'):
+            _save_mpd_directories({directory: walked[directory] for directory, recursive in chunk if not recursive},
+                                  known, [path for directory, recursive in chunk if recursive
+                                          for path in forgotten[directory]], ingest.batch_size)
+
+    with ingest.stats.stage('commit'):
+        set_sync_watermark('mpd', 'db_update', db_update)
+
+    ingest.finish()
+
+    return len(changed) + len(removed)
+
+
+def _scan_directory(music_library: str, directory: str, extensions: Iterable[str]) -> Iterator[str]:
+    """
+    Walks a directory of the library and all of its subdirectories
+    using `os.scandir`, reading each directory only once.
+
+    :param music_library: The path to the music library.
+    :param directory: The path of the directory, relative to the library.
+    :param extensions: The lowercase extensions of the files to include.
+    :return: An iterator of the path of each file, relative to the library,
+    in name order.
+    """
+    extensions = {'.' + extension for extension in extensions}
+
+    stack = [directory]
+    while stack:
+        directory = stack.pop()
+        prefix = directory + '/' if directory else ''
+
+        files = []
+        subdirectories = []
+        with scandir(music_library + directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+
+                if entry.is_dir():
+                    subdirectories.append(prefix + entry.name)
+                elif entry.is_file() and path.splitext(entry.name)[1].lower() in extensions:
+                    files.append(prefix + entry.name)
+
+        stack += sorted(subdirectories, reverse=True)
+        yield from sorted(files)
+
+
+def _add_filesystem_track(ingest: Ingest, relative_path: str, probed: dict):
+    """
+    Adds a track and its artist and album using the tags read from its file.
+    """
+    tags = probed['tags']
+    unknown_artist = "[Unknown Artist]"
+    unknown_album = "[Unknown Album]"
+
+    artist = tags.get('artist', unknown_artist)
+    album = tags.get('album', unknown_album)
+    title = tags.get('title', path.splitext(path.basename(relative_path))[0])
+
+    artist_hash = helper.generate_artist_hash(artist)
+    ingest.add_artist(artist_hash,
+                      name=artist,
+                      name_sort=helper.get_sort_name(artist))
+
+    album_hash = helper.generate_album_hash(album, artist)
+    ingest.add_album(album_hash, artist_hash,
+                     name=album,
+                     name_sort=helper.get_sort_name(album),
+                     artist_name=artist,
+                     release_date=get_formatted_date(tags.get('date')),
+                     genres=','.join(sorted(set(filter(None, tags.get('genre', []))))))
+
+    track_hash = helper.generate_track_hash(title, album, artist, relative_path)
+    ingest.add_track(track_hash, album_hash, artist_hash,
+                     name=title,
+                     name_sort=helper.get_sort_name(title),
+                     artist_name=artist,
+                     album_name=album,
+                     duration=probed['duration'],
+                     track_num=tags.get('tracknumber', 1),
+                     disc_num=tags.get('discnumber', 1),
+                     download_url=relative_path,
+                     bitrate=probed['bitrate'],
+                     size=probed['size'],
+                     format=probed['format'])
+
+
+def populate_db_from_filesystem(resume: bool = False):
+    """
+    Adds any new artists, albums and tracks by reading
+    the tags of the files in the music library directly.
+
+    Tags are read in a process pool, so the scan scales with the
+    number of cores. A file whose size and modification time match
+    its probe cache entry belongs to an unchanged track, which is
+    found by its path rather than by opening the file again.
+
+    The library is walked one top-level directory at a time,
+    which is used as the checkpoint for resuming.
+
+    :param resume: If true, continues from the checkpoint
+    left by an interrupted update.
+    """
+    import pmv
+
+    settings = pmv.settings['backends']['filesystem']
+
+    music_library = pmv.settings['music_library']
+
+    ingest = _create_ingest('filesystem')
+    start = ingest.get_resume_cursor() if resume else 0
+
+    with ingest.stats.stage('diff'):
+        track_hashes = get_track_hashes_by_path(Track.plex_id.is_(None))
+        cache = get_probe_cache()
+
+        # Only cached files with a track can skip reading their tags. The rest
+        # keep their cache ID, so that the new result replaces the old one.
+        for path_hash, cached in cache.items():
+            if path_hash not in track_hashes:
+                cached['size'] = cached['mtime_ns'] = None
+
+    extensions = {'.' + extension for extension in settings['extensions']}
+    with scandir(music_library) as entries:
+        entries = [entry for entry in entries if not entry.name.startswith('.')]
+        directories = sorted(entry.name for entry in entries if entry.is_dir())
+        root_files = sorted(entry.name for entry in entries
+                            if entry.is_file() and path.splitext(entry.name)[1].lower() in extensions)
+
+    def queue_files():
+        for relative_path in root_files:
+            yield relative_path, relative_path
+
+        for cursor, top_directory in enumerate(directories):
+            if cursor < start:
+                continue
+
+            scan = _scan_directory(music_library, top_directory, settings['extensions'])
+            for relative_path in ingest.stats.timed(scan, 'fetch'):
+                yield relative_path, relative_path
+
+            yield None, (top_directory, cursor + 1)
+
+    probes = probe.probe_files(queue_files(), music_library, settings['workers'] or cpu_count(), True, cache, True)
+
+    with ingest.stats.stage('diff'):
+        for payload, probed in ingest.stats.timed(probes, 'probe'):
+            if probed is None:
+                ingest.end_artist(*payload)
+            elif 'error' in probed:
+                print("Could not read %s: %s" % (payload, probed['error']))
+                ingest.stats.count('probe_errors')
+            elif probed['cached']:
+                ingest.mark_track(track_hashes[helper.generate_path_hash(payload)])
+            else:
+                ingest.cache_probe(payload, probed)
+                _add_filesystem_track(ingest, payload, probed)
+
+    ingest.commit()
+
+    # A resumed update did not mark the tracks before its checkpoint
+    if not resume:
+        ingest.sweep(Track.plex_id.is_(None))
+
+    ingest.finish()
@@ -1,8 +1,10 @@
-from typing import Union, List
+from typing import Union, List, Dict, Iterable, Tuple
 
 import helper
 from .db import database, Permission
-from .models import User, Artist, Album, Track, Playlist
+from .models import User, Artist, Album, Track, Playlist, IngestCheckpoint, SyncWatermark, \
+    ProbeCache, MpdDirectory, playlist_track
+from .pagination import Page, paginate
 
 db = database()
 
@@ -12,6 +14,18 @@ def add_single(obj):
     db.session.commit()
 
 
+def _get_hash_map(model, hashes: Iterable[int] = None) -> Dict[int, int]:
+    """
+    Gets a dictionary of hash to ID for the given model.
+    If hashes are given, only those rows are fetched.
+    """
+    query = db.session.query(model.hash, model.id)
+    if hashes is not None:
+        query = query.filter(model.hash.in_(list(hashes)))
+
+    return {row_hash: key for row_hash, key in query}
+
+
 def get_users(include_deleted: bool = False):
     if include_deleted:
         return db.session.query(User).all()
@@ -44,6 +58,8 @@ def get_user_by_username(username: str, include_deleted=False):
 
 
 def edit_user_by_id(key: int, fields: dict):
+    from .user_cache import invalidate_user
+
     user: User = get_user_by_id(key)
     for key in fields:
         if key == 'id' or key == 'action':
@@ -66,6 +82,9 @@ def edit_user_by_id(key: int, fields: dict):
 
         setattr(user, key, value)
 
+    db.session.commit()
+    invalidate_user(user.id)
+
 
 def get_user(param: Union[str, int]) -> User:
     """
@@ -79,15 +98,21 @@ def get_user(param: Union[str, int]) -> User:
 
 
 def delete_user_by_id(key: int, restore=False):
-    user: User = get_user_by_id(key)
+    from .user_cache import invalidate_user
+
+    user: User = get_user_by_id(key, include_deleted=True)
     user.is_deleted = not restore
     db.session.commit()
+    invalidate_user(user.id)
 
 
 def delete_user_by_username(username: str, restore=False):
-    user: User = get_user_by_username(username)
+    from .user_cache import invalidate_user
+
+    user: User = get_user_by_username(username, include_deleted=True)
     user.is_deleted = not restore
     db.session.commit()
+    invalidate_user(user.id)
 
 
 def get_artists() -> List[Artist]:
@@ -98,6 +123,27 @@ def get_artist_by_id(key: int) -> Artist:
     return db.session.query(Artist).filter_by(id=key).first()
 
 
+def get_artists_page(after: str = None, limit: int = 100) -> Page:
+    """
+    :param after: The cursor of the page, or None for the first page.
+    :param limit: The most artists to return.
+    :return: A page of artists, in order of sort name.
+    """
+    return paginate(db.session.query(Artist), [(Artist.name_sort, False), (Artist.id, False)], after, limit)
+
+
+def get_artist_albums_page(key: int, after: str = None, limit: int = 100) -> Page:
+    """
+    :param key: The ID of the artist.
+    :param after: The cursor of the page, or None for the first page.
+    :param limit: The most albums to return.
+    :return: A page of the artist's albums, newest first.
+    Albums without a release date come last.
+    """
+    return paginate(db.session.query(Album).filter_by(artist_key=key),
+                    [(Album.release_date, True), (Album.id, True)], after, limit)
+
+
 def get_artist_by_plex_key(plex_key: int) -> Artist:
     return db.session.query(Artist).filter_by(plex_id=plex_key).first()
 
@@ -106,6 +152,10 @@ def get_artist_by_hash(hash_key: int) -> Artist:
     return db.session.query(Artist).filter_by(hash=hash_key).first()
 
 
+def get_artist_hash_map(hashes: Iterable[int] = None) -> Dict[int, int]:
+    return _get_hash_map(Artist, hashes)
+
+
 def get_artist_by_name(name: str) -> Artist:
     return db.session.query(Artist).filter_by(name=name).first()
 
@@ -118,6 +168,13 @@ def get_album_by_id(key: int) -> Album:
     return db.session.query(Album).filter_by(id=key).first()
 
 
+def get_album_with_tracks(key: int) -> Album:
+    """
+    Loads an album for the album page or download, along with its tracks.
+    """
+    return db.session.query(Album).options(db.selectinload(Album.tracks)).filter_by(id=key).first()
+
+
 def get_album_by_plex_key(plex_key: int) -> Album:
     return db.session.query(Album).filter_by(plex_id=plex_key).first()
 
@@ -126,6 +183,10 @@ def get_album_by_hash(hash_key: int) -> Album:
     return db.session.query(Album).filter_by(hash=hash_key).first()
 
 
+def get_album_hash_map(hashes: Iterable[int] = None) -> Dict[int, int]:
+    return _get_hash_map(Album, hashes)
+
+
 def get_album_disc_by_id(key: int, disc: int) -> List[Track]:
     return db.session.query(Track).filter_by(album_key=key, disc_num=disc).all()
 
@@ -142,6 +203,14 @@ def get_track_by_id(key: int) -> Track:
     return db.session.query(Track).filter_by(id=key).first()
 
 
+def get_track_with_album(key: int) -> Track:
+    """
+    Loads a track for the track page, along with its album
+    in the same statement, as the album's art sets the page colours.
+    """
+    return db.session.query(Track).options(db.joinedload(Track.album)).filter_by(id=key).first()
+
+
 def get_track_by_plex_key(plex_key: int) -> Track:
     return db.session.query(Track).filter_by(plex_id=plex_key).first()
 
@@ -150,6 +219,52 @@ def get_track_by_hash(hash_key: int) -> Track:
     return db.session.query(Track).filter_by(hash=hash_key).first()
 
 
+def get_track_hash_map(hashes: Iterable[int] = None) -> Dict[int, int]:
+    return _get_hash_map(Track, hashes)
+
+
+def _get_keys_by_plex_id(model, plex_keys: Iterable[int]) -> Dict[int, int]:
+    query = db.session.query(model.plex_id, model.id).filter(model.plex_id.in_(list(plex_keys)))
+    return {plex_id: key for plex_id, key in query}
+
+
+def get_track_keys_by_plex_id(plex_keys: Iterable[int]) -> Dict[int, int]:
+    """
+    :return: A dictionary of Plex ID to track ID for
+    the tracks with the given Plex IDs.
+    """
+    return _get_keys_by_plex_id(Track, plex_keys)
+
+
+def get_album_keys_by_plex_id(plex_keys: Iterable[int]) -> Dict[int, int]:
+    """
+    :return: A dictionary of Plex ID to album ID for
+    the albums with the given Plex IDs.
+    """
+    return _get_keys_by_plex_id(Album, plex_keys)
+
+
+def get_artist_keys_by_plex_id(plex_keys: Iterable[int]) -> Dict[int, int]:
+    """
+    :return: A dictionary of Plex ID to artist ID for
+    the artists with the given Plex IDs.
+    """
+    return _get_keys_by_plex_id(Artist, plex_keys)
+
+
+def get_track_keys_by_plex_parent(plex_keys: Iterable[int]) -> List[int]:
+    """
+    :return: The IDs of the tracks which have, or whose album
+    or artist has, one of the given Plex IDs.
+    """
+    plex_keys = list(plex_keys)
+    query = db.session.query(Track.id) \
+        .outerjoin(Album, Track.album_key == Album.id) \
+        .outerjoin(Artist, Track.artist_key == Artist.id) \
+        .filter(db.or_(Track.plex_id.in_(plex_keys), Album.plex_id.in_(plex_keys), Artist.plex_id.in_(plex_keys)))
+    return [key for key, in query]
+
+
 def get_tracks_by_name(query: str) -> List[Track]:
     return db.session.query(Track).filter(Track.name.ilike('%' + query + '%')).all()
 
@@ -158,5 +273,95 @@ def get_playlist_by_id(key: int) -> Playlist:
     return db.session.query(Playlist).filter_by(id=key).first()
 
 
+def get_playlist_with_tracks(key: int) -> Playlist:
+    """
+    Loads a playlist for the playlist page or download, along with its tracks.
+    """
+    return db.session.query(Playlist).options(db.selectinload(Playlist.tracks)).filter_by(id=key).first()
+
+
 def get_playlists_by_user(user: User) -> List[Playlist]:
     return db.session.query(Playlist).filter_by(creator_id=user.id).all()
+
+
+def get_playlists_page(user: User, after: str = None, limit: int = 100) -> Page:
+    """
+    :param user: The creator of the playlists.
+    :param after: The cursor of the page, or None for the first page.
+    :param limit: The most playlists to return.
+    :return: A page of the user's playlists, oldest first.
+    """
+    return paginate(db.session.query(Playlist).filter_by(creator_id=user.id), [(Playlist.id, False)], after, limit)
+
+
+def get_playlist_tracks_page(key: int, after: str = None, limit: int = 100) -> Page:
+    """
+    :param key: The ID of the playlist.
+    :param after: The cursor of the page, or None for the first page.
+    :param limit: The most tracks to return.
+    :return: A page of the playlist's tracks, in playlist order.
+    """
+    query = db.session.query(Track, playlist_track.c.position, playlist_track.c.track_id) \
+        .join(playlist_track, playlist_track.c.track_id == Track.id) \
+        .filter(playlist_track.c.playlist_id == key)
+    page = paginate(query, [(playlist_track.c.position, False), (playlist_track.c.track_id, False)], after, limit)
+    page.items = [row.Track for row in page.items]
+    return page
+
+
+def get_ingest_checkpoint(backend: str) -> IngestCheckpoint:
+    return db.session.query(IngestCheckpoint).filter_by(backend=backend).first()
+
+
+def get_sync_watermark(backend: str, section: str) -> SyncWatermark:
+    return db.session.query(SyncWatermark).filter_by(backend=backend, section=section).first()
+
+
+def set_sync_watermark(backend: str, section: str, synced_at: int):
+    db.session.merge(SyncWatermark(backend=backend, section=section, synced_at=synced_at))
+    db.session.commit()
+
+
+def get_probe_cache() -> Dict[int, dict]:
+    """
+    :return: A dictionary of path hash to the cached
+    probe results for that file.
+    """
+    columns = [ProbeCache.id, ProbeCache.size, ProbeCache.mtime_ns, ProbeCache.bitrate, ProbeCache.duration,
+               ProbeCache.format, ProbeCache.tag_digest]
+    query = db.session.query(ProbeCache.path_hash, *columns)
+    return {row[0]: {column.key: value for column, value in zip(columns, row[1:])} for row in query}
+
+
+def get_mpd_directories() -> Dict[int, Tuple[int, str, str]]:
+    """
+    :return: A dictionary of path hash to the ID, path
+    and last modification time of each stored MPD directory.
+    """
+    query = db.session.query(MpdDirectory.path_hash, MpdDirectory.id, MpdDirectory.path, MpdDirectory.last_modified)
+    return {path_hash: (key, path, last_modified) for path_hash, key, path, last_modified in query}
+
+
+def get_track_hashes_by_path(criterion) -> Dict[int, int]:
+    """
+    :param criterion: A filter limiting the tracks to one backend.
+    :return: A dictionary of the path hash of each track's file to the track's hash.
+    """
+    query = db.session.query(Track.download_url, Track.hash).filter(criterion)
+    return {helper.generate_path_hash(url): track_hash for url, track_hash in query if url}
+
+
+def get_catalog_signature() -> tuple:
+    """
+    :return: A value which changes whenever an ingest adds, removes
+    or renames artists, albums or tracks, cheap enough to check often.
+    """
+    columns = []
+    for model in [Artist, Album, Track]:
+        columns.append(db.select([db.func.count(model.id)]).as_scalar())
+        columns.append(db.select([db.func.max(model.id)]).as_scalar())
+
+    columns.append(db.select([db.func.max(SyncWatermark.synced_at)]).where(SyncWatermark.backend == 'ingest')
+                   .as_scalar())
+
+    return tuple(db.session.query(*columns).one())
@@ -0,0 +1,197 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import inspect
+
+from .db import database
+from .models import Artist, Album, Track
+from .pagination import Page, encode_cursor, decode_cursor, paginate
+
+db = database()
+
+# Kinds of row in the search index. On SQLite each row's ID is
+# the item's ID * SEARCH_KINDS + its kind, so triggers can find it.
+SEARCH_KINDS = 4
+SEARCH_MODELS = [Artist, Album, Track]
+SEARCH_TYPES = ['artist', 'album', 'track']
+
+# Whether the database has a search index, checked on first search
+_has_index: Optional[bool] = None
+
+
+def _get_terms(query: str) -> List[str]:
+    return re.findall(r'\w+', query)
+
+
+def has_search_index() -> bool:
+    """
+    :return: True if the database has a full-text search index.
+    """
+    global _has_index
+
+    if _has_index is None:
+        dialect = db.engine.dialect.name
+        if dialect == 'sqlite':
+            _has_index = db.session.execute("SELECT 1 FROM sqlite_master WHERE name = 'search_index'").scalar() \
+                is not None
+        elif dialect == 'mysql':
+            _has_index = any(index['name'] == 'ft_tracks_name' for index in inspect(db.engine).get_indexes('tracks'))
+        else:
+            _has_index = False
+
+    return _has_index
+
+
+def _search_sqlite(terms: List[str], limits: List[int]) -> List[Tuple[int, int]]:
+    # Every term must match the start of a word
+    match = ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+
+    rows = db.session.execute("""
+        SELECT rowid FROM (
+            SELECT rowid, rank, row_number() OVER (PARTITION BY rowid % :kinds ORDER BY rank) AS position
+            FROM search_index WHERE search_index MATCH :match
+        )
+        WHERE position <= CASE rowid % :kinds WHEN 0 THEN :artists WHEN 1 THEN :albums ELSE :tracks END
+        ORDER BY rank
+    """, {'kinds': SEARCH_KINDS, 'match': match, 'artists': limits[0], 'albums': limits[1], 'tracks': limits[2]})
+
+    return [(row_id % SEARCH_KINDS, row_id // SEARCH_KINDS) for row_id, in rows]
+
+
+def _search_mysql(terms: List[str], limits: List[int]) -> List[Tuple[int, int]]:
+    # Every term must match the start of a word
+    match = ' '.join('+%s*' % term for term in terms)
+
+    selects = []
+    for kind, model in enumerate(SEARCH_MODELS):
+        if limits[kind]:
+            selects.append("(SELECT %d AS kind, id, MATCH(name) AGAINST (:match IN BOOLEAN MODE) AS score FROM %s "
+                           "WHERE MATCH(name) AGAINST (:match IN BOOLEAN MODE) ORDER BY score DESC LIMIT %d)"
+                           % (kind, model.__tablename__, limits[kind]))
+
+    if not selects:
+        return []
+
+    rows = db.session.execute(' UNION ALL '.join(selects) + ' ORDER BY score DESC', {'match': match})
+    return [(kind, key) for kind, key, score in rows]
+
+
+def _search_fallback(query: str, limits: List[int]) -> List[Tuple[int, int]]:
+    results = []
+    for kind, model in enumerate(SEARCH_MODELS):
+        if limits[kind]:
+            rows = db.session.query(model.id).filter(model.name.ilike('%' + query + '%')).limit(limits[kind])
+            results += [(kind, key) for key, in rows]
+
+    return results
+
+
+def search_music(query: str, artist_limit: int, album_limit: int,
+                 track_limit: int) -> Tuple[List[Artist], List[Album], List[Track]]:
+    """
+    Searches the names of artists, albums and tracks.
+
+    Uses the full-text index if the database has one, in which case every
+    word of the query must start a word of the name and results are
+    ranked by relevance. Otherwise falls back to a substring match.
+
+    :param query: The text to search for.
+    :param artist_limit: The most artists to return, or 0 for none.
+    :param album_limit: The most albums to return, or 0 for none.
+    :param track_limit: The most tracks to return, or 0 for none.
+    :return: The matching artists, albums and tracks, each in order of relevance.
+    """
+    limits = [artist_limit, album_limit, track_limit]
+    terms = _get_terms(query or '')
+
+    if not terms or not any(limits):
+        results = []
+    elif has_search_index():
+        search = _search_sqlite if db.engine.dialect.name == 'sqlite' else _search_mysql
+        results = search(terms, limits)
+    else:
+        results = _search_fallback(query, limits)
+
+    keys: List[List[int]] = [[] for _ in SEARCH_MODELS]
+    for kind, key in results:
+        keys[kind].append(key)
+
+    items = [_load(model, model_keys) for model, model_keys in zip(SEARCH_MODELS, keys)]
+    return items[0], items[1], items[2]
+
+
+def _load(model, keys: List[int]) -> list:
+    """
+    :return: The rows of the model with the given IDs, in the same order.
+    """
+    rows: Dict[int, object] = {row.id: row for row in
+                               db.session.query(model).filter(model.id.in_(keys))} if keys else {}
+    return [rows[key] for key in keys if key in rows]
+
+
+def _search_page_sqlite(terms: List[str], kind: int, after: Optional[list],
+                        limit: int) -> List[Tuple[int, float, int]]:
+    match = ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+    params = {'kinds': SEARCH_KINDS, 'kind': kind, 'match': match, 'limit': limit}
+
+    seek = ''
+    if after:
+        seek = 'AND (rank > :rank OR (rank = :rank AND rowid > :row_id))'
+        params.update(rank=after[0], row_id=after[1])
+
+    rows = db.session.execute("""
+        SELECT rowid, rank FROM search_index
+        WHERE search_index MATCH :match AND rowid %% :kinds = :kind %s
+        ORDER BY rank, rowid LIMIT :limit
+    """ % seek, params)
+
+    return [(row_id // SEARCH_KINDS, rank, row_id) for row_id, rank in rows]
+
+
+def _search_page_mysql(terms: List[str], kind: int, after: Optional[list],
+                       limit: int) -> List[Tuple[int, float, int]]:
+    match = ' '.join('+%s*' % term for term in terms)
+    score = 'MATCH(name) AGAINST (:match IN BOOLEAN MODE)'
+    params = {'match': match, 'limit': limit}
+
+    seek = ''
+    if after:
+        seek = 'AND (%s < :score OR (%s = :score AND id > :id))' % (score, score)
+        params.update(score=after[0], id=after[1])
+
+    rows = db.session.execute("SELECT id, %s AS score FROM %s WHERE %s %s ORDER BY score DESC, id LIMIT :limit"
+                              % (score, SEARCH_MODELS[kind].__tablename__, score, seek), params)
+
+    return [(key, row_score, key) for key, row_score in rows]
+
+
+def search_music_page(query: str, kind: int, after: str = None, limit: int = 100) -> Page:
+    """
+    Gets a page of the artists, albums or tracks
+    matching a search, in the same order as `search_music`.
+
+    :param query: The text to search for.
+    :param kind: What to search for, as an index of `SEARCH_MODELS`.
+    :param after: The cursor of the page, or None for the first page.
+    :param limit: The most items to return.
+    :return: The page of matching items.
+    """
+    model = SEARCH_MODELS[kind]
+    terms = _get_terms(query or '')
+
+    if not terms:
+        return Page([], None, limit)
+
+    if not has_search_index():
+        return paginate(db.session.query(model).filter(model.name.ilike('%' + query + '%')),
+                        [(model.id, False)], after, limit)
+
+    search = _search_page_sqlite if db.engine.dialect.name == 'sqlite' else _search_page_mysql
+    results = search(terms, kind, decode_cursor(after, 2) if after else None, limit + 1)
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = encode_cursor(list(results[-1][1:]))
+
+    return Page(_load(model, [key for key, _, _ in results]), next_cursor, limit)
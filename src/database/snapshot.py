@@ -0,0 +1,428 @@
+import datetime
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .db import database
+from .models import Artist, Album, Track
+from .pagination import Page, encode_cursor, decode_cursor, InvalidCursorError
+from .queries import get_catalog_signature, get_artists_page, get_artist_albums_page, get_artist_by_id, \
+    get_album_with_tracks
+
+db = database()
+
+MAGIC = b'PMVCAT\0\0'
+VERSION = 1
+
+# Stored in place of a missing number or date
+NULL = np.iinfo(np.int64).min
+
+# Each table of the snapshot, with the model it is read from and the
+# order its rows are stored in. Artists are stored in listing order,
+# albums in listing order within each artist, and tracks in album order.
+SNAPSHOT_TABLES = [
+    ('artists', Artist, [Artist.name_sort, Artist.id]),
+    ('albums', Album, [Album.artist_key, Album.release_date.desc(), Album.id.desc()]),
+    ('tracks', Track, [Track.album_key, Track.disc_num, Track.track_num, Track.id])
+]
+
+
+class CatalogRow:
+    """
+    A read-only row of the catalog snapshot,
+    with an attribute for each stored column.
+    """
+
+    def __init__(self, table: str, columns: dict):
+        self.table = table
+        self.__dict__.update(columns)
+
+    def __repr__(self):
+        return "<%d - %s>" % (self.id, self.name)
+
+
+def _get_kind(column) -> str:
+    python_type = column.type.python_type
+    if python_type is int:
+        return 'int'
+    elif python_type is str:
+        return 'str'
+    elif python_type is datetime.date:
+        return 'date'
+
+    raise TypeError("Cannot store column %s of type %s" % (column.name, column.type))
+
+
+def write_catalog_snapshot(path: str):
+    """
+    Writes every artist, album and track to a snapshot file,
+    which workers memory-map to serve listings without the database.
+
+    Every column is stored as an array of 64-bit integers. Strings are
+    indexes into a shared string table, and dates are ordinals. The file
+    is replaced atomically, so workers still reading the old snapshot
+    keep a consistent copy until they next check for a new one.
+
+    :param path: Where to write the snapshot.
+    """
+    signature = get_catalog_signature()
+
+    strings: Dict[str, int] = {}
+    arrays: Dict[str, np.ndarray] = {}
+    tables = {}
+
+    def intern(value: str) -> int:
+        return strings.setdefault(value, len(strings))
+
+    for name, model, order in SNAPSHOT_TABLES:
+        columns = [column for column in model.__table__.columns if column.name != 'hash']
+        kinds = [_get_kind(column) for column in columns]
+        rows = db.session.query(*columns).order_by(*order).all()
+
+        for i, (column, kind) in enumerate(zip(columns, kinds)):
+            if kind == 'str':
+                values = [-1 if row[i] is None else intern(row[i]) for row in rows]
+            elif kind == 'date':
+                values = [NULL if row[i] is None else row[i].toordinal() for row in rows]
+            else:
+                values = [NULL if row[i] is None else row[i] for row in rows]
+
+            arrays['%s.%s' % (name, column.name)] = np.array(values, dtype=np.int64)
+
+        # Rows are found by ID with a binary search of the sorted IDs
+        by_id = np.argsort(arrays[name + '.id'], kind='stable')
+        arrays[name + '.by_id'] = by_id.astype(np.int64)
+        arrays[name + '.sorted_ids'] = arrays[name + '.id'][by_id]
+
+        tables[name] = {'rows': len(rows), 'columns': [[column.name, kind] for column, kind in zip(columns, kinds)]}
+
+    db.session.commit()
+
+    encoded = [value.encode() for value in strings]
+    arrays['strings.offsets'] = np.concatenate(([0], np.cumsum([len(value) for value in encoded]))).astype(np.int64)
+    blob = b''.join(encoded)
+
+    # The header is followed by each array, then the string data,
+    # each starting on an 8 byte boundary
+    header = {'version': VERSION, 'signature': list(signature), 'created_at': int(time.time()),
+              'tables': tables, 'arrays': {}, 'strings': []}
+    header_size = 4096
+    while True:
+        offset = header_size
+        for name, array in arrays.items():
+            header['arrays'][name] = [offset, len(array)]
+            offset += array.nbytes
+        header['strings'] = [offset, len(blob)]
+
+        encoded_header = json.dumps(header, separators=(',', ':')).encode()
+        if 16 + len(encoded_header) <= header_size:
+            break
+        header_size = (16 + len(encoded_header) + 4095) // 4096 * 4096
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+    with open(temp_path, 'wb') as f:
+        f.write(struct.pack('<8sQ', MAGIC, len(encoded_header)))
+        f.write(encoded_header.ljust(header_size - 16, b'\0'))
+        for array in arrays.values():
+            f.write(array.tobytes())
+        f.write(blob)
+
+    os.replace(temp_path, path)
+
+
+class CatalogSnapshot:
+    """
+    A catalog snapshot, memory-mapped read-only. The pages of the
+    file are shared by every process which maps it, and each array
+    is a view of the file rather than a copy.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, length = struct.unpack_from('<8sQ', self._buffer)
+        if magic != MAGIC:
+            raise ValueError("Not a catalog snapshot")
+
+        header = json.loads(self._buffer[16:16 + length])
+        if header['version'] != VERSION:
+            raise ValueError("Catalog snapshot version %d is not supported" % header['version'])
+
+        self.signature = tuple(header['signature'])
+        self.created_at = header['created_at']
+        self._tables = {name: table['columns'] for name, table in header['tables'].items()}
+        self._arrays = {name: np.frombuffer(self._buffer, dtype=np.int64, count=count, offset=offset)
+                        for name, (offset, count) in header['arrays'].items()}
+        self._strings_offset = header['strings'][0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Unmaps the file. Rows already read stay valid,
+        but nothing else can be read from the snapshot.
+        """
+        # The arrays are views of the map, which cannot be closed while they exist
+        self._arrays.clear()
+        self._buffer.close()
+
+    def _get_string(self, index: int) -> str:
+        offsets = self._arrays['strings.offsets']
+        start = self._strings_offset + int(offsets[index])
+        return self._buffer[start:self._strings_offset + int(offsets[index + 1])].decode()
+
+    def _get_row(self, table: str, i: int) -> CatalogRow:
+        columns = {}
+        for name, kind in self._tables[table]:
+            value = int(self._arrays['%s.%s' % (table, name)][i])
+            if kind == 'str':
+                columns[name] = None if value < 0 else self._get_string(value)
+            elif value == NULL:
+                columns[name] = None
+            else:
+                columns[name] = datetime.date.fromordinal(value) if kind == 'date' else value
+
+        return CatalogRow(table, columns)
+
+    def _find(self, table: str, key) -> Optional[int]:
+        """
+        :return: The index of the row with the given ID, or None if there is none.
+        """
+        if not NULL < key <= np.iinfo(np.int64).max:
+            return None
+
+        sorted_ids = self._arrays[table + '.sorted_ids']
+        i = int(np.searchsorted(sorted_ids, key))
+        if i == len(sorted_ids) or sorted_ids[i] != key:
+            return None
+
+        return int(self._arrays[table + '.by_id'][i])
+
+    def _get_range(self, table: str, column: str, key: int) -> Tuple[int, int]:
+        """
+        :return: The start and end index of the rows whose value of the
+        column is the key. Only valid for the first column of a table's order.
+        """
+        values = self._arrays['%s.%s' % (table, column)]
+        return int(np.searchsorted(values, key, 'left')), int(np.searchsorted(values, key, 'right'))
+
+    def _get_page(self, table: str, start: int, end: int, order: List[str], after: Optional[str],
+                  limit: int) -> Optional[Page]:
+        """
+        Gets a page of the rows from `start` to `end`, which are stored in
+        the same order as the database listing, so cursors from either
+        can be used with the other. A cursor is found by the ID it ends with.
+
+        :return: The page, or None if the cursor's row is no longer in the snapshot.
+        """
+        if after:
+            key = decode_cursor(after, len(order))[-1]
+            if not isinstance(key, int):
+                raise InvalidCursorError("Invalid cursor")
+
+            i = self._find(table, key)
+            if i is None or not start <= i < end:
+                return None
+            start = i + 1
+
+        items = [self._get_row(table, i) for i in range(start, min(start + limit, end))]
+        next_cursor = None
+        if items and start + limit < end:
+            next_cursor = encode_cursor([getattr(items[-1], name) for name in order])
+
+        return Page(items, next_cursor, limit)
+
+    def get_artist(self, key: int) -> Optional[CatalogRow]:
+        i = self._find('artists', key)
+        return None if i is None else self._get_row('artists', i)
+
+    def get_album(self, key: int) -> Optional[CatalogRow]:
+        i = self._find('albums', key)
+        return None if i is None else self._get_row('albums', i)
+
+    def get_album_tracks(self, key: int) -> List[CatalogRow]:
+        if self._find('albums', key) is None:
+            return []
+
+        start, end = self._get_range('tracks', 'album_key', key)
+        return [self._get_row('tracks', i) for i in range(start, end)]
+
+    def get_artists_page(self, after: Optional[str], limit: int) -> Optional[Page]:
+        return self._get_page('artists', 0, len(self._arrays['artists.id']), ['name_sort', 'id'], after, limit)
+
+    def get_artist_albums_page(self, key: int, after: Optional[str], limit: int) -> Optional[Page]:
+        if self._find('artists', key) is None:
+            return None
+
+        start, end = self._get_range('albums', 'artist_key', key)
+        return self._get_page('albums', start, end, ['release_date', 'id'], after, limit)
+
+
+# The snapshot mapped by this process, the identity of the file it was
+# mapped from, and when the file was last checked for a newer snapshot
+_snapshot: Optional[CatalogSnapshot] = None
+_identity = None
+_checked_at: Optional[float] = None
+
+
+def get_catalog_snapshot() -> Optional[CatalogSnapshot]:
+    """
+    Gets the catalog snapshot, mapping the file again if
+    an ingest has replaced it since it was last checked.
+
+    :return: The snapshot, or None if it is disabled
+    or there is no valid snapshot to read.
+    """
+    global _snapshot, _identity, _checked_at
+    import pmv
+
+    settings = pmv.settings['catalog_snapshot']
+    if not settings['enable']:
+        return None
+
+    if _checked_at is not None and time.monotonic() - _checked_at < settings['check_interval']:
+        return _snapshot
+    _checked_at = time.monotonic()
+
+    try:
+        stat = os.stat(settings['path'])
+    except FileNotFoundError:
+        _snapshot = _identity = None
+        return None
+
+    identity = stat.st_ino, stat.st_mtime_ns, stat.st_size
+    if identity != _identity:
+        _identity = identity
+        try:
+            _snapshot = CatalogSnapshot(settings['path'])
+        except (OSError, ValueError, KeyError) as e:
+            print("Ignoring catalog snapshot %s: %s" % (settings['path'], e))
+            _snapshot = None
+
+    return _snapshot
+
+
+def update_catalog_snapshot(path: str, force: bool = False) -> bool:
+    """
+    Writes the catalog snapshot if it is missing or out of date.
+
+    :param path: The path of the snapshot.
+    :param force: Whether to write it even if it seems up to date.
+    :return: Whether the snapshot was written.
+    """
+    if not force:
+        try:
+            with CatalogSnapshot(path) as snapshot:
+                if snapshot.signature == get_catalog_signature():
+                    return False
+        except (OSError, ValueError, KeyError):
+            pass
+
+    write_catalog_snapshot(path)
+    return True
+
+
+# The delayed write of the snapshot, if one is waiting
+_scheduled: Optional[threading.Timer] = None
+_scheduled_lock = threading.Lock()
+
+
+def schedule_catalog_snapshot(path: str, delay: float):
+    """
+    Writes the catalog snapshot after a delay, in the background, unless
+    a write is already waiting. Live updates arrive a few tracks at a time,
+    so this rewrites the snapshot once per burst rather than once per update.
+    Must be called inside an app context.
+
+    :param path: The path of the snapshot.
+    :param delay: The number of seconds to wait.
+    """
+    global _scheduled
+    from flask import current_app
+
+    with _scheduled_lock:
+        if _scheduled is not None:
+            return
+
+        _scheduled = threading.Timer(delay, _write_scheduled, (current_app._get_current_object(), path))
+        _scheduled.daemon = True
+        _scheduled.start()
+
+
+def _write_scheduled(app, path: str):
+    global _scheduled
+
+    # Cleared first, so that changes made during the write schedule another
+    with _scheduled_lock:
+        _scheduled = None
+
+    try:
+        with app.app_context():
+            write_catalog_snapshot(path)
+    except Exception as e:
+        print("Could not write catalog snapshot %s: %s" % (path, e))
+
+
+def get_catalog_artists_page(after: str = None, limit: int = 100) -> Page:
+    """
+    Gets a page of artists from the catalog snapshot,
+    or from the database if there is no snapshot.
+    See `get_artists_page`.
+    """
+    snapshot = get_catalog_snapshot()
+    page = snapshot.get_artists_page(after, limit) if snapshot is not None else None
+    return page if page is not None else get_artists_page(after, limit)
+
+
+def get_catalog_artist_albums_page(key: int, after: str = None, limit: int = 100) -> Page:
+    """
+    Gets a page of an artist's albums from the catalog snapshot,
+    or from the database if there is no snapshot.
+    See `get_artist_albums_page`.
+    """
+    snapshot = get_catalog_snapshot()
+    page = snapshot.get_artist_albums_page(key, after, limit) if snapshot is not None else None
+    return page if page is not None else get_artist_albums_page(key, after, limit)
+
+
+def get_catalog_artist(key: int):
+    """
+    :return: The artist from the catalog snapshot, or from
+    the database if it is not in the snapshot.
+    """
+    snapshot = get_catalog_snapshot()
+    artist = snapshot.get_artist(key) if snapshot is not None else None
+    return artist if artist is not None else get_artist_by_id(key)
+
+
+def get_catalog_album_with_tracks(key: int) -> tuple:
+    """
+    :return: The album and its tracks in album order, from the catalog
+    snapshot, or from the database if it is not in the snapshot.
+    The album is None if it does not exist.
+    """
+    snapshot = get_catalog_snapshot()
+    album = snapshot.get_album(key) if snapshot is not None else None
+    if album is not None:
+        return album, snapshot.get_album_tracks(key)
+
+    album = get_album_with_tracks(key)
+    if album is None:
+        return None, []
+
+    return album, sorted(album.tracks, key=lambda track: (track.disc_num, track.track_num))
@@ -0,0 +1,226 @@
+import re
+import threading
+import time
+import unicodedata
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .db import database
+from .models import Artist, Album, Track
+from .queries import get_catalog_signature
+
+db = database()
+
+SUGGEST_TYPES = ['artist', 'album', 'track']
+SUGGEST_MODELS = [Artist, Album, Track]
+
+
+def _normalise(text: str) -> List[str]:
+    """
+    :return: The lowercase words of the text, without accents or punctuation.
+    """
+    text = (text or '').lower()
+    if not text.isascii():
+        text = ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+
+    return re.findall(r'\w+', text)
+
+
+def _pad(text: str, partial: bool = False) -> str:
+    """
+    Pads each word of the text so that the start and end of a word
+    are trigrams of their own. Words are separated by enough space
+    that no trigram spans two of them.
+
+    :param partial: If true, the last word is treated as still being
+    typed, so its end is not padded.
+    """
+    words = _normalise(text)
+    return '  ' + '   '.join(words) + ('' if partial and words else ' ')
+
+
+def _encode_trigrams(padded: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Packs every trigram of padded text into an integer.
+
+    :return: The packed trigram starting at each position of the text,
+    and whether each is a real trigram rather than a gap between words.
+    """
+    chars = np.frombuffer(padded.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(chars) < 3:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+
+    # Code points fit in 21 bits
+    trigrams = (chars[:-2] << np.uint64(42)) | (chars[1:-1] << np.uint64(21)) | chars[2:]
+    valid = (chars[1:-1] != 32) | (chars[2:] != 32)
+
+    return trigrams, valid
+
+
+class TrigramIndex:
+    """
+    An index of names by their trigrams, which finds
+    names similar to a query even if it is misspelt.
+
+    Each trigram is packed into an integer, and the sorted
+    distinct trigrams are stored in `trigrams`. Postings are stored
+    as compressed sparse rows: the items containing `trigrams[g]`
+    are `indices[indptr[g]:indptr[g + 1]]`. Matches are ranked
+    by the Jaccard similarity of their trigram sets.
+    """
+
+    def __init__(self, items: List[Tuple[int, int, str]]):
+        """
+        :param items: Each item's type, as an index of `SUGGEST_TYPES`, ID and name.
+        """
+        self.kinds = np.array([kind for kind, key, name in items], dtype=np.uint8)
+        self.keys = np.array([key for kind, key, name in items], dtype=np.int64)
+        self.names = [name for kind, key, name in items]
+
+        # Every name is encoded at once. A name always ends in a single
+        # space and starts with two, so no real trigram spans two names.
+        padded = [_pad(name) for name in self.names]
+        trigrams, valid = _encode_trigrams(''.join(padded) + '  ')
+
+        lengths = np.fromiter(map(len, padded), dtype=np.int64, count=len(padded))
+        positions = np.repeat(np.arange(len(items), dtype=np.int32), lengths)
+
+        trigrams, positions = trigrams[valid], positions[valid]
+
+        # Each trigram only counts once per name
+        order = np.lexsort((positions, trigrams))
+        trigrams, positions = trigrams[order], positions[order]
+        distinct = np.ones(len(trigrams), dtype=bool)
+        distinct[1:] = (trigrams[1:] != trigrams[:-1]) | (positions[1:] != positions[:-1])
+        trigrams, positions = trigrams[distinct], positions[distinct]
+
+        self.trigrams, starts = np.unique(trigrams, return_index=True)
+        self.indices = positions
+        self.indptr = np.append(starts, len(positions)).astype(np.int64)
+        self.counts = np.bincount(positions, minlength=len(items)).astype(np.int32)
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, query: str, limit: int, min_score: float = 0.2) -> List[Tuple[int, int, str, float]]:
+        """
+        :param query: The text to search for, which may be partly typed.
+        :param limit: The most matches to return.
+        :param min_score: The lowest similarity to return, from 0 to 1.
+        :return: The type, ID, name and similarity of each match, best first.
+        """
+        trigrams, valid = _encode_trigrams(_pad(query, partial=True))
+        trigrams = np.unique(trigrams[valid])
+        if not len(trigrams) or not len(self.trigrams):
+            return []
+
+        found = np.minimum(np.searchsorted(self.trigrams, trigrams), len(self.trigrams) - 1)
+        found = found[self.trigrams[found] == trigrams]
+        if not len(found):
+            return []
+
+        postings = np.concatenate([self.indices[self.indptr[i]:self.indptr[i + 1]] for i in found])
+        hits = np.bincount(postings, minlength=len(self))
+
+        candidates = np.flatnonzero(hits)
+        shared = hits[candidates]
+        scores = shared / (len(trigrams) + self.counts[candidates] - shared)
+
+        if len(candidates) > limit:
+            best = np.argpartition(-scores, limit)[:limit]
+            candidates, scores = candidates[best], scores[best]
+
+        order = np.argsort(-scores, kind='stable')
+        return [(int(self.kinds[i]), int(self.keys[i]), self.names[i], float(score))
+                for i, score in zip(candidates[order], scores[order]) if score >= min_score]
+
+
+class _SuggestionCache:
+    """
+    Holds the trigram index, rebuilding it in the background
+    whenever the catalog signature changes.
+    """
+
+    def __init__(self):
+        self.index: Optional[TrigramIndex] = None
+        self.signature = None
+
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self._rebuilding = False
+
+    def load(self):
+        with self._lock:
+            if self.index is None:
+                self.signature = get_catalog_signature()
+                self.index = build_suggestion_index()
+                self._checked_at = time.monotonic()
+
+    def get(self, check_interval: float) -> TrigramIndex:
+        if self.index is None:
+            self.load()
+        elif time.monotonic() - self._checked_at >= check_interval:
+            self._checked_at = time.monotonic()
+            signature = get_catalog_signature()
+            if signature != self.signature and not self._rebuilding:
+                self._rebuilding = True
+                threading.Thread(target=self._rebuild, args=(_get_app(), signature), daemon=True).start()
+
+        return self.index
+
+    def _rebuild(self, app, signature):
+        try:
+            with app.app_context():
+                index = build_suggestion_index()
+            self.index, self.signature = index, signature
+        finally:
+            self._rebuilding = False
+
+
+def _get_app():
+    from flask import current_app
+    return current_app._get_current_object()
+
+
+_cache = _SuggestionCache()
+
+
+def build_suggestion_index() -> TrigramIndex:
+    """
+    :return: A trigram index of every artist, album and track name.
+    """
+    items = []
+    for kind, model in enumerate(SUGGEST_MODELS):
+        items += [(kind, key, name) for key, name in db.session.query(model.id, model.name)]
+
+    db.session.commit()
+    return TrigramIndex(items)
+
+
+def load_suggestions():
+    """
+    Builds the suggestion index now rather than on first use.
+    Called before the server forks its workers, so they share
+    the index instead of each building their own.
+    """
+    _cache.load()
+
+
+def get_suggestions(query: str, limit: int, check_interval: float = 30) -> List[dict]:
+    """
+    Finds the names most similar to a query, tolerating typos.
+
+    The index is built by `load_suggestions`, or on first use,
+    then rebuilt in the background when the catalog is seen
+    to have changed. Until then, the previous index is used.
+
+    :param query: The text to search for, which may be partly typed.
+    :param limit: The most suggestions to return.
+    :param check_interval: The minimum number of seconds between
+    checks of whether the catalog has changed.
+    :return: A dictionary of the type, ID, name and score of each suggestion.
+    """
+    index = _cache.get(check_interval)
+    return [{'type': SUGGEST_TYPES[kind], 'id': key, 'name': name, 'score': round(score, 3)}
+            for kind, key, name, score in index.search(query, limit)]
@@ -0,0 +1,115 @@
+import time
+from typing import Dict, Optional, Tuple, Union
+
+from flask_login import UserMixin
+
+from .db import Permission
+from .models import User
+from .queries import get_user_by_id, get_user_by_api_key
+
+# Cached users by ID, and user IDs by API key, each with the time they expire.
+# Every worker process has its own cache, so a change made by one worker
+# is seen by the others once their entries expire.
+_users: Dict[int, Tuple[float, 'CachedUser']] = {}
+_api_keys: Dict[str, Tuple[float, int]] = {}
+
+
+class CachedUser(UserMixin):
+    """
+    A read-only copy of a user, detached from the database session,
+    which is used as the logged in user so that authenticating
+    a request does not need to query the database.
+
+    Permissions are packed into a bit mask, one bit for each
+    `Permission`, so checking one is a single bitwise operation.
+    """
+
+    def __init__(self, user: User):
+        self.id = user.id
+        self.username = user.username
+        self.api_key = user.api_key
+        self.lastfm_username = user.lastfm_username
+        self.is_admin = bool(user.is_admin)
+
+        self.permissions = 0
+        for permission in Permission:
+            if getattr(user, permission.name):
+                self.permissions |= 1 << permission.value
+
+    def __repr__(self):
+        return "<%d - %s>" % (self.id, self.username)
+
+    def __getattr__(self, name: str):
+        # Templates read each permission as an attribute
+        if name in Permission.__members__:
+            return self.has_permission(Permission[name])
+
+        raise AttributeError(name)
+
+    def has_permission(self, permission: Permission) -> bool:
+        return bool(self.permissions >> permission.value & 1)
+
+
+def _cache_user(user: Optional[User], ttl: float) -> Optional[CachedUser]:
+    if not user:
+        return None
+
+    cached = CachedUser(user)
+    expires = time.monotonic() + ttl
+    _users[cached.id] = expires, cached
+    if cached.api_key:
+        _api_keys[cached.api_key] = expires, cached.id
+
+    return cached
+
+
+def get_cached_user(key: Union[str, int], ttl: float = 30) -> Optional[CachedUser]:
+    """
+    Gets a user by ID, from the cache if it holds
+    an unexpired copy, otherwise from the database.
+
+    :param key: The ID of the user.
+    :param ttl: The number of seconds to cache the user for.
+    :return: The user, or None if there is no user with that ID
+    or they have been deleted.
+    """
+    if not str(key).isdigit():
+        return None
+
+    entry = _users.get(int(key))
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+
+    return _cache_user(get_user_by_id(int(key)), ttl)
+
+
+def get_cached_user_by_api_key(api_key: str, ttl: float = 30) -> Optional[CachedUser]:
+    """
+    Gets a user by API key, from the cache if it holds
+    an unexpired copy, otherwise from the database.
+
+    :param api_key: The API key of the user.
+    :param ttl: The number of seconds to cache the user for.
+    :return: The user, or None if no user has that API key
+    or they have been deleted.
+    """
+    entry = _api_keys.get(api_key)
+    if entry and entry[0] > time.monotonic():
+        user = _users.get(entry[1])
+        if user and user[0] > time.monotonic():
+            return user[1]
+
+    user = get_user_by_api_key(api_key)
+    return _cache_user(user if user and not user.is_deleted else None, ttl)
+
+
+def invalidate_user(key: Union[str, int]):
+    """
+    Removes a user from this worker's cache,
+    so that they are next loaded from the database.
+
+    :param key: The ID of the user.
+    """
+    entry = _users.pop(int(key), None)
+    if entry and entry[1].api_key:
+        _api_keys.pop(entry[1].api_key, None)
@@ -11,6 +11,12 @@ default_settings = {
             "music_library_section": "Music",
             "movies_library_section": "Movies",
             "tv_library_section": "Television",
+            "container_size": 1000,
+            "fetch_workers": 8,
+            "alerts": {
+                "debounce": 5,
+                "max_delay": 30
+            },
             "search_results": {
                 "music": {
                     "artist": 10,
@@ -23,10 +29,58 @@ default_settings = {
             "enable": False,
             "hostname": "localhost",
             "port": 6600
+        },
+        "filesystem": {
+            "enable": False,
+            "extensions": ["aac", "aiff", "alac", "ape", "flac", "m4a", "mp3", "mpc", "ogg", "opus", "wav", "wma",
+                           "wv"],
+            "workers": 0
         }
     },
     "music_library": "",  # TODO Make sure this always ends in a /
     "database": "sqlite:///etc/pmv/pmv.db",
+    "database_pool": {
+        "size": 5,
+        "max_overflow": 5,
+        "timeout": 10,
+        "recycle": 3600,
+        "pre_ping": True
+    },
+    "sqlite": {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "busy_timeout": 10000,
+        "cache_size": -65536,
+        "mmap_size": 268435456
+    },
+    "ingest": {
+        "batch_size": 500,
+        "probe_workers": 8,
+        "probe_processes": False,
+        "progress_interval": 10
+    },
+    "auth_cache": {
+        "ttl": 30
+    },
+    "pagination": {
+        "page_size": 100,
+        "max_page_size": 500
+    },
+    "suggest": {
+        "limit": 10,
+        "check_interval": 30
+    },
+    "query_stats": {
+        "enable": True,
+        "n_plus_one_threshold": 5,
+        "headers": False
+    },
+    "catalog_snapshot": {
+        "enable": True,
+        "path": "/etc/pmv/catalog.snapshot",
+        "check_interval": 5,
+        "watch_delay": 30
+    },
     "genius_api": "",
     "colors": {
         "text_dark": "#111111",
@@ -66,13 +120,22 @@ default_settings = {
 
 
 def set_missing_as_default(settings: dict):
-    for setting in default_settings:
-        if setting not in settings:
-            settings[setting] = default_settings[setting]
-
+    _set_missing(settings, default_settings)
     write_settings(settings)
 
 
+def _set_missing(settings: dict, defaults: dict):
+    """
+    Recursively copies any keys missing from the settings,
+    so that new nested settings are added to existing files.
+    """
+    for setting in defaults:
+        if setting not in settings:
+            settings[setting] = defaults[setting]
+        elif isinstance(defaults[setting], dict) and isinstance(settings[setting], dict):
+            _set_missing(settings[setting], defaults[setting])
+
+
 def write_settings(settings: dict):
     with open('/etc/pmv/settings.json', 'w') as f:
         f.write(dumps(settings, indent=2))
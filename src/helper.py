@@ -2,6 +2,9 @@ import math
 import string
 from _md5 import md5
 import secrets
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
 import database as db
 from flask import abort, Response
 
@@ -68,3 +71,34 @@ def generate_album_hash(name: str, artist: str) -> int:
 
 def generate_track_hash(name: str, album: str, artist: str, relative_path: str) -> int:
     return get_numbers(md5(('%s%s%s%s' % (name, album, artist, relative_path)).encode('utf8')).hexdigest())
+
+
+def generate_path_hash(relative_path: str) -> int:
+    # 63 bits, so that paths in even a very large library are unlikely
+    # to collide, while still fitting in a signed 64-bit column
+    return int(md5(relative_path.encode('utf8')).hexdigest()[:16], 16) >> 1
+
+
+def map_concurrently(func: Callable, items: Iterable, workers: int, executor_type=ThreadPoolExecutor) -> Iterator:
+    """
+    Calls a function on each item using a pool of workers,
+    yielding the results in the same order as the items.
+
+    At most twice as many items as there are workers are in
+    flight at once, so the items may be an unbounded stream.
+
+    :param func: The function to call on each item.
+    :param items: An iterable of items.
+    :param workers: The maximum number of concurrent calls.
+    :param executor_type: The executor to run the pool with.
+    :return: An iterator of results.
+    """
+    with executor_type(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
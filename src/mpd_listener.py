@@ -0,0 +1,50 @@
+import logging
+import time
+
+import mpd
+
+from PersistentMPDClient import PersistentMPDClient
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before reconnecting after losing MPD
+RECONNECT_DELAY = 5
+
+
+def watch(settings: dict):
+    """
+    Waits for MPD to report changes to its database and applies them
+    until interrupted. Any changes made while nothing was watching
+    are synced first. Must be called inside an app context.
+
+    :param settings: The global settings dictionary.
+    """
+    import database as db
+
+    mpd_settings = settings['backends']['mpd']
+    client = PersistentMPDClient(host=mpd_settings['hostname'], port=mpd_settings['port'])
+
+    logger.info("Starting MPD database watcher.")
+
+    try:
+        while True:
+            try:
+                changed = db.sync_mpd_database(client)
+                logger.debug("Synced %d changed MPD directories." % changed)
+            except (mpd.ConnectionError, OSError):
+                logger.warning("Lost connection to MPD while syncing.")
+                db.session().rollback()
+                time.sleep(RECONNECT_DELAY)
+                continue
+            except Exception:
+                logger.exception("Failed to sync the MPD database.")
+                db.session().rollback()
+
+            try:
+                # Blocks until an update has finished changing the database
+                client.idle('database')
+            except (mpd.ConnectionError, OSError):
+                logger.warning("Lost connection to MPD, reconnecting.")
+                time.sleep(RECONNECT_DELAY)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Plex library types which are synced
+SYNCED_TYPES = [8, 9, 10]  # Artist, album, track
+
+# Timeline entry states
+STATE_DELETED = 9
+
+
+class UpdateQueue:
+    """
+    A queue of library items waiting to be synced.
+
+    Repeated events for the same item are merged into one.
+    Items are only handed out once no new events have arrived
+    for `debounce` seconds, or `max_delay` seconds after the oldest
+    waiting event, so a burst of events becomes a single batch.
+    """
+
+    def __init__(self, debounce: float = 5, max_delay: float = 30, batch_size: int = 500):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+
+        self._items: Dict[int, bool] = OrderedDict()
+        self._condition = threading.Condition()
+        self._first_event = 0
+        self._last_event = 0
+
+    def put(self, key: int, deleted: bool):
+        """
+        Adds an item to the queue.
+        The latest event for an item replaces any earlier one.
+
+        :param key: The rating key of the item.
+        :param deleted: Whether the item was deleted.
+        """
+        with self._condition:
+            now = time.monotonic()
+            if not self._items:
+                self._first_event = now
+            self._last_event = now
+
+            self._items.pop(key, None)
+            self._items[key] = deleted
+            self._condition.notify()
+
+    def get_batch(self) -> Dict[int, bool]:
+        """
+        Blocks until a batch of items is ready.
+
+        :return: A dictionary of rating key to whether the item was deleted.
+        """
+        with self._condition:
+            while True:
+                if not self._items:
+                    self._condition.wait()
+                    continue
+
+                now = time.monotonic()
+                wait = min(self._last_event + self.debounce, self._first_event + self.max_delay) - now
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+
+                batch = OrderedDict()
+                while self._items and len(batch) < self.batch_size:
+                    key, deleted = self._items.popitem(last=False)
+                    batch[key] = deleted
+
+                # Anything left over is ready straight away
+                self._first_event = self._last_event = now - self.max_delay
+                return batch
+
+
+def parse_alert(msg: dict, section_id: int) -> Tuple[Tuple[int, bool], ...]:
+    """
+    Gets the items affected by a Plex alert.
+
+    :param msg: The alert, as passed to the alert listener callback.
+    :param section_id: The ID of the music library section.
+    :return: A tuple of each affected item's rating key and whether it was deleted.
+    """
+    if msg.get('type') != 'timeline':
+        return ()
+
+    items = []
+    for entry in msg.get('TimelineEntry', []):
+        if entry.get('identifier') != 'com.plexapp.plugins.library':
+            continue
+
+        if int(entry.get('sectionID', -1)) != section_id or int(entry.get('type', -1)) not in SYNCED_TYPES:
+            continue
+
+        deleted = int(entry.get('state', -1)) == STATE_DELETED or entry.get('metadataState') == 'deleted'
+        items.append((int(entry['itemID']), deleted))
+
+    return tuple(items)
+
+
+def watch(plex, music, settings: dict):
+    """
+    Listens for Plex alerts and applies them to the database
+    until interrupted. Must be called inside an app context.
+
+    :param plex: The Plex server.
+    :param music: The music library section.
+    :param settings: The global settings dictionary.
+    """
+    import database as db
+
+    alert_settings = settings['backends']['plex']['alerts']
+    queue = UpdateQueue(alert_settings['debounce'], alert_settings['max_delay'], settings['ingest']['batch_size'])
+
+    def listen(msg):
+        for key, deleted in parse_alert(msg, int(music.key)):
+            queue.put(key, deleted)
+
+    logger.info("Starting Plex alert listener.")
+    notifier = plex.startAlertListener(listen)
+
+    try:
+        while True:
+            batch = queue.get_batch()
+            logger.debug("Syncing %d items from Plex alerts." % len(batch))
+
+            try:
+                db.sync_plex_items([key for key, deleted in batch.items() if not deleted],
+                                   [key for key, deleted in batch.items() if deleted])
+            except Exception:
+                logger.exception("Failed to sync items from Plex alerts.")
+                db.session().rollback()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        notifier.stop()
@@ -1,17 +1,16 @@
 import argparse
 import base64
 import logging
-import sched
+import os
 import sys
-import time
 from logging import handlers
-from multiprocessing import Manager
 
 from flask import Flask, render_template
 from flask_login import LoginManager
 from musicbrainzngs import musicbrainz
 from plexapi.server import PlexServer
-from simplejson import load
+import requests
+from simplejson import load, dumps
 
 import defaults
 import routes
@@ -57,10 +56,6 @@ def get_song_lyrics(track):
 
 app.jinja_env.globals.update(lyrics=get_song_lyrics)
 
-manager = Manager()
-_update_stack = manager.list()
-
-
 # Load settings
 try:
     logger.info("Loading settings from file...")
@@ -76,9 +71,18 @@ logger.setLevel(settings['log_level'])
 logger.debug('Creating database engine')
 app.config['SQLALCHEMY_DATABASE_URI'] = settings['database']
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init(app)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = db.get_engine_options(settings['database'], settings['database_pool'])
+db.init(app, settings['sqlite'])
+
+# Workers share the snapshot and the suggestion index, so both are built before they are forked
+with app.app_context():
+    if settings['catalog_snapshot']['enable']:
+        db.update_catalog_snapshot(settings['catalog_snapshot']['path'])
+
+    db.load_suggestions()
 
 app.config.update(SECRET_KEY=settings['secret_key'])
+db.init_query_stats(app, settings['query_stats'])
 
 if settings['backends']['plex']['server_token']:
     logger.info("Using Plex backend.")
@@ -86,8 +90,11 @@ if settings['backends']['plex']['server_token']:
     music = plex.library.section(settings['backends']['plex']['music_library_section'])
     settings['musicLibrary'] = music.locations[0]
 
-    logger.debug("Starting plex alert listener.")
-    # plex.startAlertListener(listen)  # TODO Fix alert listener
+    def reset_plex_session():
+        # Forked workers must not share the parent's HTTP connections
+        plex._session = requests.Session()
+
+    os.register_at_fork(after_in_child=reset_plex_session)
 
 # Login manager configuration
 logger.debug("Creating login manager.")
@@ -115,7 +122,7 @@ def request_loader(req):
     # Attempt login via URL arg
     api_key = req.args.get('api_key')
     if api_key:
-        user = db.get_user_by_api_key(api_key)
+        user = db.get_cached_user_by_api_key(api_key, settings['auth_cache']['ttl'])
         if user:
             return user
 
@@ -123,7 +130,7 @@ def request_loader(req):
     api_key = req.headers.get('Authorization')
     if api_key:
         api_key = api_key.replace('Basic ', '', 1)
-        user = db.get_user_by_api_key(api_key)
+        user = db.get_cached_user_by_api_key(api_key, settings['auth_cache']['ttl'])
         if user:
             return user
 
@@ -131,114 +138,82 @@ def request_loader(req):
 
 
 @login_manager.user_loader
-def get_user(username):
-    return db.get_user(username)
-
-
-# def delete_entry(entry):
-#     table = db.get_table_for(entry['type'])
-#     db.delete(table, condition=db.Value('library_key', entry['library_key']))
-#
-#
-# def process_update_stack(update_stack):  # TODO Fix updating when stack changes size during update
-#     # print(update_stack)
-#     for entry in update_stack:
-#         # print(entry)
-#         try:
-#             item = ph.get_by_key(entry['library_key'])
-#             do_recursive_db_update(ph.wrap(item))
-#         except NotFound:
-#             delete_entry(entry)
-#
-#     update_stack[:] = []
+def get_user(key):
+    return db.get_cached_user(key, settings['auth_cache']['ttl'])
 
 
 # --START OF PROGRAM--
 if __name__ == "__main__":
-    scheduler = sched.scheduler(time.time)
     parser = argparse.ArgumentParser()
     parser.add_argument('-u', '--update', action='store_true', help='Update the database and exit')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='With --update, continue from the checkpoint of an interrupted update')
+    parser.add_argument('-d', '--delta', action='store_true',
+                        help='With --update, only sync Plex items changed since the last sync')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Keep the database in sync with live Plex alerts and MPD database changes '
+                             'until interrupted')
+    parser.add_argument('-s', '--summary', metavar='FILE',
+                        help='With --update, write the JSON ingest summary to a file rather than stdout')
+    parser.add_argument('-e', '--explain', action='store_true',
+                        help='Check that the queries made by each route use an index and exit')
     parser.add_argument('-l', '--list-routes', action='store_true', help='Dump all the Flask routes and exit')
 
     args = parser.parse_args()
 
     if args.update:
         with app.app_context():
-            db.init(app)
+            db.init(app, settings['sqlite'])
             if settings['backends']['plex']['enable']:
-                db.populate_db_from_plex()
+                if args.delta:
+                    db.populate_db_from_plex_delta()
+                else:
+                    db.populate_db_from_plex(args.resume)
             if settings['backends']['mpd']['enable']:
-                db.populate_db_from_mpd()
+                db.populate_db_from_mpd(args.resume)
+            elif settings['backends']['filesystem']['enable']:
+                # Both read the same library, so would remove each other's tracks
+                db.populate_db_from_filesystem(args.resume)
+
+            summary = dumps(db.get_ingest_summaries(), indent=2)
+            if args.summary:
+                with open(args.summary, 'w') as f:
+                    f.write(summary)
+            else:
+                print(summary)
             sys.exit()
+    elif args.watch:
+        import threading
+
+        import mpd_listener
+        import plex_listener
+
+        def watch_mpd():
+            with app.app_context():
+                mpd_listener.watch(settings)
+
+        watch_plex = settings['backends']['plex']['enable']
+        if watch_plex and not settings['backends']['plex']['server_token']:
+            print("Plex is enabled but has no server token, so its alerts cannot be watched")
+            sys.exit(1)
+
+        if settings['backends']['mpd']['enable']:
+            if watch_plex:
+                threading.Thread(target=watch_mpd, daemon=True).start()
+            else:
+                watch_mpd()
+
+        if watch_plex:
+            with app.app_context():
+                plex_listener.watch(plex, music, settings)
+        sys.exit()
+    elif args.explain:
+        with app.app_context():
+            sys.exit(0 if db.check_query_plans() else 1)
     elif args.list_routes:
         with app.app_context():
             for rule in app.url_map.iter_rules():
                 print('%s\t%s\t%s' % (rule.endpoint, rule.rule, rule.methods))
             sys.exit()
 
-    # def run_process_update_stack(update_stack):
-    #     try:
-    #         process_update_stack(update_stack)
-    #     finally:
-    #         scheduler.enter(10, 1, run_process_update_stack, (update_stack,))
-    #
-    #
-    # def run_scheduler(update_stack):
-    #     run_process_update_stack(update_stack)
-    #     scheduler.run()
-
-    # flask = Process(target=app.run, args=(None, None, debug))
-    # db_updater = Process(target=run_scheduler, args=(_update_stack,))
-
-    # flask.start()
-    #  db_updater.start()
-
-    # flask.join()
-    # db_updater.join()
     app.run(debug=False)
-
-    # db_updater.join()
-
-# OLD PLEX EVENT LISTENER
-# def trigger_database_update():
-#     cache = db.get_cache()
-#     if len(cache) > 0:
-#         db.update_after_refresh(cache)
-#         db.clear_cache()
-
-
-# def listen(msg):
-#     if msg['type'] == 'timeline':
-#         timeline_entry = msg['TimelineEntry'][0]
-#
-#         # item = ph.get_by_key(timeline_entry['itemID'])
-#         # type = ph.Type(timeline_entry['type']).name
-#
-#         # _update_stack.append({item: type})
-#
-#         # print(msg)
-#
-#         state = timeline_entry['metadataState']
-#
-#         data = {
-#             'section_id': timeline_entry['sectionID'],
-#             'library_key': timeline_entry['itemID'],
-#             'type': ph.Type(timeline_entry['type']),
-#             # 'deleted': state == 'deleted',
-#         }
-#
-#         # print(data)
-#
-#         if data not in _update_stack:
-#             _update_stack.append(data)
-#
-#         print(_update_stack)
-#     #
-#     #     db.update_after_refresh([data])
-#     #
-#     #     if 'updatedAt' in timeline_entry:
-#     #
-#     #
-#     elif msg['type'] == 'backgroundProcessingQueue':
-#         update_database()
-#
@@ -0,0 +1,148 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from hashlib import md5
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+import mutagen
+
+import helper
+
+
+def get_tag_digest(tags) -> str:
+    """
+    :return: A digest of every tag on a file,
+    which changes whenever any tag is edited.
+    """
+    if not tags:
+        return ''
+
+    pairs = sorted((str(key), str(value)) for key, value in tags.items())
+    return md5(repr(pairs).encode('utf8')).hexdigest()
+
+
+# Tags read by `read_tags`, as named by mutagen's easy interfaces
+TAG_KEYS = ['title', 'artist', 'album', 'date', 'genre', 'tracknumber', 'discnumber']
+
+
+def read_tags(tags) -> Dict[str, Any]:
+    """
+    Reads the common tags from a file's easy tags.
+
+    :param tags: The tags of a file opened using `mutagen.File(path, easy=True)`.
+    :return: A dictionary of each tag present to its first value,
+    except for genre which is a list of every value.
+    """
+    if not tags:
+        return {}
+
+    values = {}
+    for key in TAG_KEYS:
+        try:
+            value = tags[key]
+        except (KeyError, ValueError):
+            continue
+
+        if not value:
+            continue
+
+        if key == 'genre':
+            values[key] = [str(genre) for genre in value]
+        elif key in ['tracknumber', 'discnumber']:
+            # Often stored as "number/total"
+            number = str(value[0]).partition('/')[0].strip()
+            if number.isdigit():
+                values[key] = int(number)
+        else:
+            values[key] = str(value[0])
+
+    return values
+
+
+def probe_file(full_path: str, cached: dict = None, with_tags: bool = False) -> dict:
+    """
+    Reads the audio properties of a file.
+
+    If the file's size and modification time match
+    the cached result, the file is not opened.
+
+    :param full_path: The absolute path to the file.
+    :param cached: The result of the last probe of this file, if any.
+    :param with_tags: If true, also reads the file's tags using `read_tags`.
+    :return: A dictionary of the bitrate, duration, size, format,
+    modification time and tag digest, and whether it came from the cache.
+    """
+    stat = os.stat(full_path)
+    if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+        return dict(cached, cached=True)
+
+    audio = mutagen.File(full_path, easy=with_tags)
+    if audio is None:
+        raise mutagen.MutagenError("Unknown file type")
+
+    probed = {
+        'id': cached['id'] if cached else None,
+        'bitrate': audio.info.bitrate / 1000,  # Store bitrate in kbps
+        'duration': audio.info.length * 1000,  # Store time in ms
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'format': full_path.rpartition('.')[-1].lower(),
+        'tag_digest': get_tag_digest(audio.tags),
+        'cached': False
+    }
+
+    if with_tags:
+        probed['tags'] = read_tags(audio.tags)
+
+    return probed
+
+
+def _probe_request(request: Optional[Tuple[str, Optional[dict], bool]]) -> Optional[dict]:
+    if not request:
+        return None
+
+    try:
+        return probe_file(*request)
+    except (OSError, mutagen.MutagenError) as e:
+        return {'error': str(e)}
+
+
+def probe_files(items: Iterable[Tuple[Optional[str], Any]], music_library: str, workers: int,
+                use_processes: bool = False, cache: Dict[int, dict] = None,
+                with_tags: bool = False) -> Iterator[Tuple[Any, Optional[dict]]]:
+    """
+    Probes a stream of files using a pool of workers.
+
+    Results are yielded in the same order as the items as soon
+    as they are ready, so they can be inserted while later files
+    are still being read. Only the paths and cached results are
+    sent to the workers; payloads stay in this process.
+
+    :param items: An iterable of each file's path relative to the library
+    and a payload to return with its result. Items with no path are passed
+    straight through with a result of None, which can be used to mark
+    positions in the stream.
+    :param music_library: The path to the music library.
+    :param workers: The number of files to probe at once.
+    :param use_processes: If true, probe in a process pool rather than
+    a thread pool, for when parsing rather than I/O is the bottleneck.
+    :param cache: A dictionary of path hash to the last probe result
+    for that file, as returned by `database.get_probe_cache`.
+    :param with_tags: If true, also reads the tags of every file which is not cached.
+    :return: An iterator of each item's payload and probe result.
+    Files which cannot be read have a result containing only an error.
+    """
+    cache = cache or {}
+    payloads = deque()
+
+    def requests():
+        for relative_path, payload in items:
+            payloads.append(payload)
+            if relative_path:
+                yield music_library + relative_path, cache.get(helper.generate_path_hash(relative_path)), with_tags
+            else:
+                yield None
+
+    executor_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    for result in helper.map_concurrently(_probe_request, requests(), workers, executor_type):
+        yield payloads.popleft(), result
@@ -1,11 +1,10 @@
-import json
 from functools import wraps
-from flask import jsonify, request, make_response
-from jsonpickle import encode
+from flask import jsonify, request, make_response, render_template, url_for
 from flask_login import login_required
 from werkzeug.local import LocalProxy
 import database as db
 from helper import throw_error, get_current_user
+from .serializers import Serializer, get_serializer, to_json
 
 
 def require_permission(permission: db.Permission,
@@ -49,18 +48,110 @@ def admin_required(func, get_user=get_current_user):
     return admin_wrapper
 
 
-def get_json_response(obj, max_depth: int = 2, append: dict = None):
-    encoded = encode(obj, unpicklable=False, max_depth=max_depth)
+def get_json_response(obj, serializer: Serializer = None, append: dict = None):
+    """
+    :param obj: The object to encode. Models are encoded by their serializer.
+    :param serializer: The serializer for the object itself, if not the default for its model.
+    :param append: Extra keys to add to the encoded object.
+    """
     if append:
-        encoded = json.loads(encoded)
-        for key in append:
-            encoded[key] = append[key]
-        encoded = encode(encoded, unpicklable=False, max_depth=2)
+        serializer = serializer or get_serializer(obj)
+        obj = dict(serializer.to_dict(obj) if serializer else obj, **append)
+        serializer = None
 
-    response = make_response(encoded, 200)
+    response = make_response(to_json(obj, serializer), 200)
     response.mimetype = 'application/json'
     return response
 
 
+def get_id_list(name: str) -> list:
+    """
+    Gets a list of IDs from a JSON body, or from a form as repeated
+    fields or a single comma-separated field.
+
+    :param name: The name of the list.
+    :return: The IDs, in the order given.
+    """
+    if request.is_json:
+        ids = (request.get_json(silent=True) or {}).get(name) or []
+    else:
+        ids = [key for value in request.form.getlist(name) for key in value.split(',') if key.strip()]
+
+    try:
+        return [int(key) for key in ids]
+    except (TypeError, ValueError):
+        throw_error(400, "Invalid <b>%s</b>." % name)
+
+
 def wants_html():
     return 'text/html' in request.accept_mimetypes
+
+
+def wants_fragment():
+    """
+    :return: True if the request was made by a "Load more" button,
+    which only needs the rows of the next page.
+    """
+    return request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+
+
+def get_page(get_page_func, *args):
+    """
+    Gets the page of a listing requested by the `after` and `limit` arguments.
+
+    :param get_page_func: The query function for the listing.
+    :param args: Any arguments to pass before the page arguments.
+    :return: The requested page.
+    """
+    import pmv
+
+    settings = pmv.settings['pagination']
+    limit = max(1, min(request.args.get('limit', settings['page_size'], type=int), settings['max_page_size']))
+
+    try:
+        return get_page_func(*args, after=request.args.get('after'), limit=limit)
+    except db.InvalidCursorError:
+        throw_error(400, "Invalid cursor.")
+
+
+def get_next_page_url(page: db.Page):
+    """
+    :return: The URL of the page after the given page
+    of the current listing, or None if it is the last.
+    """
+    if not page.next_cursor:
+        return None
+
+    args = dict(request.args.items(), after=page.next_cursor, limit=page.limit)
+    return url_for(request.endpoint, **request.view_args, **args, _external=True)
+
+
+def get_page_json_response(page: db.Page, obj=None, **kwargs):
+    """
+    Gets the JSON response for a page of a listing,
+    linking to the next page in the `Link` header.
+
+    :param page: The page.
+    :param obj: The object to encode, if not the items of the page.
+    """
+    response = get_json_response(page.items if obj is None else obj, **kwargs)
+
+    next_url = get_next_page_url(page)
+    if next_url:
+        response.headers['Link'] = '<%s>; rel="next"' % next_url
+
+    return response
+
+
+def render_page(template: str, rows_template: str, page: db.Page, **context):
+    """
+    Renders a page of a listing. The first page renders the whole template,
+    while the "Load more" button only fetches the rows of the next page.
+
+    :param template: The template of the whole page.
+    :param rows_template: The template of the listing's rows.
+    :param page: The page.
+    :param context: The variables to render the templates with.
+    """
+    return render_template(rows_template if wants_fragment() else template, next_url=get_next_page_url(page),
+                           **context)
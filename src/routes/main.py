@@ -1,6 +1,6 @@
 from flask import render_template, redirect, url_for, Blueprint
 import database as db
-from .helpers import admin_required
+from .helpers import admin_required, get_json_response
 
 bp = Blueprint('main', __name__)
 
@@ -27,7 +27,28 @@ def admin():
     import pmv
     routes = [rule for rule in pmv.app.url_map.iter_rules()]
 
-    return render_template('admin.html', title="Admin", users=db.get_users(), routes=routes)
+    return render_template('admin.html', title="Admin", users=db.get_users(), routes=routes, pool=db.get_pool_stats(),
+                           queries=db.get_query_report(), threshold=pmv.settings['query_stats']['n_plus_one_threshold'])
+
+
+@bp.route('/admin/pool')
+@admin_required
+def pool_stats():
+    """
+    :return: The database connection pool of the worker
+    which handled the request, and its checkout wait times.
+    """
+    return get_json_response(db.get_pool_stats())
+
+
+@bp.route('/admin/queries')
+@admin_required
+def query_stats():
+    """
+    :return: The queries made by each endpoint handled by the
+    worker which handled the request, and any N+1 suspects.
+    """
+    return get_json_response(db.get_query_report())
 
 
 # ['__class__', '__delattr__', '__dict__', '__dir__', '__doc__', '__eq__', '__format__', '__ge__',
@@ -29,7 +29,7 @@ def torrent(artist_name, album_name):
 def zip(album_id: int = None, playlist_id: int = None, disc: int = None):
     import pmv
     if album_id:
-        item = db.get_album_by_id(album_id)
+        item = db.get_album_by_id(album_id) if disc else db.get_album_with_tracks(album_id)
         if disc:
             tracks = db.get_album_disc_by_id(album_id, disc)
             filename = "/etc/pmv/zips/%s/%s-%r.zip" % (item.artist_name, item.name, disc)
@@ -37,7 +37,7 @@ def zip(album_id: int = None, playlist_id: int = None, disc: int = None):
             tracks = item.tracks
             filename = "/etc/pmv/zips/%s/%s.zip" % (item.artist_name, item.name)
     else:
-        item = db.get_playlist_by_id(playlist_id)
+        item = db.get_playlist_with_tracks(playlist_id)
         tracks = item.tracks
         filename = "/etc/pmv/zips/playlists/%s/%s.zip" % (item.creator, item.name)
 
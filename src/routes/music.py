@@ -1,14 +1,13 @@
-import datetime
-import operator
-from functools import reduce
 from urllib.parse import unquote
 
 from flask import render_template, redirect, url_for, Blueprint, send_file, request, flash, make_response
 from magic import Magic
 
 import database as db
-from helper import get_current_user
-from .helpers import require_permission, get_json_response, wants_html
+from helper import get_current_user, throw_error
+from . import serializers
+from .helpers import require_permission, get_json_response, wants_html, wants_fragment, get_page, \
+    get_page_json_response, render_page, get_id_list
 
 bp = Blueprint('music', __name__, url_prefix='/music')
 al = Blueprint('album', __name__, url_prefix='/music/album')
@@ -21,21 +20,21 @@ pl = Blueprint('playlist', __name__, url_prefix='/music/playlist')
 @require_permission(db.Permission.music_can_view)
 def artist(artist_id: int = None):
     if artist_id:
-        artist = db.get_artist_by_id(artist_id)
-        albums = artist.albums
-        albums.sort(key=lambda x: x.release_date or datetime.date(datetime.MINYEAR, 1, 1), reverse=True)
+        albums = get_page(db.get_catalog_artist_albums_page, artist_id)
 
         if 'text/html' in request.accept_mimetypes:
-            return_data = render_template('table.html', albums=albums, title=artist.name)
+            title = None if wants_fragment() else db.get_catalog_artist(artist_id).name
+            return_data = render_page('table.html', 'tables/album_rows.html', albums, albums=albums.items,
+                                      title=title)
         else:
-            return_data = get_json_response(albums)
+            return_data = get_page_json_response(albums)
     else:
-        artists = db.get_artists()
-        artists.sort(key=lambda x: x.name_sort)
+        artists = get_page(db.get_catalog_artists_page)
         if wants_html():
-            return_data = render_template('table.html', artists=artists, title="Artists")
+            return_data = render_page('table.html', 'tables/artist_rows.html', artists, artists=artists.items,
+                                      title="Artists")
         else:
-            return_data = get_json_response(artists)
+            return_data = get_page_json_response(artists)
     return return_data
 
 
@@ -43,13 +42,13 @@ def artist(artist_id: int = None):
 @require_permission(db.Permission.music_can_view)
 def album(album_id: int):
     import pmv
-    album = db.get_album_by_id(album_id)
-    tracks = album.tracks
-    tracks = sorted(tracks, key=lambda x: (x.disc_num, x.track_num))
+    album, tracks = db.get_catalog_album_with_tracks(album_id)
+    if not album:
+        throw_error(404, "Album not found.")
 
     if wants_html():
         return render_template('table.html', tracks=tracks, title=album.name, key=album.id, parentKey=album.artist_key,
-                               parentTitle=album.artist_name, settings=pmv.settings, totalSize=album.total_size())
+                               parentTitle=album.artist_name, settings=pmv.settings, totalSize=album.total_size)
     else:
         return get_json_response(tracks)
 
@@ -58,10 +57,9 @@ def album(album_id: int):
 def track(track_id: int):
     import images
     import lyrics
-    track = db.get_track_by_id(track_id)
+    track = db.get_track_with_album(track_id)
 
     playlists = db.get_playlists_by_user(get_current_user())
-    # track.album
 
     banner_colour = images.get_predominant_colour(track.album)
     button_colour = images.get_button_colour(banner_colour)
@@ -73,7 +71,7 @@ def track(track_id: int):
                                lyrics=lyrics.get_song_lyrics(track)
                                .split('\n'), playlists=playlists)
     else:
-        return get_json_response(track, max_depth=1)
+        return get_json_response(track, serializers.TRACK_WITH_ALBUM)
 
 
 @tr.route("/<int:track_id>/file")
@@ -95,27 +93,29 @@ def track_file(track_id: int, download=False):
 @pl.route('/')
 @require_permission(db.Permission.music_can_view)
 def playlists():
-    playlists = db.get_playlists_by_user(get_current_user()) or []
+    playlists = get_page(db.get_playlists_page, get_current_user())
 
     if wants_html():
-        return render_template('playlists.html', playlists=playlists)
+        return render_page('playlists.html', 'components/playlist_rows.html', playlists, playlists=playlists.items)
     else:
-        return get_json_response(playlists)
+        return get_page_json_response(playlists)
 
 
 @pl.route('/<int:playlist_id>')
 @require_permission(db.Permission.music_can_view)
 def playlist(playlist_id: int):
     import pmv
-    playlist = db.get_playlist_by_id(playlist_id)
+    tracks = get_page(db.get_playlist_tracks_page, playlist_id)
+
+    if wants_fragment():
+        return render_page('table.html', 'tables/track_rows.html', tracks, tracks=tracks.items, is_playlist=True)
 
+    playlist = db.get_playlist_by_id(playlist_id)
     if wants_html():
-        return render_template('table.html', tracks=playlist.tracks, title=playlist.name, settings=pmv.settings,
-                               is_playlist=True, key=playlist_id,
-                               totalSize=reduce(operator.add, [track.size for track in playlist.tracks]))
+        return render_page('table.html', 'tables/track_rows.html', tracks, tracks=tracks.items, title=playlist.name,
+                           settings=pmv.settings, is_playlist=True, key=playlist_id, totalSize=playlist.total_size)
     else:
-        tracks = [*map(lambda x: x.id, playlist.tracks)]
-        return get_json_response(playlist, max_depth=1, append={'tracks': tracks})
+        return get_page_json_response(tracks, playlist, append={'tracks': [track.id for track in tracks]})
 
 
 @pl.route('/add/<string:name>', methods=['POST'])
@@ -140,20 +140,82 @@ def add_to_playlist(track_id: int, playlist_id: int = None, playlist_name: str =
         if not playlist_name:
             playlist_name = request.form.get('playlist_name')
         playlist = db.Playlist(name=playlist_name, creator_id=get_current_user().id)
+        db.add_single(playlist)
     else:
-        playlist = db.get_playlist_by_id(playlist_id)
-
-    track = db.get_track_by_id(track_id)
+        playlist = _get_playlist(playlist_id)
 
-    # Check track not already in playlist
-    f = [*filter(lambda track: track.id == track_id, playlist.tracks)]
-    if not f or len(f) == 0:
-        playlist.tracks.append(track)
-        db.session().commit()
+    # Tracks already in the playlist are skipped
+    db.add_tracks_to_playlist(playlist.id, [track_id])
 
     return redirect(request.referrer)
 
 
+def _get_playlist(playlist_id: int) -> db.Playlist:
+    """
+    Gets a playlist to edit, which only its creator or an administrator can do.
+    """
+    playlist = db.get_playlist_by_id(playlist_id)
+    if not playlist:
+        throw_error(404, "Playlist not found.")
+
+    user = get_current_user()
+    if playlist.creator_id != user.id and not user.is_admin:
+        throw_error(403, "Only the creator of a playlist can edit it.")
+
+    return playlist
+
+
+def _get_playlist_edit_response(playlist: db.Playlist, **result):
+    """
+    Redirects a form back to the page it was sent from,
+    or returns the result of an edit along with the playlist's totals.
+    """
+    if wants_html():
+        return redirect(request.referrer or url_for('playlist.playlist', playlist_id=playlist.id))
+
+    return get_json_response(dict(result, playlist_id=playlist.id, track_count=playlist.track_count,
+                                  total_size=playlist.total_size, total_duration=playlist.total_duration))
+
+
+@pl.route('/<int:playlist_id>/tracks', methods=['POST'])
+@require_permission(db.Permission.music_can_view)
+def add_tracks_to_playlist(playlist_id: int):
+    playlist = _get_playlist(playlist_id)
+    added = db.add_tracks_to_playlist(playlist.id, get_id_list('track_ids'))
+    return _get_playlist_edit_response(playlist, added=added)
+
+
+@pl.route('/<int:playlist_id>/album/<int:album_id>', methods=['POST'])
+@require_permission(db.Permission.music_can_view)
+def add_album_to_playlist(playlist_id: int, album_id: int):
+    playlist = _get_playlist(playlist_id)
+    added = db.add_album_to_playlist(playlist.id, album_id)
+    return _get_playlist_edit_response(playlist, added=added)
+
+
+@pl.route('/<int:playlist_id>/tracks/remove', methods=['POST'])
+@require_permission(db.Permission.music_can_view)
+def remove_tracks_from_playlist(playlist_id: int):
+    playlist = _get_playlist(playlist_id)
+    removed = db.remove_tracks_from_playlist(playlist.id, get_id_list('track_ids'))
+    return _get_playlist_edit_response(playlist, removed=removed)
+
+
+@pl.route('/<int:playlist_id>/tracks/move', methods=['POST'])
+@require_permission(db.Permission.music_can_view)
+def move_tracks_in_playlist(playlist_id: int):
+    playlist = _get_playlist(playlist_id)
+
+    data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+    try:
+        position = int(data.get('position', 0))
+    except (TypeError, ValueError):
+        throw_error(400, "Invalid <b>position</b>.")
+
+    tracks = db.move_tracks_in_playlist(playlist.id, get_id_list('track_ids'), position)
+    return _get_playlist_edit_response(playlist, tracks=tracks)
+
+
 @tr.route('/<int:track_id>/lyrics', methods=['GET', 'POST'])
 @require_permission(db.Permission.music_can_edit)
 def lyrics(track_id: int):
@@ -179,24 +241,50 @@ def update_metadata(track_id: int):
     return str(track_id)  # TODO Write metadata updating (local, database, plex)
 
 
+@bp.route("/search/suggest")
+@require_permission(db.Permission.music_can_view)
+def suggest():
+    import pmv
+
+    settings = pmv.settings['suggest']
+    limit = max(1, min(request.args.get('limit', settings['limit'], type=int), 100))
+    return get_json_response(db.get_suggestions(request.args.get('query', ''), limit, settings['check_interval']))
+
+
 @bp.route("/search", methods=['GET', 'POST'])
 @bp.route("/search/<query>", methods=['GET', 'POST'])
 @require_permission(db.Permission.music_can_view)
 def search(query=None, for_artists=True, for_albums=True, for_tracks=True):
+    import pmv
+
     if not query:
         query = request.form.get('query')
 
-    if for_artists:
-        artists = db.get_artists_by_name(query)
+    # A single type of result can be paged through
+    kind = request.args.get('type')
+    if kind:
+        if kind not in db.SEARCH_TYPES:
+            throw_error(400, "Unknown search type <b>%s</b>." % kind)
 
-    if for_albums:
-        albums = db.get_albums_by_name(query)
+        page = get_page(db.search_music_page, query, db.SEARCH_TYPES.index(kind))
+        if wants_html():
+            return render_page('table.html', 'tables/%s_rows.html' % kind, page, **{kind + 's': page.items},
+                               title=query, is_search=True, prev=request.referrer)
+        else:
+            return get_page_json_response(page)
 
-    if for_tracks:
-        tracks = db.get_tracks_by_name(query)
+    limits = pmv.settings['backends']['plex']['search_results']['music']
+    artists, albums, tracks = db.search_music(query,
+                                              limits['artist'] if for_artists else 0,
+                                              limits['album'] if for_albums else 0,
+                                              limits['track'] if for_tracks else 0)
 
     if wants_html():
+        # Full lists may have more results
+        more_urls = {kind: url_for('music.search', query=query, type=kind)
+                     for kind, items in zip(db.SEARCH_TYPES, [artists, albums, tracks])
+                     if items and len(items) == limits[kind]}
         return render_template('table.html', artists=artists, albums=albums, tracks=tracks, title=query,
-                               is_search=True, prev=request.referrer)
+                               is_search=True, prev=request.referrer, more_urls=more_urls)
     else:
-        return get_json_response({'artists': artists, 'albums': albums, 'tracks': tracks}, max_depth=3)
+        return get_json_response({'artists': artists, 'albums': albums, 'tracks': tracks})
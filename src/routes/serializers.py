@@ -0,0 +1,127 @@
+import datetime
+import json
+from operator import attrgetter
+from typing import Dict, Optional
+
+import numpy as np
+
+import database as db
+
+
+class Serializer:
+    """
+    Turns a model into a dictionary of its declared fields.
+
+    Only the declared fields are read, so the output never depends on
+    which relationships happen to be loaded, and nothing is lazily loaded
+    unless a nested serializer asks for it.
+    """
+
+    def __init__(self, *fields: str, **nested: 'Serializer'):
+        """
+        :param fields: The attributes to include.
+        :param nested: Related objects to include, and the serializer
+        of each. A list of related objects is serialized item by item.
+        """
+        self.fields = fields
+        self.nested = nested
+
+        # Reads every field in one call, always as a tuple
+        getter = attrgetter(*fields) if fields else lambda obj: ()
+        self._get = getter if len(fields) != 1 else lambda obj: (getter(obj),)
+
+    def extend(self, *fields: str, **nested: 'Serializer') -> 'Serializer':
+        """
+        :return: A serializer with these fields as well as this one's.
+        """
+        return Serializer(*self.fields, *fields, **dict(self.nested, **nested))
+
+    def to_dict(self, obj) -> dict:
+        values = dict(zip(self.fields, self._get(obj)))
+
+        for field, serializer in self.nested.items():
+            value = getattr(obj, field)
+            if value is None:
+                values[field] = None
+            elif isinstance(value, (list, tuple)):
+                values[field] = [serializer.to_dict(item) for item in value]
+            else:
+                values[field] = serializer.to_dict(value)
+
+        return values
+
+
+ARTIST = Serializer('id', 'name', 'name_sort', 'album_count', 'track_count', 'plex_id', 'plex_thumb')
+
+ALBUM = Serializer('id', 'name', 'name_sort', 'artist_key', 'artist_name', 'release_date', 'genres',
+                   'track_count', 'disc_count', 'total_size', 'total_duration', 'plex_id', 'plex_thumb')
+
+TRACK = Serializer('id', 'name', 'name_sort', 'artist_key', 'artist_name', 'album_key', 'album_name',
+                   'duration', 'track_num', 'disc_num', 'download_url', 'bitrate', 'size', 'format', 'plex_id')
+
+TRACK_WITH_ALBUM = TRACK.extend(album=ALBUM)
+
+PLAYLIST = Serializer('id', 'name', 'creator_id', 'track_count', 'total_size', 'total_duration')
+
+# Never includes the password or API key
+USER = Serializer('id', 'username', 'lastfm_username', 'is_admin', *db.Permission.__members__)
+
+SERIALIZERS: Dict[type, Serializer] = {
+    db.Artist: ARTIST,
+    db.Album: ALBUM,
+    db.Track: TRACK,
+    db.Playlist: PLAYLIST,
+    db.User: USER,
+    db.CachedUser: USER
+}
+
+# Rows of the catalog snapshot, by their table
+SNAPSHOT_SERIALIZERS: Dict[str, Serializer] = {
+    'artists': ARTIST,
+    'albums': ALBUM,
+    'tracks': TRACK
+}
+
+
+def get_serializer(obj) -> Optional[Serializer]:
+    """
+    :return: The serializer for the object, or None if it is not a model.
+    """
+    if isinstance(obj, db.CatalogRow):
+        return SNAPSHOT_SERIALIZERS[obj.table]
+
+    return SERIALIZERS.get(type(obj))
+
+
+def _default(obj):
+    """
+    Serializes the values the JSON encoder does not know.
+    """
+    serializer = get_serializer(obj)
+    if serializer:
+        return serializer.to_dict(obj)
+    elif isinstance(obj, datetime.date):
+        return obj.isoformat()
+    elif isinstance(obj, db.Page):
+        return obj.items
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, (set, frozenset)):
+        return list(obj)
+
+    raise TypeError("Cannot serialize %s" % type(obj).__name__)
+
+
+def to_json(obj, serializer: Serializer = None) -> bytes:
+    """
+    Encodes models, and lists and dictionaries of them, as JSON.
+
+    :param obj: The object to encode.
+    :param serializer: The serializer for the object itself,
+    if not the default for its model.
+    :return: The encoded JSON.
+    """
+    if serializer:
+        obj = serializer.to_dict(obj)
+
+    return json.dumps(obj, default=_default, separators=(',', ':')).encode()
@@ -11,14 +11,13 @@ bp = Blueprint('users', __name__)
 
 @bp.route("/login", methods=['GET', 'POST'])
 def login():
-    import pmv
     display_flash = False
 
     if request.method == 'POST':
         username = request.form.get('username').lower()
         password = request.form.get('password')
         remember = request.form.get('remember') is not None
-        user = pmv.get_user(username)
+        user = db.get_user(username)
 
         if user:
             if check_password_hash(user.password, password):
@@ -36,7 +35,6 @@ def login():
 
 @bp.route('/signup', methods=['POST'])
 def sign_up():
-    import pmv
     username = request.form['username'].lower()
     password = request.form['password']
     remember = request.form.get('remember') is not None
@@ -44,7 +42,7 @@ def sign_up():
     db.add_user(username, generate_password_hash(password))
     # TODO Add some proper validation, redirecting for signup
     # if len(data) == 0:
-    user = pmv.get_user(username)
+    user = db.get_user(username)
     login_user(user, remember)
     return redirect(url_for('main.index'))
     # else:
@@ -116,8 +114,6 @@ def edit_user_by_id(key: int):
 
     db.edit_user_by_id(key, form)
 
-    db.session().commit()
-
     message = "User with ID %r' successfully edited." % key
     if request.method == 'POST':
         flash(message, category='success')
@@ -0,0 +1,10 @@
+// Replaces a "Load more" button with the next page of its listing,
+// which ends with another button if there are more pages after it.
+$(document).on('click', '.load-more button', function () {
+    let button = $(this);
+    button.prop('disabled', true);
+
+    $.get(button.data('url'))
+        .done(html => button.closest('.load-more').replaceWith(html))
+        .fail(() => button.prop('disabled', false));
+});
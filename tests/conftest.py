@@ -0,0 +1,150 @@
+import copy
+import os
+import sys
+import types
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import database as db  # noqa: E402
+import defaults  # noqa: E402
+
+
+class FakePlexItem(types.SimpleNamespace):
+    """
+    An artist, album or track as listed by plexapi,
+    with only the attributes the populators read.
+    """
+
+    def reload(self):
+        pass
+
+    def iterParts(self):
+        yield types.SimpleNamespace(file=self.file, size=self.size)
+
+    def albums(self):
+        return self.children
+
+    def fetchItems(self, ekey):
+        return [*self.leaves()]
+
+    def leaves(self):
+        for child in self.children:
+            if child.TYPE == 'track':
+                yield child
+            else:
+                yield from child.leaves()
+
+
+class FakePlex:
+    """
+    A Plex server with a single music section,
+    answering the requests the populators make.
+    """
+
+    def __init__(self, library: str):
+        self.library = library
+        self.items = {}
+        self._next_key = 1
+
+    def _add(self, kind: str, title: str, **fields) -> FakePlexItem:
+        key = self._next_key
+        self._next_key += 1
+
+        item = FakePlexItem(TYPE=kind, ratingKey=key, key='/library/metadata/%d' % key, title=title,
+                            titleSort=title, thumb=None, children=[], **fields)
+        self.items[key] = item
+        return item
+
+    def add_artist(self, title: str) -> FakePlexItem:
+        return self._add('artist', title)
+
+    def add_album(self, artist: FakePlexItem, title: str) -> FakePlexItem:
+        album = self._add('album', title, parentRatingKey=artist.ratingKey, year=2000,
+                          genres=[types.SimpleNamespace(tag='rock')], leafCount=0)
+        artist.children.append(album)
+        return album
+
+    def add_track(self, album: FakePlexItem, title: str, size: int = 100) -> FakePlexItem:
+        artist = self.items[album.parentRatingKey]
+        track = self._add('track', title, parentRatingKey=album.ratingKey, grandparentRatingKey=artist.ratingKey,
+                          parentTitle=album.title, grandparentTitle=artist.title, duration=1000,
+                          index=len(album.children) + 1, parentIndex=1, size=size,
+                          media=[types.SimpleNamespace(bitrate=320, audioCodec='mp3')])
+        track.file = self.library + '%s/%s/%s.mp3' % (artist.title, album.title, title)
+        album.children.append(track)
+        album.leafCount += 1
+        return track
+
+    def rename(self, item: FakePlexItem, title: str):
+        """
+        Renames an item, updating the titles its tracks list it under.
+        """
+        item.title = item.titleSort = title
+        for track in item.leaves() if item.TYPE != 'track' else []:
+            if item.TYPE == 'album':
+                track.parentTitle = title
+            else:
+                track.grandparentTitle = title
+
+    def fetchItems(self, ekey: str, container_start: int = 0, container_size: int = None, maxresults: int = None):
+        if ekey.startswith('/library/metadata/'):
+            keys = [int(key) for key in ekey.rsplit('/', 1)[1].split(',')]
+            return [self.items[key] for key in keys if key in self.items]
+
+        kind = {'type=8': 'artist', 'type=9': 'album', 'type=10': 'track'}[ekey.split('&')[0].split('?')[1]]
+        items = [item for item in self.items.values() if item.TYPE == kind]
+        return items[container_start:container_start + container_size]
+
+
+@pytest.fixture
+def pmv(tmp_path, monkeypatch):
+    """
+    Stands in for the pmv module, which the database
+    package imports lazily for its settings and servers.
+    """
+    module = types.ModuleType('pmv')
+    module.settings = copy.deepcopy(defaults.default_settings)
+    module.settings['music_library'] = str(tmp_path / 'library') + '/'
+    module.settings['catalog_snapshot']['enable'] = False
+    module.settings['ingest']['batch_size'] = 4
+    module.settings['backends']['plex']['container_size'] = 5
+
+    monkeypatch.setitem(sys.modules, 'pmv', module)
+    return module
+
+
+@pytest.fixture
+def database(pmv, tmp_path):
+    """
+    An empty database, with an app context pushed for the test.
+    """
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'pmv.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init(app)
+    pmv.app = app
+
+    with app.app_context():
+        yield app
+        db.session().remove()
+
+
+@pytest.fixture
+def plex(pmv):
+    """
+    A fake Plex server with two artists, each with two albums of three tracks.
+    """
+    server = FakePlex(pmv.settings['music_library'])
+    for i in range(2):
+        artist = server.add_artist('Artist %d' % i)
+        for j in range(2):
+            album = server.add_album(artist, 'Album %d' % j)
+            for k in range(3):
+                server.add_track(album, 'Track %d-%d-%d' % (i, j, k), size=1000 + 100 * i + 10 * j + k)
+
+    pmv.plex = server
+    pmv.music = types.SimpleNamespace(key=3)
+    return server
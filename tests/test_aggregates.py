@@ -0,0 +1,83 @@
+import pytest
+
+import database as db
+
+
+@pytest.fixture
+def catalog(database):
+    session = db.session()
+    for i in range(2):
+        artist = db.Artist(name='Artist %d' % i, hash=i)
+        session.add(artist)
+        session.flush()
+
+        for j in range(2):
+            album = db.Album(name='Album %d' % j, artist_key=artist.id, hash=i * 10 + j)
+            session.add(album)
+            session.flush()
+
+            for k in range(3):
+                session.add(db.Track(name='Track %d' % k, artist_key=artist.id, album_key=album.id,
+                                     disc_num=1 + k // 2, track_num=k + 1, size=100 * (k + 1),
+                                     duration=None if k == 2 else 10, hash=i * 100 + j * 10 + k))
+
+    playlist = db.Playlist(name='Playlist')
+    session.add(playlist)
+    session.commit()
+
+    db.add_tracks_to_playlist(playlist.id, [key for key, in session.query(db.Track.id).filter(db.Track.disc_num == 1)])
+    return playlist.id
+
+
+def _get_aggregates(model, *columns):
+    return [tuple(getattr(row, column) for column in columns)
+            for row in db.session().query(model).order_by(model.id)]
+
+
+def test_recompute(catalog):
+    db.update_album_aggregates()
+    db.update_artist_aggregates()
+    db.update_playlist_aggregates()
+    db.session().commit()
+
+    assert _get_aggregates(db.Album, 'track_count', 'disc_count', 'total_size', 'total_duration') == \
+        [(3, 2, 600, 20)] * 4
+    assert _get_aggregates(db.Artist, 'album_count', 'track_count') == [(2, 6)] * 2
+    assert _get_aggregates(db.Playlist, 'track_count', 'total_size', 'total_duration') == [(8, 1200, 80)]
+
+
+def test_recompute_some(catalog):
+    db.session().query(db.Album).update({db.Album.track_count: 0, db.Album.total_size: 0})
+    db.session().query(db.Artist).update({db.Artist.track_count: 0})
+
+    db.update_album_aggregates([1, 3, None])
+    db.update_artist_aggregates([2])
+    db.session().commit()
+
+    assert _get_aggregates(db.Album, 'track_count', 'total_size') == [(3, 600), (0, 0), (3, 600), (0, 0)]
+    assert _get_aggregates(db.Artist, 'track_count') == [(0,), (6,)]
+
+
+def test_empty(catalog):
+    db.session().execute(db.playlist_track.delete())
+    db.session().query(db.Track).delete()
+    db.update_album_aggregates()
+    db.update_playlist_aggregates()
+    db.session().commit()
+
+    assert _get_aggregates(db.Album, 'track_count', 'disc_count', 'total_size', 'total_duration') == \
+        [(0, 0, 0, 0)] * 4
+    assert _get_aggregates(db.Playlist, 'track_count', 'total_size', 'total_duration') == [(0, 0, 0)]
+
+
+def test_playlist_matches_recompute(catalog):
+    track_keys = [key for key, in db.session().query(db.Track.id).filter(db.Track.disc_num == 2)]
+    db.add_tracks_to_playlist(catalog, track_keys)
+    db.remove_tracks_from_playlist(catalog, track_keys[:2] + [1])
+
+    incremental = _get_aggregates(db.Playlist, 'track_count', 'total_size', 'total_duration')
+    db.update_playlist_aggregates([catalog])
+    db.session().commit()
+
+    assert incremental == _get_aggregates(db.Playlist, 'track_count', 'total_size', 'total_duration') == \
+        [(9, 1700, 70)]
@@ -0,0 +1,18 @@
+import database as db
+
+
+def test_query_plans(database, capsys):
+    assert db.check_query_plans()
+
+    output = capsys.readouterr().out
+    for name, call in db.ROUTE_QUERIES:
+        assert 'OK   ' + name in output
+    assert not any(line.startswith('SCAN ') for line in output.splitlines())
+
+
+def test_unindexed_query_fails(database, monkeypatch, capsys):
+    queries = [("music: artists by substring", lambda: db.get_artists_by_name('a'))]
+    monkeypatch.setattr(db.explain, 'ROUTE_QUERIES', queries)
+
+    assert not db.check_query_plans()
+    assert 'SCAN music: artists by substring' in capsys.readouterr().out
@@ -0,0 +1,211 @@
+import pytest
+
+import database as db
+
+
+def _add(ingest: db.Ingest, number: int, artist: int = 0, size: int = None):
+    """
+    Queues a track, along with its album and artist.
+    """
+    ingest.add_artist(artist, name='Artist %d' % artist)
+    ingest.add_album(artist, artist, name='Album %d' % artist, artist_name='Artist %d' % artist)
+    ingest.add_track(100 + number, artist, artist, name='Track %d' % number, download_url='%d.mp3' % number,
+                     size=size if size is not None else 1000 + number, duration=1000)
+
+
+def _get_track_hashes():
+    return sorted(track_hash for track_hash, in db.session().query(db.Track.hash))
+
+
+def test_batched_hashes(database):
+    ingest = db.Ingest('test', batch_size=2)
+    for number in range(5):
+        _add(ingest, number, artist=number % 2)
+    ingest.commit()
+
+    # Tracks are reported in batches, with some reported twice and one not at all
+    ingest = db.Ingest('test', batch_size=2, preload=False)
+    assert ingest.tracks == {}
+
+    for batch in [[0, 1, 5], [6, 1], [2, 3, 5]]:
+        ingest.load_hashes([number % 2 for number in batch], [number % 2 for number in batch],
+                           [100 + number for number in batch])
+        assert set(ingest.tracks) <= {100 + number for number in batch}
+
+        for number in batch:
+            _add(ingest, number, artist=number % 2)
+
+    ingest.commit()
+    assert ingest.sweep(db.Track.hash.isnot(None)) == 1
+    ingest.finish()
+
+    assert _get_track_hashes() == [100, 101, 102, 103, 105, 106]
+    assert ingest.stats.counts['tracks_inserted'] == 2
+    assert db.session().query(db.Artist).count() == 2
+
+
+def _count_tracks():
+    return db.session().query(db.Track).count()
+
+
+def test_batches(database):
+    ingest = db.Ingest('test', batch_size=2)
+
+    # Tracks are only written once a batch fills
+    counts = []
+    for number in range(5):
+        _add(ingest, number, artist=number // 3)
+        counts.append(_count_tracks())
+    assert counts == [0, 2, 2, 4, 4]
+
+    ingest.commit()
+    assert _count_tracks() == 5
+
+    album = db.session().query(db.Album).filter_by(hash=0).one()
+    assert (album.track_count, album.total_size) == (3, 3003)
+    assert db.session().query(db.Artist).filter_by(hash=1).one().track_count == 2
+
+    # Reporting the same tracks again writes nothing
+    ingest = db.Ingest('test', batch_size=2)
+    for number in range(5):
+        _add(ingest, number, artist=number // 3)
+    ingest.commit()
+
+    assert ingest.finish()['counts']['tracks_inserted'] == 0
+    assert db.get_sync_watermark('ingest', 'test') is None
+    assert _get_track_hashes() == [100, 101, 102, 103, 104]
+
+
+def test_finish_records_changes(database):
+    ingest = db.Ingest('test')
+    _add(ingest, 0)
+    ingest.commit()
+
+    summary = ingest.finish()
+    assert summary['counts']['tracks_inserted'] == 1
+    assert summary['counts']['tracks_seen'] == 1
+    assert db.get_sync_watermark('ingest', 'test') is not None
+
+
+def test_checkpoint(database):
+    ingest = db.Ingest('test', batch_size=2)
+    _add(ingest, 0)
+    ingest.end_artist('Artist 0', 1)
+    assert db.get_ingest_checkpoint('test') is None
+
+    # The checkpoint is written with the batch after it
+    _add(ingest, 1)
+    assert db.get_ingest_checkpoint('test').artist == 'Artist 0'
+    assert db.Ingest('test').get_resume_cursor() == 1
+
+    ingest.commit()
+    assert db.get_ingest_checkpoint('test') is None
+    assert db.Ingest('test').get_resume_cursor() == 0
+
+
+def test_resume(database, plex, monkeypatch):
+    fetch = plex.fetchItems
+    starts = []
+
+    def fail_on_last_container(ekey, container_start=0, **kwargs):
+        if 'type=10' in ekey:
+            starts.append(container_start)
+            if container_start == 10 and len(starts) < 4:
+                raise ConnectionError("Interrupted")
+        return fetch(ekey, container_start, **kwargs)
+
+    monkeypatch.setattr(plex, 'fetchItems', fail_on_last_container)
+
+    with pytest.raises(ConnectionError):
+        db.populate_db_from_plex()
+    db.session().rollback()
+
+    checkpoint = db.get_ingest_checkpoint('plex')
+    assert checkpoint.cursor == 5
+    assert 0 < _count_tracks() < 12
+
+    db.populate_db_from_plex(resume=True)
+
+    assert starts == [0, 5, 10, 5, 10]
+    assert _count_tracks() == 12
+    assert db.get_ingest_checkpoint('plex') is None
+    # A resumed update is not a complete pass
+    assert db.get_sync_watermark('plex', '3') is None
+
+
+def _add_playlist(*track_hashes) -> int:
+    playlist = db.Playlist(name='Playlist')
+    db.session().add(playlist)
+    db.session().commit()
+
+    db.add_tracks_to_playlist(playlist.id, [db.get_track_by_hash(track_hash).id for track_hash in track_hashes])
+    return playlist.id
+
+
+def _get_playlist_hashes(key: int):
+    return [track.hash for track in db.get_playlist_with_tracks(key).tracks]
+
+
+def _ingest(*numbers, sizes=None) -> db.Ingest:
+    ingest = db.Ingest('test', batch_size=2)
+    for number in numbers:
+        _add(ingest, number, artist=number // 3, size=(sizes or {}).get(number))
+    ingest.commit()
+    return ingest
+
+
+def test_sweep(database):
+    _ingest(0, 1, 2, 3)
+
+    ingest = _ingest(0, 2)
+    assert ingest.sweep(db.Track.hash.isnot(None)) == 2
+
+    assert _get_track_hashes() == [100, 102]
+    # The second artist and its album were left empty
+    assert db.session().query(db.Artist).count() == 1
+    assert db.session().query(db.Album).one().track_count == 2
+
+
+def test_sweep_nothing_reported(database, capsys):
+    _ingest(0, 1)
+
+    ingest = db.Ingest('test')
+    assert ingest.sweep(db.Track.hash.isnot(None)) == 0
+    assert 'No tracks were reported' in capsys.readouterr().out
+    assert _count_tracks() == 2
+
+    assert ingest.sweep(db.Track.hash == 101, allow_empty=True) == 1
+    assert _get_track_hashes() == [100]
+
+
+def test_sweep_moves(database):
+    _ingest(0, 1, 2, 3)
+    moved = _add_playlist(101, 100)
+    kept = _add_playlist(103)
+
+    # Track 1 comes back as track 5, with the same size and duration.
+    # Track 3 is replaced by track 6, which has a different size.
+    ingest = _ingest(0, 2, 5, 6, sizes={5: 1001})
+    assert ingest.sweep(db.Track.hash.isnot(None)) == 2
+    assert ingest.stats.counts['tracks_moved'] == 1
+
+    assert _get_playlist_hashes(moved) == [105, 100]
+    assert _get_playlist_hashes(kept) == []
+    assert db.get_playlist_by_id(moved).track_count == 2
+
+
+def test_sweep_move_onto_playlist(database):
+    _ingest(0, 1)
+    playlist = _add_playlist(101, 100)
+
+    # The new track is already on the playlist, so the old entry is dropped
+    ingest = db.Ingest('test')
+    _add(ingest, 5, size=1001)
+    ingest.commit()
+    db.add_tracks_to_playlist(playlist, [db.get_track_by_hash(105).id])
+
+    ingest.mark_track(100)
+    ingest.sweep(db.Track.hash.isnot(None))
+
+    assert _get_playlist_hashes(playlist) == [100, 105]
+    assert db.get_playlist_by_id(playlist).track_count == 2
@@ -0,0 +1,162 @@
+import sqlite3
+from hashlib import md5
+
+import pytest
+from flask import Flask
+from sqlalchemy import inspect
+
+import database as db
+import database.search
+import helper
+from database.migrations import MIGRATIONS
+
+# The tables as they were created before any migrations existed
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY, username VARCHAR(32) NOT NULL, password VARCHAR(100) NOT NULL,
+    music_can_delete BOOLEAN, music_can_transcode BOOLEAN, music_can_upload BOOLEAN,
+    music_can_edit BOOLEAN, music_can_download BOOLEAN, music_can_view BOOLEAN,
+    movie_can_delete BOOLEAN, movie_can_transcode BOOLEAN, movie_can_upload BOOLEAN,
+    movie_can_edit BOOLEAN, movie_can_download BOOLEAN, movie_can_view BOOLEAN,
+    tv_can_delete BOOLEAN, tv_can_transcode BOOLEAN, tv_can_upload BOOLEAN,
+    tv_can_edit BOOLEAN, tv_can_download BOOLEAN, tv_can_view BOOLEAN,
+    is_admin BOOLEAN, is_deleted BOOLEAN, api_key VARCHAR(64), lastfm_username VARCHAR(16)
+);
+CREATE TABLE artists (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, name_sort TEXT, album_count SMALLINT,
+    plex_id BIGINT UNIQUE, plex_thumb BIGINT, hash BIGINT UNIQUE
+);
+CREATE TABLE albums (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, name_sort TEXT, artist_key INTEGER REFERENCES artists (id),
+    artist_name TEXT, release_date DATE, genres TEXT, track_count SMALLINT,
+    plex_id BIGINT UNIQUE, plex_thumb BIGINT, hash BIGINT UNIQUE
+);
+CREATE TABLE tracks (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, name_sort TEXT,
+    artist_key INTEGER REFERENCES artists (id), artist_name TEXT,
+    album_key INTEGER REFERENCES albums (id), album_name TEXT,
+    duration BIGINT, track_num SMALLINT, disc_num SMALLINT, download_url TEXT, bitrate INTEGER,
+    size BIGINT, format VARCHAR(32), plex_id BIGINT UNIQUE, hash BIGINT UNIQUE
+);
+CREATE TABLE playlists (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, creator_id INTEGER REFERENCES users (id)
+);
+CREATE TABLE playlist_track (
+    track_id INTEGER REFERENCES tracks (id), playlist_id INTEGER REFERENCES playlists (id),
+    PRIMARY KEY (track_id, playlist_id)
+);
+
+INSERT INTO artists (id, name, hash) VALUES (1, 'Blue Artist', 1), (2, 'Other Artist', 2);
+INSERT INTO albums (id, name, artist_key, hash) VALUES (1, 'First', 1, 1), (2, 'Second', 1, 2), (3, 'Third', 2, 3);
+INSERT INTO tracks (id, name, artist_key, album_key, disc_num, track_num, size, duration, hash) VALUES
+    (1, 'Blue Track', 1, 1, 1, 1, 100, 10, 1), (2, 'Track', 1, 1, 2, 1, 200, 20, 2),
+    (3, 'Track', 1, 2, 1, 1, 300, NULL, 3), (4, 'Track', 2, 3, 1, 1, 400, 40, 4);
+INSERT INTO playlists (id, name) VALUES (1, 'First'), (2, 'Second');
+INSERT INTO playlist_track (playlist_id, track_id) VALUES (1, 4), (1, 1), (1, 3), (2, 2);
+"""
+
+
+@pytest.fixture
+def baseline(pmv, tmp_path, monkeypatch):
+    """
+    A database created before any migrations, migrated as the app starts.
+    """
+    path = str(tmp_path / 'pmv.db')
+    with sqlite3.connect(path) as connection:
+        connection.executescript(BASELINE_SCHEMA)
+
+    # Whether there is a search index is only checked once
+    monkeypatch.setattr(database.search, '_has_index', None)
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init(app)
+    pmv.app = app
+
+    with app.app_context():
+        yield app
+        db.session().remove()
+
+
+def _get_versions():
+    return [version for version, in db.session().query(db.SchemaMigration.version).order_by(db.SchemaMigration.version)]
+
+
+def _check_schema():
+    """
+    Checks that the database has every column and index of the models,
+    and none of the indexes which migrations have replaced.
+    """
+    inspector = inspect(db.database().engine)
+    for table in db.database().metadata.sorted_tables:
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        assert {column.name for column in table.columns} <= columns
+        assert {index.name for index in table.indexes} <= indexes
+        assert not indexes & {'ix_albums_artist_key', 'ix_playlist_track_playlist_id'}
+
+    assert db.has_search_index()
+
+
+def test_fresh(database):
+    assert _get_versions() == [version for version, _, _ in MIGRATIONS]
+    _check_schema()
+
+
+def test_baseline(baseline):
+    assert _get_versions() == [version for version, _, _ in MIGRATIONS]
+    _check_schema()
+
+    # Rows from before the search index are indexed, and new ones are added by the triggers
+    db.session().add(db.Track(name='Blue New', artist_key=2, album_key=3, hash=5))
+    db.session().commit()
+    assert [artist.id for artist in db.search_music('blue', 10, 10, 10)[0]] == [1]
+    assert sorted(track.id for track in db.search_music('blue', 10, 10, 10)[2]) == [1, 5]
+
+
+def test_baseline_aggregates(baseline):
+    albums = db.session().query(db.Album).order_by(db.Album.id)
+    assert [(album.track_count, album.disc_count, album.total_size, album.total_duration) for album in albums] == \
+        [(2, 2, 300, 30), (1, 1, 300, 0), (1, 1, 400, 40)]
+
+    artists = db.session().query(db.Artist).order_by(db.Artist.id)
+    assert [(artist.album_count, artist.track_count) for artist in artists] == [(2, 3), (1, 1)]
+
+    playlists = db.session().query(db.Playlist).order_by(db.Playlist.id)
+    assert [(playlist.track_count, playlist.total_size, playlist.total_duration) for playlist in playlists] == \
+        [(3, 800, 50), (1, 200, 20)]
+
+
+def test_baseline_playlist_positions(baseline):
+    # Existing playlists keep the order they were listed in, by track ID
+    assert [track.id for track in db.get_playlist_tracks_page(1, None).items] == [1, 3, 4]
+    assert db.add_tracks_to_playlist(1, [2]) == [2]
+    assert [track.id for track in db.get_playlist_tracks_page(1, None).items] == [1, 3, 4, 2]
+
+
+def test_migrated_once(baseline):
+    applied = [(migration.version, migration.applied_at) for migration in db.session().query(db.SchemaMigration)]
+    db.init(baseline)
+    assert [(migration.version, migration.applied_at) for migration in db.session().query(db.SchemaMigration)] == \
+        applied
+
+
+def test_widen_path_hashes(database):
+    paths = ['Artist/Album', 'Artist/Album/Track.flac']
+    for path in paths:
+        # Hashes were the first 32 bits of the digest
+        old_hash = int(md5(path.encode('utf8')).hexdigest()[:8], 16)
+        db.session().add(db.ProbeCache(path=path, path_hash=old_hash))
+        db.session().add(db.MpdDirectory(path=path, path_hash=old_hash))
+
+    db.session().query(db.SchemaMigration).filter_by(version=6).delete()
+    db.session().commit()
+
+    db.init(database)
+
+    expected = [helper.generate_path_hash(path) for path in paths]
+    for model in [db.ProbeCache, db.MpdDirectory]:
+        assert [path_hash for path_hash, in db.session().query(model.path_hash).order_by(model.id)] == expected
+    assert _get_versions()[-1] == 6
@@ -0,0 +1,116 @@
+import datetime
+
+import pytest
+
+import database as db
+import database.search
+
+
+@pytest.fixture
+def catalog(database):
+    session = db.session()
+    for i in range(9):
+        # Repeated and missing sort names and dates, so that pages tie on their first column
+        artist = db.Artist(name='Artist %d' % i, name_sort=None if i % 4 == 0 else 'Artist %d' % (i // 3), hash=i)
+        session.add(artist)
+    session.flush()
+
+    for j in range(9):
+        session.add(db.Album(name='Album %d' % j, artist_key=1, hash=j,
+                             release_date=None if j % 3 == 0 else datetime.date(2000 + j // 4, 1, 1)))
+    session.flush()
+
+    # Names which match a search to different degrees, with many exact ties
+    names = ['Blue', 'Blue Moon', 'Blue Blue', 'Moon', 'Blue Sky Blue', 'Blues'] * 4
+    for k, name in enumerate(names):
+        session.add(db.Track(name=name, artist_key=1, album_key=1, hash=k))
+
+    session.commit()
+
+
+def _get_all(get_page, limit: int):
+    """
+    :return: The IDs of every item, following the cursors from the first page.
+    """
+    keys = []
+    after = None
+    while True:
+        page = get_page(after, limit)
+        assert len(page.items) <= limit
+        keys += [item.id for item in page.items]
+
+        after = page.next_cursor
+        if not after:
+            return keys
+
+
+@pytest.mark.parametrize('limit', [1, 2, 4, 100])
+def test_artists(catalog, limit):
+    artists = db.session().query(db.Artist).all()
+    # Nulls sort first in ascending order
+    expected = [artist.id for artist in sorted(artists, key=lambda artist: (artist.name_sort is not None,
+                                                                            artist.name_sort or '', artist.id))]
+    assert _get_all(db.get_artists_page, limit) == expected
+
+
+@pytest.mark.parametrize('limit', [1, 2, 4, 100])
+def test_albums_newest_first(catalog, limit):
+    albums = db.session().query(db.Album).all()
+    # Nulls sort last in descending order
+    expected = [album.id for album in sorted(albums, key=lambda album: (album.release_date is None,
+                                                                        -album.release_date.toordinal()
+                                                                        if album.release_date else 0, -album.id))]
+    assert _get_all(lambda after, n: db.get_artist_albums_page(1, after, n), limit) == expected
+
+
+def test_last_page(catalog):
+    page = db.get_artists_page(None, 9)
+    assert len(page.items) == 9 and page.next_cursor is None
+
+
+@pytest.mark.parametrize('cursor', ['not a cursor', db.encode_cursor([1]), db.encode_cursor('Artist')])
+def test_invalid_cursor(catalog, cursor):
+    with pytest.raises(db.InvalidCursorError):
+        db.get_artists_page(cursor, 2)
+
+
+def test_invalid_date_cursor(catalog):
+    with pytest.raises(db.InvalidCursorError):
+        db.get_artist_albums_page(1, db.encode_cursor(['May', 1]), 2)
+
+
+def test_cursor_round_trip():
+    values = [datetime.date(2001, 2, 3), None, 'Name', 4]
+    assert db.decode_cursor(db.encode_cursor(values), 4) == ['2001-02-03', None, 'Name', 4]
+
+
+@pytest.mark.parametrize('limit', [1, 3, 5, 100])
+def test_search_rank_cursors(catalog, limit):
+    assert db.has_search_index()
+
+    track = database.search.SEARCH_MODELS.index(db.Track)
+    pages = _get_all(lambda after, n: db.search_music_page('blue', track, after, n), limit)
+    expected = [item.id for item in db.search_music_page('blue', track, None, 100).items]
+
+    assert pages == expected
+    assert len(set(pages)) == 20
+    # Names repeating the term rank highest, and each group of ties is split across pages
+    assert {db.get_track_by_id(key).name for key in pages[:4]} == {'Blue Blue'}
+
+
+def test_search_fallback(catalog, monkeypatch):
+    monkeypatch.setattr(database.search, '_has_index', False)
+
+    track = database.search.SEARCH_MODELS.index(db.Track)
+    pages = _get_all(lambda after, n: db.search_music_page('moon', track, after, n), 3)
+    assert pages == sorted(key for key, in db.session().query(db.Track.id).filter(db.Track.name.like('%Moon%')))
+
+
+def test_playlist_tracks(catalog):
+    playlist = db.Playlist(name='Playlist')
+    db.session().add(playlist)
+    db.session().commit()
+
+    track_keys = [5, 3, 9, 1, 7]
+    db.add_tracks_to_playlist(playlist.id, track_keys)
+    assert _get_all(lambda after, n: db.get_playlist_tracks_page(playlist.id, after, n), 2) == track_keys
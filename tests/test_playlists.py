@@ -0,0 +1,111 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import database as db
+import database.playlists
+
+
+@pytest.fixture
+def tracks(database):
+    session = db.session()
+    artist = db.Artist(name='Artist', hash=1)
+    session.add(artist)
+    session.flush()
+
+    album = db.Album(name='Album', artist_key=artist.id, hash=1)
+    session.add(album)
+    session.flush()
+
+    keys = []
+    for i in range(6):
+        track = db.Track(name='Track %d' % i, artist_key=artist.id, album_key=album.id, track_num=6 - i, disc_num=1,
+                         size=100 * (i + 1), duration=10 * (i + 1), hash=i)
+        session.add(track)
+        session.flush()
+        keys.append(track.id)
+
+    session.commit()
+    return keys
+
+
+@pytest.fixture
+def playlist(database):
+    playlist = db.Playlist(name='Playlist')
+    db.session().add(playlist)
+    db.session().commit()
+    return playlist.id
+
+
+def _get_entries(key: int):
+    return [track_key for track_key, in db.session().query(db.playlist_track.c.track_id)
+            .filter(db.playlist_track.c.playlist_id == key).order_by(db.playlist_track.c.position)]
+
+
+def _get_aggregates(key: int):
+    playlist = db.session().query(db.Playlist).get(key)
+    db.session().refresh(playlist)
+    return playlist.track_count, playlist.total_size, playlist.total_duration
+
+
+def test_add_tracks(tracks, playlist):
+    assert db.add_tracks_to_playlist(playlist, [tracks[2], tracks[0], tracks[2], 10 ** 6]) == [tracks[2], tracks[0]]
+    assert db.add_tracks_to_playlist(playlist, [tracks[0], tracks[1]]) == [tracks[1]]
+
+    assert _get_entries(playlist) == [tracks[2], tracks[0], tracks[1]]
+    assert _get_aggregates(playlist) == (3, 600, 60)
+
+
+def test_add_album(tracks, playlist):
+    album_key = db.get_track_by_id(tracks[0]).album_key
+    assert db.add_album_to_playlist(playlist, album_key) == tracks[::-1]
+    assert _get_aggregates(playlist) == (6, 2100, 210)
+
+
+def test_remove_tracks(tracks, playlist):
+    db.add_tracks_to_playlist(playlist, tracks)
+
+    assert db.remove_tracks_from_playlist(playlist, [tracks[1], tracks[4], 10 ** 6]) == [tracks[1], tracks[4]]
+    assert _get_entries(playlist) == [tracks[0], tracks[2], tracks[3], tracks[5]]
+    assert _get_aggregates(playlist) == (4, 1400, 140)
+
+    # The incremental aggregates agree with recomputing them
+    db.update_playlist_aggregates([playlist])
+    db.session().commit()
+    assert _get_aggregates(playlist) == (4, 1400, 140)
+
+
+@pytest.mark.parametrize('moved, position, expected', [
+    ([3, 1], 0, [3, 1, 0, 2, 4, 5]),
+    ([0], 10, [1, 2, 3, 4, 5, 0]),
+    ([5, 4, 3, 2, 1, 0], 0, [5, 4, 3, 2, 1, 0]),
+    ([2, 10 ** 6], 1, [0, 2, 1, 3, 4, 5]),
+])
+def test_move_tracks(tracks, playlist, moved, position, expected):
+    db.add_tracks_to_playlist(playlist, tracks)
+    keys = [tracks[i] if i < len(tracks) else i for i in moved]
+
+    order = [tracks[i] for i in expected]
+    assert db.move_tracks_in_playlist(playlist, keys, position) == order
+    assert _get_entries(playlist) == order
+
+
+@pytest.mark.parametrize('code, retried', [(1213, True), (1205, True), (1045, False)])
+def test_add_retries_on_lock_errors(tracks, playlist, monkeypatch, code, retried):
+    add_tracks = database.playlists._add_tracks
+    calls = []
+
+    def fail_once(key, track_keys):
+        calls.append(key)
+        if len(calls) == 1:
+            raise OperationalError('INSERT', {}, Exception(code, 'Lock error'))
+        return add_tracks(key, track_keys)
+
+    monkeypatch.setattr(database.playlists, '_add_tracks', fail_once)
+
+    if retried:
+        assert db.add_tracks_to_playlist(playlist, tracks[:2]) == tracks[:2]
+        assert _get_aggregates(playlist) == (2, 300, 30)
+    else:
+        with pytest.raises(OperationalError):
+            db.add_tracks_to_playlist(playlist, tracks[:2])
+        assert _get_entries(playlist) == []
@@ -0,0 +1,94 @@
+import plex_listener
+import database as db
+
+
+def _get_ids():
+    session = db.session()
+    return [sorted(key for key, in session.query(model.id)) for model in [db.Artist, db.Album, db.Track]]
+
+
+def _sync_alerts(queue: plex_listener.UpdateQueue, msg: dict):
+    """
+    Passes an alert through the queue and syncs
+    the batch it produces, as the listener does.
+    """
+    for key, deleted in plex_listener.parse_alert(msg, 3):
+        queue.put(key, deleted)
+
+    batch = queue.get_batch()
+    db.sync_plex_items([key for key, deleted in batch.items() if not deleted],
+                       [key for key, deleted in batch.items() if deleted])
+
+
+def _timeline(item, state: int = 5) -> dict:
+    return {'type': 'timeline', 'TimelineEntry': [{'identifier': 'com.plexapp.plugins.library', 'sectionID': '3',
+                                                   'itemID': str(item.ratingKey), 'type': 9, 'state': state}]}
+
+
+def test_renamed_album_alert(database, plex):
+    db.populate_db_from_plex()
+    ids = _get_ids()
+
+    album = plex.items[2]
+    plex.rename(album, 'Renamed')
+    _sync_alerts(plex_listener.UpdateQueue(0, 0), _timeline(album))
+
+    assert _get_ids() == ids
+
+    renamed = db.get_album_by_plex_key(album.ratingKey)
+    assert renamed.name == 'Renamed'
+    assert renamed.track_count == 3
+    assert {track.album_name for track in renamed.tracks} == {'Renamed'}
+    assert db.get_album_by_hash(renamed.hash).id == renamed.id
+
+
+def _add_playlist(track_keys) -> int:
+    playlist = db.Playlist(name='Playlist')
+    db.session().add(playlist)
+    db.session().commit()
+
+    db.add_tracks_to_playlist(playlist.id, track_keys)
+    return playlist.id
+
+
+def _get_playlist_entries(key: int):
+    return [(track_key, position) for track_key, position in
+            db.session().query(db.playlist_track.c.track_id, db.playlist_track.c.position)
+            .filter(db.playlist_track.c.playlist_id == key).order_by(db.playlist_track.c.position)]
+
+
+def test_renamed_track_full_pass(database, plex):
+    db.populate_db_from_plex()
+    ids = _get_ids()
+
+    track = plex.items[4]
+    key = db.get_track_by_plex_key(track.ratingKey).id
+    playlist_key = _add_playlist([ids[2][-1], key, ids[2][0]])
+    entries = _get_playlist_entries(playlist_key)
+
+    plex.rename(track, 'Renamed')
+    db.populate_db_from_plex()
+
+    assert _get_ids() == ids
+    assert db.get_track_by_id(key).name == 'Renamed'
+    assert _get_playlist_entries(playlist_key) == entries
+
+
+def test_moved_track_full_pass(database, plex):
+    db.populate_db_from_plex()
+
+    # Re-adding a file under a new path gives it a new rating key
+    old = plex.items.pop(4)
+    album = plex.items[old.parentRatingKey]
+    album.children.remove(old)
+    new = plex.add_track(album, 'Moved', size=old.size)
+
+    old_key = db.get_track_by_plex_key(old.ratingKey).id
+    playlist_key = _add_playlist([old_key, db.get_track_by_plex_key(5).id])
+
+    db.populate_db_from_plex()
+
+    new_key = db.get_track_by_plex_key(new.ratingKey).id
+    assert db.get_track_by_id(old_key) is None
+    assert _get_playlist_entries(playlist_key) == [(new_key, 0), (db.get_track_by_plex_key(5).id, 1)]
+    assert db.get_playlist_by_id(playlist_key).track_count == 2
@@ -0,0 +1,21 @@
+import datetime
+
+import pytest
+
+import database as db
+
+
+@pytest.mark.parametrize('value, expected', [
+    (2019, datetime.date(2019, 1, 1)),
+    ('2019', datetime.date(2019, 1, 1)),
+    ('2019-05', datetime.date(2019, 5, 1)),
+    ('2019-05-03', datetime.date(2019, 5, 3)),
+    ('2019-05-03T00:00:00', datetime.date(2019, 5, 3)),
+    ('2019-05-03T12:30:00Z', datetime.date(2019, 5, 3)),
+    (' 2019-05-03 ', datetime.date(2019, 5, 3)),
+    ('May 2019', None),
+    ('2019-13-01', None),
+    (None, None),
+])
+def test_formatted_date(value, expected):
+    assert db.get_formatted_date(value) == expected
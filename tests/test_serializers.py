@@ -0,0 +1,103 @@
+import datetime
+import json
+
+import jsonpickle
+import pytest
+
+import database as db
+from routes.helpers import get_json_response
+from routes.serializers import ALBUM, ARTIST, PLAYLIST, TRACK, TRACK_WITH_ALBUM, USER, to_json
+
+
+@pytest.fixture
+def catalog(database):
+    session = db.session()
+    artist = db.Artist(name='Artist', name_sort='Artist, The', hash=1, plex_id=10)
+    session.add(artist)
+    session.flush()
+
+    album = db.Album(name='Album', artist_key=artist.id, artist_name='Artist', hash=1, genres='rock',
+                     release_date=datetime.date(2001, 2, 3))
+    session.add(album)
+    session.flush()
+
+    for i in range(3):
+        session.add(db.Track(name='Track %d' % i, artist_key=artist.id, album_key=album.id, artist_name='Artist',
+                             album_name='Album', track_num=i + 1, disc_num=1, size=100, duration=10, format='mp3',
+                             hash=i))
+
+    playlist = db.Playlist(name='Playlist')
+    session.add(playlist)
+    session.commit()
+
+    db.add_tracks_to_playlist(playlist.id, [1, 2])
+    db.update_album_aggregates()
+    db.update_artist_aggregates()
+    db.add_user('user', 'password')
+    db.session().commit()
+
+
+def _encode_old(obj) -> dict:
+    """
+    :return: The object as the routes encoded it before the serializers.
+    """
+    return json.loads(jsonpickle.encode(obj, unpicklable=False, max_depth=2, keys=False))
+
+
+def _get_models():
+    return [
+        (ARTIST, db.get_artist_by_id(1)),
+        (ALBUM, db.get_album_by_id(1)),
+        (TRACK, db.get_track_by_id(1)),
+        (PLAYLIST, db.session().query(db.Playlist).get(1)),
+        (USER, db.get_user_by_username('user')),
+    ]
+
+
+def test_old_shape(catalog):
+    for serializer, obj in _get_models():
+        old = _encode_old(obj)
+        new = json.loads(to_json(obj))
+
+        # Every field keeps its name and value
+        assert list(new) == list(serializer.fields)
+        assert new == {field: old[field] for field in serializer.fields}
+
+
+def test_no_private_fields(catalog):
+    user = json.loads(to_json(db.get_user_by_username('user')))
+    assert 'password' not in user and 'api_key' not in user
+
+    cached = json.loads(to_json(db.get_cached_user(1)))
+    assert cached == user
+
+
+def test_nested(catalog):
+    track = db.get_track_with_album(1)
+    old = _encode_old(track)
+    new = json.loads(to_json(track, TRACK_WITH_ALBUM))
+
+    assert {field: new[field] for field in TRACK.fields} == {field: old[field] for field in TRACK.fields}
+    # Nested dates were encoded by their repr, and are now ISO dates too
+    assert old['album']['release_date'] == 'datetime.date(2001, 2, 3)'
+    assert new['album'] == dict({field: old['album'][field] for field in ALBUM.fields}, release_date='2001-02-03')
+
+
+def test_lists(catalog):
+    artists = [db.get_artist_by_id(1)] * 2
+    assert json.loads(to_json(artists)) == [json.loads(to_json(artists[0]))] * 2
+    assert json.loads(to_json({'artists': artists})) == {'artists': json.loads(to_json(artists))}
+
+
+def test_page(catalog):
+    page = db.get_artists_page(None)
+    assert json.loads(to_json(page)) == [json.loads(to_json(artist)) for artist in page.items]
+
+
+def test_json_response(database, catalog):
+    album = db.get_album_by_id(1)
+    with database.test_request_context():
+        response = get_json_response(album, append={'tracks': [1, 2, 3]})
+
+    assert response.mimetype == 'application/json'
+    assert json.loads(response.get_data()) == dict(json.loads(to_json(album)), tracks=[1, 2, 3])
@@ -0,0 +1,112 @@
+import datetime
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import database as db  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'pmv.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init(app)
+
+    with app.app_context():
+        session = db.session()
+        for i in range(7):
+            # Repeated and missing sort names and dates, so that pages tie on their first column
+            artist = db.Artist(name='Artist %d' % i, name_sort=None if i == 3 else 'Artist %d' % (i // 2),
+                               hash=i, track_count=5)
+            session.add(artist)
+            session.flush()
+
+            for j in range(5):
+                album = db.Album(name='Album %d' % j, artist_key=artist.id, artist_name=artist.name,
+                                 release_date=None if j == 2 else datetime.date(2000 + j // 2, 1, 1),
+                                 genres='rock', hash=i * 10 + j)
+                session.add(album)
+                session.flush()
+
+                session.add(db.Track(name='Track %d' % j, name_sort='Track %d' % j, artist_key=artist.id,
+                                     album_key=album.id, duration=None if j == 4 else 1000 * j,
+                                     track_num=j + 1, disc_num=1, download_url='%d/%d.mp3' % (i, j),
+                                     hash=i * 10 + j))
+        session.commit()
+
+        yield app
+
+
+@pytest.fixture
+def snapshot(app, tmp_path):
+    path = str(tmp_path / 'catalog.snapshot')
+    with app.app_context():
+        db.write_catalog_snapshot(path)
+
+    with db.CatalogSnapshot(path) as snapshot:
+        yield snapshot
+
+
+def _get_pages(get_page, limit):
+    """
+    :return: The IDs on each page and the cursor after each,
+    following the cursors until the last page.
+    """
+    pages = []
+    after = None
+    while True:
+        page = get_page(after, limit)
+        pages.append(([item.id for item in page.items], page.next_cursor))
+
+        after = page.next_cursor
+        if not after:
+            return pages
+
+
+def test_round_trip(app, snapshot):
+    columns = ['id', 'name', 'name_sort', 'artist_key', 'artist_name', 'release_date', 'genres']
+
+    with app.app_context():
+        for album in db.session().query(db.Album):
+            row = snapshot.get_album(album.id)
+            assert [getattr(row, name) for name in columns] == [getattr(album, name) for name in columns]
+
+        track = db.session().query(db.Track).filter_by(duration=None).first()
+        assert snapshot.get_album_tracks(track.album_key)[0].duration is None
+
+    assert snapshot.get_artist(10 ** 6) is None
+
+
+def test_empty_catalog(app, tmp_path):
+    path = str(tmp_path / 'empty.snapshot')
+    with app.app_context():
+        for model in [db.Track, db.Album, db.Artist]:
+            db.session().query(model).delete()
+        db.session().commit()
+        db.write_catalog_snapshot(path)
+
+    with db.CatalogSnapshot(path) as snapshot:
+        page = snapshot.get_artists_page(None, 100)
+        assert page is not None and page.items == [] and page.next_cursor is None
+        assert snapshot.get_artist_albums_page(1, None, 100) is None
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 100])
+def test_cursor_parity(app, snapshot, limit):
+    with app.app_context():
+        assert _get_pages(snapshot.get_artists_page, limit) == _get_pages(db.get_artists_page, limit)
+
+        for artist_key in [1, 4]:
+            assert _get_pages(lambda after, n: snapshot.get_artist_albums_page(artist_key, after, n), limit) == \
+                _get_pages(lambda after, n: db.get_artist_albums_page(artist_key, after, n), limit)
+
+        # Cursors from the database continue in the snapshot, and the other way around
+        cursor = db.get_artists_page(None, limit).next_cursor
+        if cursor:
+            assert [item.id for item in snapshot.get_artists_page(cursor, limit).items] == \
+                [item.id for item in db.get_artists_page(cursor, limit).items]
@@ -0,0 +1,82 @@
+import pytest
+
+import database as db
+from database import user_cache
+
+
+@pytest.fixture
+def user(database, monkeypatch):
+    # Each test starts with an empty cache
+    monkeypatch.setattr(user_cache, '_users', {})
+    monkeypatch.setattr(user_cache, '_api_keys', {})
+
+    db.add_user('user', 'password')
+    return db.get_user_by_username('user')
+
+
+def _set_directly(user, **fields):
+    """
+    Changes a user without going through the queries which invalidate the cache.
+    """
+    db.session().query(db.User).filter_by(id=user.id).update(fields)
+    db.session().commit()
+
+
+def test_copy(user):
+    cached = db.get_cached_user(user.id)
+
+    assert isinstance(cached, db.CachedUser)
+    assert (cached.id, cached.username, cached.api_key, cached.is_admin) == (user.id, 'user', user.api_key, False)
+    assert cached.music_can_view and not cached.music_can_delete
+    assert cached.has_permission(db.Permission.music_can_view)
+    assert cached.get_id() == str(user.id)
+
+    with pytest.raises(AttributeError):
+        cached.password
+
+
+def test_cached(user):
+    cached = db.get_cached_user(user.id)
+    _set_directly(user, username='renamed')
+
+    assert db.get_cached_user(str(user.id)) is cached
+    assert db.get_cached_user_by_api_key(user.api_key) is cached
+
+
+def test_expiry(user):
+    cached = db.get_cached_user(user.id, ttl=0)
+    _set_directly(user, username='renamed')
+
+    assert db.get_cached_user(user.id).username == 'renamed'
+    assert db.get_cached_user(user.id) is not cached
+
+
+def test_edit_invalidates(user):
+    old_key = user.api_key
+    assert db.get_cached_user(user.id).music_can_view
+    assert db.get_cached_user_by_api_key(old_key) is not None
+
+    db.edit_user_by_id(user.id, {'music_perms': 'd-----', 'api_key': 'new key', 'is_admin': 'True'})
+
+    cached = db.get_cached_user(user.id)
+    assert cached.is_admin
+    assert cached.music_can_delete and not cached.music_can_view
+    assert db.get_cached_user_by_api_key(old_key) is None
+    assert db.get_cached_user_by_api_key('new key').id == user.id
+
+
+def test_delete_invalidates(user):
+    db.get_cached_user(user.id)
+    api_key = user.api_key
+
+    db.delete_user_by_id(user.id)
+    assert db.get_cached_user(user.id) is None
+    assert db.get_cached_user_by_api_key(api_key) is None
+
+    db.delete_user_by_username('user', restore=True)
+    assert db.get_cached_user(user.id).username == 'user'
+
+
+@pytest.mark.parametrize('key', ['', 'user', '1; --', None])
+def test_invalid_keys(user, key):
+    assert db.get_cached_user(key) is None